@@ -0,0 +1,167 @@
+import csv
+import threading
+
+from array import array
+from time import monotonic
+
+
+class AliasIndex:
+    """
+    Maps the surface forms of entities (other spellings, redirects, normalized titles, ...) to the canonical title of
+    the wikipedia page they resolve to. The cache only stores one row per canonical title, every alias points to it.
+
+    Aliases are not stored as strings but as their 64 bit hash in an open addressing hash table, every canonical title
+    is stored once. Hence memory grows with the number of canonical titles; an alias only costs a few bytes. Two
+    aliases with the same hash would share a title, which is negligible for 64 bit hashes.
+
+    The index is persisted in an append-only csv file (alias, title) and rebuilt from it when opened. New aliases are
+    visible at once but appended in batches (see flush), so lookups do not wait for a write per alias.
+    """
+
+    header = ["alias", "title"]
+    _empty_slot = -1
+
+    def __init__(self, filename=None, base_filenames=(), batch_size=1000, max_latency=1.0):
+        """
+
+        :param filename: Csv file the index is read from and new aliases are appended to. If None, the index is only
+            kept in memory.
+        :param base_filenames: Further csv files which are only read (e.g. the index shared by all shards).
+        :param batch_size: Number of new aliases which are appended to filename at once.
+        :param max_latency: Seconds after which new aliases are appended even if there are less than batch_size.
+        """
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self._lock = threading.Lock()
+        # serializes the writes to the file, held without self._lock, so lookups do not wait for them
+        self._file_lock = threading.Lock()
+        self._pending_aliases = []
+        self._written = monotonic()
+        self._hashes = array('q', [0]) * 8
+        self._title_ids = array('i', [self._empty_slot]) * 8
+        self._aliases = 0
+        self._titles = []
+        self._title_index = dict()
+
+        for base_filename in base_filenames:
+            self._load(base_filename)
+
+        self._file = None
+        if filename is not None:
+            self._load(filename)
+            self._file = open(filename, "a")
+            if self._file.tell() == 0:
+                csv.writer(self._file).writerow(self.header)
+                self._file.flush()
+
+    def _load(self, filename):
+        try:
+            with open(filename, "r") as file:
+                reader = csv.reader(file)
+                next(reader, None)
+                for alias, title in reader:
+                    self._put(alias, title)
+        except FileNotFoundError:
+            pass
+
+    def _find_slot(self, alias_hash):
+        mask = len(self._hashes) - 1
+        slot = alias_hash & mask
+        while self._title_ids[slot] != self._empty_slot and self._hashes[slot] != alias_hash:
+            slot = (slot + 1) & mask
+        return slot
+
+    def _grow(self):
+        hashes, title_ids = self._hashes, self._title_ids
+        self._hashes = array('q', [0]) * (len(hashes) * 2)
+        self._title_ids = array('i', [self._empty_slot]) * (len(hashes) * 2)
+        for alias_hash, title_id in zip(hashes, title_ids):
+            if title_id != self._empty_slot:
+                slot = self._find_slot(alias_hash)
+                self._hashes[slot] = alias_hash
+                self._title_ids[slot] = title_id
+
+    def _put(self, alias, title):
+        """
+        :return: False if alias already pointed to title.
+        """
+        title_id = self._title_index.get(title, None)
+        if title_id is None:
+            title_id = len(self._titles)
+            self._titles.append(title)
+            self._title_index[title] = title_id
+
+        alias_hash = hash(alias)
+        slot = self._find_slot(alias_hash)
+        if self._title_ids[slot] == title_id:
+            return False
+        if self._title_ids[slot] == self._empty_slot:
+            self._aliases += 1
+        self._hashes[slot] = alias_hash
+        self._title_ids[slot] = title_id
+
+        # keep the load factor of the hash table below 2/3
+        if 3 * self._aliases > 2 * len(self._hashes):
+            self._grow()
+        return True
+
+    def add(self, alias, title):
+        """
+        Records that alias resolves to the page title. Aliases equal to their title are not recorded, the cache
+        already contains a row for every title.
+        """
+        if alias == title:
+            return
+
+        with self._lock:
+            if not self._put(alias, title) or self._file is None:
+                return
+            self._pending_aliases.append((alias, title))
+            due = len(self._pending_aliases) >= self.batch_size or monotonic() - self._written >= self.max_latency
+
+        if due:
+            # another thread already writing takes the new aliases with it or leaves them for the next batch
+            self._write_pending_aliases(blocking=False)
+
+    def _write_pending_aliases(self, blocking=True):
+        if not self._file_lock.acquire(blocking):
+            return
+        try:
+            with self._lock:
+                aliases, self._pending_aliases = self._pending_aliases, []
+                self._written = monotonic()
+            if aliases and self._file is not None and not self._file.closed:
+                csv.writer(self._file).writerows(aliases)
+                self._file.flush()
+        finally:
+            self._file_lock.release()
+
+    def flush(self):
+        """
+        Appends all new aliases to the file.
+        """
+        self._write_pending_aliases()
+
+    def get(self, alias):
+        """
+        :return: The canonical title of alias or None if alias is unknown.
+        """
+        alias_hash = hash(alias)
+        with self._lock:
+            title_id = self._title_ids[self._find_slot(alias_hash)]
+            return None if title_id == self._empty_slot else self._titles[title_id]
+
+    def __len__(self):
+        return self._aliases
+
+    def titles(self):
+        """
+        :return: Number of distinct canonical titles.
+        """
+        return len(self._titles)
+
+    def close(self):
+        self.flush()
+        with self._file_lock:
+            if self._file is not None and not self._file.closed:
+                self._file.close()
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import threading
+
+import aiohttp
+
+from time import monotonic
+
+from named_entity_linker import NamedEntityLinking
+from wikidata_entity_linker import WikidataEntityLinker
+
+
+class AsyncWikidataEntityLinker(WikidataEntityLinker):
+    """
+    WikidataEntityLinker which performs all 'wbgetentities' requests from a single asyncio event loop using one shared
+    connection pool. Instead of one blocking request per thread, up to max_in_flight batched requests may be pending
+    at the same time.
+
+    The linker owns its event loop, which runs in a daemon thread. Synchronous callers (entity_id, entity_ids) and
+    coroutines running in other event loops are dispatched onto that loop, so every request shares the same
+    aiohttp session no matter where it originates.
+    """
+
+    def __init__(self, entities_per_request=50, max_in_flight=200, rate_limiter=None, metrics=None, api_url=None,
+                 batch_sizer=None, cassette=None, request_timeout=None):
+        WikidataEntityLinker.__init__(self, session=None, entities_per_request=entities_per_request,
+                                      rate_limiter=rate_limiter, metrics=metrics, api_url=api_url,
+                                      batch_sizer=batch_sizer, cassette=cassette, request_timeout=request_timeout)
+        self.max_in_flight = max_in_flight
+        self._semaphore = None
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+            self._session = None
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _dispatch(self, coroutine):
+        if asyncio.get_running_loop() is self._loop:
+            return await coroutine
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self._loop))
+
+    def _get_session(self):
+        # aiohttp sessions are bound to the loop they are created in, hence they are created lazily inside self._loop
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+            # aiohttp's default timeout of 5 minutes would stall a batch far longer than the synchronous linker does
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.request_timeout))
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._session
+
+    async def _async_execute_query(self, params):
+        """
+        :return: A tuple<int, headers, dict, bytes>, containing the http status code, the response headers, the
+            decoded json response (None if the request did not succeed) and the body of the response.
+        """
+        session = self._get_session()
+        if self._use_post(params):
+            self._methods.inc(labels=('POST',))
+            request = session.post(self.wikidata_api_url, data=params)
+        else:
+            self._methods.inc(labels=('GET',))
+            request = session.get(self.wikidata_api_url, params=params)
+
+        async with self._semaphore:
+            async with request as response:
+                body = await response.read()
+                if response.status != 200:
+                    return response.status, response.headers, None, body
+                try:
+                    return response.status, response.headers, json.loads(body), body
+                except ValueError:
+                    return response.status, response.headers, None, body
+
+    async def _async_link_entities(self, entities, not_found_entities, normalize=None):
+        """
+        Coroutine version of WikidataEntityLinker._link_entities.
+        """
+        if len(entities) > self.entities_per_request:
+            raise Exception(f"Only {self.entities_per_request} entities are allowed per request. You are trying to "
+                            f"request {len(entities)} entities at once.")
+
+        entities = self._requestable_entities(entities, not_found_entities)
+        if len(entities) == 0:
+            return dict()
+
+        if normalize is None:
+            normalize = True if len(entities) == 1 else False
+
+        params = self._query_params(self.join_titles(entities), normalize)
+        if self._replaying():
+            return self._replay_entities(entities, params, not_found_entities)
+
+        try_count = 1
+        while True:
+            await asyncio.sleep(self.rate_limiter.reserve())
+            started = monotonic()
+            with self._request_seconds.time():
+                try:
+                    status_code, headers, query_result_json, content = await self._async_execute_query(params)
+                except asyncio.TimeoutError:
+                    status_code = None
+            if status_code is None:
+                self._report_timeout(started, try_count)
+                await asyncio.sleep(self.rate_limiter.backoff_delay(try_count))
+                try_count += 1
+                self._retries.inc()
+                continue
+            if status_code == 414 and try_count < self.max_tries:
+                self._shorten_get_queries(params)
+                try_count += 1
+                continue
+            self._report_batch(len(entities), started, len(content), status_code, query_result_json)
+            if not self._must_retry(status_code, headers, query_result_json):
+                if self.cassette is not None:
+                    self.cassette.record(params, content)
+                break
+
+            if try_count >= self.max_tries:
+                raise Exception(f"http request to fetch wikidata ids to entity failed with {status_code}.")
+
+            await asyncio.sleep(self.rate_limiter.backoff_delay(try_count))
+            try_count += 1
+            self._retries.inc()
+
+        return self._parse_query_result(entities, query_result_json, not_found_entities)
+
+    async def _async_entity_id(self, entity):
+        if not entity:
+            raise Exception("entity must not be None or empty.")
+
+        result = await self._async_link_entities([entity], set())
+        assert len(result) < 2, "An entity should only be linked to max one id."
+
+        if len(result) == 0:
+            return None, NamedEntityLinking.NOT_FOUND
+
+        return list(result.values())[0], NamedEntityLinking.SUCCESS
+
+    async def _async_entity_ids(self, entities, not_found_entities):
+        if len(entities) > self.entities_per_request:
+            raise Exception(f"Only {self.entities_per_request} entities are allowed per request. You are trying to "
+                            f"request {len(entities)} entities at once.")
+
+        missing_batch_entities = set()
+        self._pass_requests.inc(labels=('batch',))
+        linked_entities = await self._async_link_entities(entities, missing_batch_entities)
+        missing_batch_entities = [entity for entity in entities if entity in missing_batch_entities]
+
+        # the candidate batches and the remaining normalization requests are independent of each other, so they are
+        # all sent at once
+        candidates, candidate_batches = self._normalization_candidate_batches(missing_batch_entities, entities)
+        linked_candidates = dict()
+        self._pass_requests.inc(len(candidate_batches), ('candidates',))
+        for result in await asyncio.gather(*[self._async_link_entities(candidate_batch, None, normalize=False)
+                                             for candidate_batch in candidate_batches]):
+            linked_candidates.update(result)
+
+        unresolved_entities = self._apply_normalization_candidates(candidates, linked_candidates, linked_entities,
+                                                                   not_found_entities)
+        self._pass_requests.inc(len(unresolved_entities), ('normalize',))
+        results = await asyncio.gather(*[self._async_entity_id(entity) for entity in unresolved_entities])
+
+        for entity, (linked_entity, linking_info) in zip(unresolved_entities, results):
+            if linked_entity is None:
+                if not_found_entities is not None:
+                    not_found_entities.add(entity)
+                continue
+
+            linked_entities[entity] = linked_entity
+
+        return linked_entities
+
+    async def async_entity_id(self, entity):
+        return await self._dispatch(self._async_entity_id(entity))
+
+    async def async_entity_ids(self, entities, not_found_entities=None):
+        """
+        Coroutine version of WikidataEntityLinker.entity_ids. May be awaited from any event loop.
+        """
+        return await self._dispatch(self._async_entity_ids(entities, not_found_entities))
+
+    def entity_id(self, entity):
+        return self._run(self._async_entity_id(entity))
+
+    def entity_ids(self, entities, not_found_entities=None):
+        return self._run(self._async_entity_ids(entities, not_found_entities))
@@ -0,0 +1,97 @@
+import threading
+
+from collections import namedtuple
+from time import monotonic
+
+BatchSizerState = namedtuple('BatchSizerState', ['size', 'latency', 'response_bytes', 'decreases', 'errors'])
+
+
+class AdaptiveBatchSizer:
+    """
+    Thread-safe controller of the number of entities per request (AIMD):
+        - every full batch answered within target_latency and below max_response_bytes increases the batch size
+          additively (by `increase` entities),
+        - a batch exceeding target_latency or max_response_bytes, and every request failing because of its size
+          (timeouts, too long urls or bodies), multiplies the batch size with `decrease`.
+
+    Large batches need fewer requests per entity, small batches keep the latency of a single request low. Throttling
+    is handled by the rate limiter, other server errors are retried, neither changes the batch size.
+
+    Many requests are in flight at the same time, so a slow phase would be reported by all of them at once. Hence
+    only requests which have been sent after the last decrease can decrease the batch size again.
+    """
+
+    def __init__(self, max_size=50, min_size=5, initial_size=None, target_latency=2.0,
+                 max_response_bytes=4 * 1024 * 1024, increase=1.0, decrease=0.5, smoothing=0.2):
+        """
+
+        :param max_size: Largest batch size, e.g. the number of titles wikidata allows per request.
+        :param initial_size: Batch size to start with (default: max_size).
+        :param target_latency: Seconds a request may take before the batch size is decreased.
+        :param smoothing: Weight of the newest observation in the moving averages of latency and response size.
+        """
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.target_latency = target_latency
+        self.max_response_bytes = max_response_bytes
+        self.increase = increase
+        self.decrease = decrease
+        self.smoothing = smoothing
+
+        self._lock = threading.Lock()
+        self._size = float(initial_size if initial_size is not None else max_size)
+        self._last_decrease = 0.0
+        self._latency = None
+        self._response_bytes = None
+        self._decreases = 0
+        self._errors = 0
+
+    def size(self):
+        """
+        :return: The number of entities the next request should contain.
+        """
+        with self._lock:
+            return int(self._size)
+
+    def _average(self, average, value):
+        return value if average is None else average + self.smoothing * (value - average)
+
+    def _decrease(self, started):
+        if started < self._last_decrease:
+            return
+        self._size = max(float(self.min_size), self._size * self.decrease)
+        self._last_decrease = monotonic()
+        self._decreases += 1
+
+    def record_success(self, batch_size, started, seconds, response_bytes):
+        """
+
+        :param batch_size: Number of entities the request contained.
+        :param started: monotonic() when the request has been sent.
+        :param seconds: Duration of the request.
+        :param response_bytes: Size of the answer.
+        """
+        with self._lock:
+            self._latency = self._average(self._latency, seconds)
+            self._response_bytes = self._average(self._response_bytes, response_bytes)
+
+            if seconds > self.target_latency or response_bytes > self.max_response_bytes:
+                self._decrease(started)
+            elif batch_size >= int(self._size):
+                # only full batches show that the current size is fine
+                self._size = min(float(self.max_size), self._size + self.increase)
+
+    def record_error(self, started):
+        """
+        Records a request which failed because of its size, e.g. a timeout or a 414.
+
+        :param started: monotonic() when the failed request has been sent.
+        """
+        with self._lock:
+            self._errors += 1
+            self._decrease(started)
+
+    def state(self):
+        with self._lock:
+            return BatchSizerState(size=int(self._size), latency=self._latency, response_bytes=self._response_bytes,
+                                   decreases=self._decreases, errors=self._errors)
@@ -0,0 +1,125 @@
+import argparse
+import gc
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from compact_entity_table import CompactEntityTable
+from wikidata_entity_linker import WikidataNamedEntity
+
+
+def synthetic_rows(entries, negative_ratio=0.3, distinct_descriptions=50000, seed=0):
+    """
+    Generates cache rows resembling a linked embedding vocabulary: a share of negative entries and descriptions
+    which repeat a lot ("Wikimedia disambiguation page", "family name", ...).
+    """
+    generator = random.Random(seed)
+    for i in range(entries):
+        entity = f"entity_{i}"
+        if generator.random() < negative_ratio:
+            yield entity, "", ""
+        else:
+            description_id = int(generator.paretovariate(1.2)) % distinct_descriptions
+            yield entity, f"Q{generator.randrange(1, 100000000)}", f"description {description_id}"
+
+
+class UnslottedNamedEntity:
+    """
+    WikidataNamedEntity as it was before CompactEntityTable: every instance has its own __dict__.
+    """
+
+    def __init__(self, entity, linked_entity, description):
+        self.entity = entity
+        self.linked_entity = linked_entity
+        self.description = description
+
+
+def build_dictionary(rows):
+    # the representation used by PersistentEntityLinker before CompactEntityTable
+    dictionary = dict()
+    for entity, linked_entity, description in rows:
+        dictionary[entity] = UnslottedNamedEntity(entity, linked_entity, description)
+    return dictionary
+
+
+def build_slotted_dictionary(rows):
+    # the dictionary holding today's (slotted) WikidataNamedEntity objects, for reference
+    dictionary = dict()
+    for entity, linked_entity, description in rows:
+        dictionary[entity] = WikidataNamedEntity(entity, linked_entity, description)
+    return dictionary
+
+
+def build_compact_table(rows):
+    table = CompactEntityTable()
+    for entity, linked_entity, description in rows:
+        table.put(entity, linked_entity, description)
+    return table
+
+
+representations = {
+    'dict': build_dictionary,
+    'dict-slotted': build_slotted_dictionary,
+    'compact': build_compact_table,
+}
+
+
+def max_rss_in_bytes():
+    # ru_maxrss is reported in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(representation, entries, lookups):
+    """
+    Builds one representation in the current process and prints "<rss delta> <build seconds> <lookups per second>".
+    """
+    gc.collect()
+    rss_before = max_rss_in_bytes()
+
+    # rows are generated while building, just like they are parsed from the cache file, so every representation
+    # only retains the strings it actually keeps
+    start = time.perf_counter()
+    structure = representations[representation](synthetic_rows(entries))
+    build_seconds = time.perf_counter() - start
+    gc.collect()
+    rss_after = max_rss_in_bytes()
+
+    keys = [f"entity_{random.randrange(entries)}" for _ in range(lookups)]
+    start = time.perf_counter()
+    for key in keys:
+        structure.get(key)
+    lookups_per_second = lookups / (time.perf_counter() - start)
+
+    print(rss_after - rss_before, build_seconds, lookups_per_second)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the memory footprint of the in-memory linking cache '
+                                                 'representations. Every representation is measured in its own '
+                                                 'process.')
+    parser.add_argument('-e', '--entries', help="number of cache entries (default=10000000)", default=10000000,
+                        type=int)
+    parser.add_argument('-l', '--lookups', help="number of random lookups (default=1000000)", default=1000000,
+                        type=int)
+    parser.add_argument('--measure', help=argparse.SUPPRESS, choices=list(representations.keys()))
+
+    args_dict = vars(parser.parse_args())
+
+    if args_dict['measure'] is not None:
+        measure(args_dict['measure'], args_dict['entries'], args_dict['lookups'])
+        sys.exit(0)
+
+    print(f"{'representation':<16}{'memory (MiB)':>14}{'bytes/entry':>14}{'build (s)':>12}{'lookups/s':>14}")
+    for representation in representations.keys():
+        output = subprocess.run([sys.executable, __file__, '--entries', str(args_dict['entries']), '--lookups',
+                                 str(args_dict['lookups']), '--measure', representation],
+                                check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        rss_delta, build_seconds, lookups_per_second = output.split()
+        rss_delta = int(rss_delta)
+        print(f"{representation:<16}{rss_delta / 2 ** 20:>14.1f}{rss_delta / args_dict['entries']:>14.1f}"
+              f"{float(build_seconds):>12.1f}{float(lookups_per_second):>14.0f}")
@@ -0,0 +1,273 @@
+import argparse
+import csv
+import json
+import os
+import random
+import requests
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rate_limiter import AdaptiveRateLimiter
+from wikidata_entity_linker import PersistentEntityLinker, WikidataEntityLinker, WikidataEntityLinkerProxy
+
+benchmarks_directory = os.path.dirname(os.path.abspath(__file__))
+linker_script = os.path.join(benchmarks_directory, "..", "wikidata_entity_linker.py")
+server_script = os.path.join(benchmarks_directory, "mock_wikidata_server.py")
+
+
+def write_vocabulary(filename, entries, lowercase_ratio=0.1, duplicate_ratio=0.05, seed=0):
+    """
+    Writes a synthetic embedding vocabulary (fasttext .vec layout: a header row followed by "word vector...").
+    Some words are lowercase (they need normalization) and some words repeat earlier ones.
+    """
+    generator = random.Random(seed)
+    with open(filename, "w") as file:
+        file.write(f"{entries} 2\n")
+        for i in range(entries):
+            if i > 0 and generator.random() < duplicate_ratio:
+                # frequent words repeat most, like in real vocabularies
+                word_id = int(generator.paretovariate(1.0)) % i
+            else:
+                word_id = i
+
+            word = f"Term{word_id}"
+            if generator.random() < lowercase_ratio:
+                word = word.lower()
+            file.write(f"{word} 0.1 0.2\n")
+
+
+def read_vocabulary(filename):
+    with open(filename, "r") as file:
+        reader = csv.reader(file, delimiter=' ', quoting=csv.QUOTE_NONE)
+        next(reader)
+        return [row[0] for row in reader]
+
+
+def max_rss_in_bytes(who=resource.RUSAGE_SELF):
+    # ru_maxrss is reported in kilobytes on linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def histogram_percentile(histogram, share):
+    """
+    Estimates a percentile from the buckets of a histogram exported by metrics.py, interpolating linearly inside the
+    bucket (like Prometheus' histogram_quantile).
+    """
+    if histogram['count'] == 0:
+        return 0.0
+
+    rank = share * histogram['count']
+    lower_bound = 0.0
+    lower_count = 0
+    for upper_bound, count in histogram['buckets'].items():
+        if upper_bound == '+Inf':
+            return lower_bound
+        upper_bound = float(upper_bound)
+        if count >= rank:
+            return lower_bound + (upper_bound - lower_bound) * (rank - lower_count) / max(1, count - lower_count)
+        lower_bound, lower_count = upper_bound, count
+    return lower_bound
+
+
+def measure_library(vocabulary_filename, api_url, threads, entities_per_request, request_rate, work_directory):
+    """
+    Links the vocabulary using WikidataEntityLinkerProxy from several threads.
+
+    :return: Dictionary containing the seconds, the batch latencies and the peak rss.
+    """
+    entities = read_vocabulary(vocabulary_filename)
+    persistent_entity_linker = PersistentEntityLinker(os.path.join(work_directory, "library_cache.csv"))
+    rate_limiter = AdaptiveRateLimiter(rate=request_rate, max_rate=request_rate)
+
+    batches = iter([entities[i:i + entities_per_request] for i in range(0, len(entities), entities_per_request)])
+    batches_lock = threading.Lock()
+    latencies = []
+
+    def link():
+        proxy = WikidataEntityLinkerProxy(
+            persistent_entity_linker=persistent_entity_linker,
+            wikidata_entity_linker=WikidataEntityLinker(session=requests.Session(),
+                                                        entities_per_request=entities_per_request,
+                                                        rate_limiter=rate_limiter, api_url=api_url))
+        while True:
+            with batches_lock:
+                batch = next(batches, None)
+            if batch is None:
+                return
+
+            start = time.perf_counter()
+            proxy.entity_ids(batch, set())
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=link) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - start
+    persistent_entity_linker.close()
+
+    return {'entities': len(entities), 'seconds': seconds, 'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99), 'max_rss': max_rss_in_bytes()}
+
+
+def measure_cli(vocabulary_filename, api_url, threads, entities_per_request, request_rate, work_directory):
+    """
+    Links the vocabulary by running wikidata_entity_linker.py.
+
+    :return: Dictionary containing the seconds, the batch latencies (from the exported metrics) and the peak rss.
+    """
+    metrics_filename = os.path.join(work_directory, "cli_metrics.jsonl")
+    arguments = [sys.executable, linker_script, vocabulary_filename, '-d', ' ', '-t', str(threads),
+                 '--entities-per-request', str(entities_per_request), '--request-rate', str(request_rate),
+                 '--api-url', api_url, '-c', os.path.join(work_directory, "cli_cache.csv"),
+                 '-o', os.path.join(work_directory, "cli_linking.csv"),
+                 '-n', os.path.join(work_directory, "cli_not_found.txt"),
+                 '--metrics', metrics_filename, '--metrics-interval', '3600']
+
+    start = time.perf_counter()
+    subprocess.run(arguments, check=True, stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+
+    with open(metrics_filename, "r") as metrics_file:
+        metrics = json.loads(metrics_file.readlines()[-1])
+    network = metrics.get('pipeline_stage_seconds', {}).get('network', {'count': 0})
+
+    return {'entities': metrics.get('pipeline_rows_read_total', 0), 'seconds': seconds,
+            'p50': histogram_percentile(network, 0.5), 'p99': histogram_percentile(network, 0.99),
+            'max_rss': max_rss_in_bytes(resource.RUSAGE_CHILDREN)}
+
+
+modes = {
+    'library': measure_library,
+    'cli': measure_cli,
+}
+
+
+def free_port():
+    with socket.socket() as server_socket:
+        server_socket.bind(('127.0.0.1', 0))
+        return server_socket.getsockname()[1]
+
+
+def server_request(base_url, path):
+    with urlopen(base_url + path) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def start_server(port, server_arguments):
+    server = subprocess.Popen([sys.executable, server_script, '--port', str(port)] + server_arguments,
+                              stdout=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            server_request(base_url, '/stats')
+            return server, base_url
+        except OSError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise Exception("The mock server did not start.")
+
+
+def comma_separated(value_type):
+    return lambda value: [value_type(part) for part in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the linker end to end against a local mock of the '
+                                                 'wbgetentities api. Every measurement runs in its own process with '
+                                                 'an empty cache.')
+    parser.add_argument('-s', '--sizes', help="comma separated vocabulary sizes, up to 10000000 "
+                                              "(default=10000,100000,1000000)", default=[10000, 100000, 1000000],
+                        type=comma_separated(int))
+    parser.add_argument('-m', '--modes', help="comma separated modes: 'library' drives WikidataEntityLinkerProxy "
+                                              "from threads, 'cli' runs wikidata_entity_linker.py "
+                                              "(default=library,cli)", default=['library', 'cli'],
+                        type=comma_separated(str))
+    parser.add_argument('-t', '--threads', help="comma separated thread counts (default=20)", default=[20],
+                        type=comma_separated(int))
+    parser.add_argument('-e', '--entities-per-request', help="comma separated batch sizes (default=50)", default=[50],
+                        type=comma_separated(int))
+    parser.add_argument('--request-rate', help="requests per second allowed by the rate limiter (default=100000, "
+                                               "i.e. not limited)", default=100000.0, type=float)
+    parser.add_argument('--latency', help="mean latency of the mock server in milliseconds (default=20)",
+                        default=20.0, type=float)
+    parser.add_argument('--jitter', help="standard deviation of the latency in milliseconds (default=5)",
+                        default=5.0, type=float)
+    parser.add_argument('--error-rate', help="share of requests the mock server answers with 500 (default=0)",
+                        default=0.0, type=float)
+    parser.add_argument('--throttle-rate', help="share of requests the mock server answers with 429 (default=0)",
+                        default=0.0, type=float)
+    parser.add_argument('--work-directory', help="directory for vocabularies and caches (default: a temporary "
+                                                 "directory, which is removed afterwards)", default=None)
+    parser.add_argument('--measure', help=argparse.SUPPRESS, nargs=6)
+
+    args_dict = vars(parser.parse_args())
+
+    if args_dict['measure'] is not None:
+        mode, vocabulary, api_url, threads, entities_per_request, work_directory = args_dict['measure']
+        print(json.dumps(modes[mode](vocabulary, api_url, int(threads), int(entities_per_request),
+                                     args_dict['request_rate'], work_directory)))
+        sys.exit(0)
+
+    for mode in args_dict['modes']:
+        if mode not in modes:
+            parser.error(f"unknown mode {mode}")
+
+    work_directory = args_dict['work_directory'] or tempfile.mkdtemp(prefix="linking_benchmark_")
+    os.makedirs(work_directory, exist_ok=True)
+    server, base_url = start_server(free_port(), [
+        '--latency', str(args_dict['latency']), '--jitter', str(args_dict['jitter']),
+        '--error-rate', str(args_dict['error_rate']), '--throttle-rate', str(args_dict['throttle_rate']),
+        '--retry-after', '0'])
+
+    try:
+        print(f"{'mode':<10}{'entities':>10}{'threads':>9}{'batch':>7}{'entities/s':>12}{'requests/entity':>17}"
+              f"{'p50 (ms)':>10}{'p99 (ms)':>10}{'peak rss (MiB)':>16}")
+        for size in args_dict['sizes']:
+            vocabulary = os.path.join(work_directory, f"vocabulary_{size}.vec")
+            if not os.path.exists(vocabulary):
+                write_vocabulary(vocabulary, size)
+
+            for mode in args_dict['modes']:
+                for threads in args_dict['threads']:
+                    for entities_per_request in args_dict['entities_per_request']:
+                        run_directory = tempfile.mkdtemp(dir=work_directory)
+                        server_request(base_url, '/reset')
+                        output = subprocess.run(
+                            [sys.executable, __file__, '--request-rate', str(args_dict['request_rate']), '--measure',
+                             mode, vocabulary, base_url + '/w/api.php', str(threads), str(entities_per_request),
+                             run_directory], check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+                        result = json.loads(output.splitlines()[-1])
+                        statistics = server_request(base_url, '/stats')
+                        shutil.rmtree(run_directory)
+
+                        print(f"{mode:<10}{size:>10}{threads:>9}{entities_per_request:>7}"
+                              f"{result['entities'] / result['seconds']:>12.0f}"
+                              f"{statistics['requests'] / max(1, result['entities']):>17.3f}"
+                              f"{result['p50'] * 1000:>10.1f}{result['p99'] * 1000:>10.1f}"
+                              f"{result['max_rss'] / 2 ** 20:>16.1f}")
+    finally:
+        server.terminate()
+        server.wait()
+        if args_dict['work_directory'] is None:
+            shutil.rmtree(work_directory)
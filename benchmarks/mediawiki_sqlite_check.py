@@ -0,0 +1,170 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dump_entity_linker import DumpEntityLinker, DumpIndexBuilder
+from mediawiki_entity_linker import ConnectionPool, MediaWikiDatabaseEntityLinker
+
+# the columns of mediawiki's page, page_props and redirect tables which are read by the linkers
+schema = {
+    'page': "page_id INTEGER PRIMARY KEY, page_namespace INTEGER NOT NULL, page_title TEXT NOT NULL, "
+            "page_is_redirect INTEGER NOT NULL DEFAULT 0",
+    'page_props': "pp_page INTEGER NOT NULL, pp_propname TEXT NOT NULL, pp_value TEXT, pp_sortkey REAL, "
+                  "PRIMARY KEY (pp_page, pp_propname)",
+    'redirect': "rd_from INTEGER PRIMARY KEY, rd_namespace INTEGER NOT NULL, rd_title TEXT NOT NULL, "
+                "rd_interwiki TEXT, rd_fragment TEXT",
+}
+
+pages = [
+    # page_id, page_namespace, page_title, page_is_redirect
+    (1, 0, 'Berlin', 0),
+    (2, 0, 'Mercury', 0),
+    (3, 0, 'Berlin_(disambiguation)', 0),
+    (4, 0, 'Berlin,_Germany', 1),
+    (5, 0, 'Quicksilver', 1),
+    (6, 0, 'Paris', 0),
+    (7, 0, 'Paris_(redirect)', 1),
+    (8, 0, 'Mercury_(planet)', 0),
+    (9, 0, 'Hg', 1),
+    (10, 0, 'Mars', 0),
+    # an interwiki redirect, its target is a page of another wiki which happens to have the title of a local page
+    (11, 0, 'Mars_(word)', 1),
+    (12, 4, 'Berlin', 0),
+    (13, 0, "O'Brien_&_Sons", 0),
+    (14, 0, 'Mercury_Records', 1),
+]
+
+page_props = [
+    # pp_page, pp_propname, pp_value
+    (1, 'wikibase_item', 'Q64'),
+    (1, 'wikibase-shortdesc', 'Capital of Germany'),
+    (2, 'wikibase_item', 'Q925'),
+    (2, 'disambiguation', ''),
+    (3, 'wikibase_item', 'Q1150'),
+    (3, 'disambiguation', ''),
+    (6, 'wikibase_item', 'Q90'),
+    (8, 'wikibase_item', 'Q308'),
+    (8, 'wikibase-shortdesc', 'Planet of the solar system'),
+    (10, 'wikibase_item', 'Q111'),
+    (12, 'wikibase_item', 'Q999999'),
+    (13, 'wikibase_item', 'Q4711'),
+]
+
+redirects = [
+    # rd_from, rd_namespace, rd_title, rd_interwiki, rd_fragment
+    (4, 0, 'Berlin', '', ''),
+    (5, 0, 'Mercury', '', ''),
+    # older databases store NULL instead of '' for local redirects
+    (7, 0, 'Paris', None, None),
+    (9, 0, 'Mercury_(planet)', '', 'Chemistry'),
+    (11, 0, 'Mars', 'wikt', ''),
+    (14, 0, 'Mercury_Records', '', ''),
+]
+
+# entity -> expected wikidata id (None: not linked)
+expected_linkings = {
+    'Berlin': 'Q64',
+    'berlin': 'Q64',
+    'Berlin, Germany': 'Q64',
+    'Berlin (disambiguation)': None,
+    'Mercury': None,
+    'Quicksilver': None,
+    'Paris (redirect)': 'Q90',
+    'Hg': 'Q308',
+    'hg': 'Q308',
+    'Mars': 'Q111',
+    'Mars (word)': None,
+    "O'Brien & Sons": 'Q4711',
+    'Mercury Records': None,
+    'Atlantis': None,
+}
+
+
+def create_database(filename):
+    """
+    Creates a SQLite stand-in of a mediawiki database containing the page, page_props and redirect tables.
+    """
+    connection = sqlite3.connect(filename)
+    with connection:
+        for table, columns in schema.items():
+            connection.execute(f"DROP TABLE IF EXISTS {table}")
+            connection.execute(f"CREATE TABLE {table} ({columns})")
+        connection.executemany("INSERT INTO page VALUES (?, ?, ?, ?)", pages)
+        connection.executemany("INSERT INTO page_props (pp_page, pp_propname, pp_value) VALUES (?, ?, ?)",
+                               page_props)
+        connection.executemany("INSERT INTO redirect VALUES (?, ?, ?, ?, ?)", redirects)
+    connection.close()
+
+
+def _sql_value(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, int):
+        return str(value)
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def write_sql_dump(filename, table, rows):
+    """
+    Writes rows in the layout of a mediawiki sql dump (see dump_entity_linker.parse_sql_insert).
+    """
+    with open(filename, "w", encoding='utf-8') as file:
+        file.write(f"INSERT INTO `{table}` VALUES "
+                   + ",".join("(" + ",".join(_sql_value(value) for value in row) + ")" for row in rows) + ";\n")
+
+
+def linked_ids(linker):
+    linked_entities = linker.entity_ids(list(expected_linkings))
+    return {entity: linked_entities[entity].linked_entity if entity in linked_entities else None
+            for entity in expected_linkings}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks the mediawiki-db source without mysql: links a fixed set of '
+                                                 'entities against a SQLite copy of the page, page_props and redirect '
+                                                 'tables and against a dump index built from the same rows, and '
+                                                 'compares both with the expected linkings. Exits with 1 if a '
+                                                 'linking differs.')
+    parser.add_argument('--work-directory', help="directory for the database, the sql dumps and the dump index, "
+                                                 "e.g. to query the database afterwards (default: a temporary "
+                                                 "directory, which is removed afterwards)", default=None)
+
+    args_dict = vars(parser.parse_args())
+
+    work_directory = args_dict['work_directory'] or tempfile.mkdtemp(prefix="mediawiki_sqlite_check_")
+    os.makedirs(work_directory, exist_ok=True)
+    try:
+        database = os.path.join(work_directory, "mediawiki.sqlite")
+        create_database(database)
+        connection_pool = ConnectionPool(lambda: sqlite3.connect(database, check_same_thread=False), size=2)
+        database_linkings = linked_ids(MediaWikiDatabaseEntityLinker(connection_pool, placeholder='?'))
+        connection_pool.close()
+
+        dump_filenames = []
+        for table, rows in (('page', pages), ('page_props', page_props), ('redirect', redirects)):
+            dump_filenames.append(os.path.join(work_directory, f"{table}.sql"))
+            write_sql_dump(dump_filenames[-1], table, rows)
+        index = os.path.join(work_directory, "index.sqlite")
+        if os.path.exists(index):
+            os.remove(index)
+        builder = DumpIndexBuilder(index, processes=1)
+        builder.add_wikipedia_sql_dumps(*dump_filenames)
+        builder.close()
+        dump_linkings = linked_ids(DumpEntityLinker(index))
+    finally:
+        if args_dict['work_directory'] is None:
+            shutil.rmtree(work_directory)
+
+    differing_entities = 0
+    for entity, expected in expected_linkings.items():
+        equal = database_linkings[entity] == expected and dump_linkings[entity] == expected
+        differing_entities += 0 if equal else 1
+        print(f"{entity!r}: expected {expected}, mediawiki-db {database_linkings[entity]}, dump "
+              f"{dump_linkings[entity]}{'' if equal else ' DIFFERENT'}")
+
+    sys.exit(1 if differing_entities else 0)
@@ -0,0 +1,320 @@
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class MockWikidata:
+    """
+    Deterministic stand-in for the titles lookup of 'wbgetentities' on enwiki. Whether a title exists, is a
+    disambiguation page or redirects to another page is derived from a hash of the title, so every run (and every
+    process) sees the same knowledge base without storing it.
+
+    Titles starting with a lowercase letter do not exist, like on wikipedia, but are found when the request asks for
+    normalization (which uppercases the first letter).
+
+    Items can also be requested by id once they have been returned for a title. Every call of edit() starts a new
+    generation in which a share of edit_ratio of all items gets a new revision.
+
+    Other sites use the titles of enwiki, but only a share of sitelink_ratio of all items has a page on them.
+    Descriptions exist in every language.
+    """
+
+    redirect_target_suffix = " (redirect target)"
+
+    def __init__(self, missing_ratio=0.2, disambiguation_ratio=0.05, redirect_ratio=0.05, edit_ratio=0.01,
+                 sitelink_ratio=0.7):
+        self.missing_ratio = missing_ratio
+        self.disambiguation_ratio = disambiguation_ratio
+        self.redirect_ratio = redirect_ratio
+        self.edit_ratio = edit_ratio
+        self.sitelink_ratio = sitelink_ratio
+        self.generation = 0
+        # Dictionary<id, title> of all items returned so far
+        self._titles = dict()
+
+    @staticmethod
+    def _hash(title):
+        return zlib.crc32(title.encode('utf-8'))
+
+    def _kind(self, title):
+        if not title or not title[0].isupper() and title[0].isalpha():
+            return 'missing'
+        if title.endswith(self.redirect_target_suffix):
+            return 'article'
+
+        share = (self._hash(title) % 10000) / 10000
+        for kind, ratio in (('missing', self.missing_ratio), ('disambiguation', self.disambiguation_ratio),
+                            ('redirect', self.redirect_ratio)):
+            if share < ratio:
+                return kind
+            share -= ratio
+        return 'article'
+
+    def edit(self):
+        self.generation += 1
+
+    def _lastrevid(self, qid):
+        edits = sum(1 for generation in range(1, self.generation + 1)
+                    if (self._hash(f"{qid}@{generation}") % 10000) / 10000 < self.edit_ratio)
+        return self._hash(qid) % 2000000000 + edits
+
+    def _qid(self, title):
+        return f"Q{self._hash(title) % 100000000 + 1}"
+
+    def _has_sitelink(self, qid, site):
+        return site == 'enwiki' or (self._hash(f"{qid}@{site}") % 10000) / 10000 < self.sitelink_ratio
+
+    def _entity(self, title, description, sitefilter=('enwiki',), languages=('en',)):
+        qid = self._qid(title)
+        self._titles[qid] = title
+        return qid, {
+            'type': 'item',
+            'id': qid,
+            'lastrevid': self._lastrevid(qid),
+            'modified': '2020-01-01T00:00:00Z',
+            'descriptions': {language: {'language': language,
+                                        'value': description if language == 'en' else f"{description} ({language})"}
+                             for language in languages},
+            'sitelinks': {site: {'site': site, 'title': title, 'badges': []}
+                          for site in sitefilter if self._has_sitelink(qid, site)},
+        }
+
+    def get_entities(self, titles, normalize, site='enwiki', sitefilter=('enwiki',), languages=('en',)):
+        """
+        :return: The json answer of wbgetentities for titles of site.
+        """
+        entities = dict()
+        normalized = None
+        missing_key = -1
+        for title in titles:
+            if normalize and title[:1].islower():
+                normalized_title = title[0].upper() + title[1:]
+                normalized = {'n': {'from': title, 'to': normalized_title}}
+                title = normalized_title
+
+            kind = self._kind(title)
+            page = title + self.redirect_target_suffix if kind == 'redirect' else title
+            if kind == 'missing' or not self._has_sitelink(self._qid(page), site):
+                entities[str(missing_key)] = {'site': site, 'title': title, 'missing': ''}
+                missing_key -= 1
+            elif kind == 'disambiguation':
+                qid, entity = self._entity(title, "Wikimedia disambiguation page", sitefilter, languages)
+                entities[qid] = entity
+            elif kind == 'redirect':
+                qid, entity = self._entity(page, f"target of {title}", sitefilter, languages)
+                entities[qid] = entity
+            else:
+                qid, entity = self._entity(title, f"description of {title}", sitefilter, languages)
+                entities[qid] = entity
+
+        result = {'entities': entities, 'success': 1}
+        if normalized is not None:
+            result['normalized'] = normalized
+        return result
+
+    def get_entities_by_ids(self, ids, sitefilter=('enwiki',), languages=('en',)):
+        """
+        :return: The json answer of wbgetentities for ids.
+        """
+        entities = dict()
+        for qid in ids:
+            title = self._titles.get(qid, None)
+            if title is None:
+                entities[qid] = {'id': qid, 'missing': ''}
+                continue
+
+            kind = self._kind(title)
+            description = "Wikimedia disambiguation page" if kind == 'disambiguation' else f"description of {title}"
+            entities[qid] = self._entity(title, description, sitefilter, languages)[1]
+        return {'entities': entities, 'success': 1}
+
+
+class MockWikidataServer(ThreadingHTTPServer):
+    """
+    Serves MockWikidata at /w/api.php (GET and POST). Latency (per request and per requested title), server errors,
+    throttling (429 with Retry-After), maxlag errors and a limit of the url length (414) can be injected. /stats returns the number of requests and requested titles, /reset resets them and
+    /edit starts a new generation of edits (see MockWikidata).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, mock_wikidata, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 maxlag_rate=0.0, retry_after=1, seed=0, latency_per_title=0.0, max_url_length=None):
+        """
+
+        :param latency: Mean latency of a request in seconds.
+        :param jitter: Standard deviation of the latency in seconds.
+        :param latency_per_title: Seconds added to the latency for every requested title or id.
+        :param max_url_length: Longer GET requests are answered with 414. None accepts urls of any length.
+        """
+        ThreadingHTTPServer.__init__(self, address, _RequestHandler)
+        self.mock_wikidata = mock_wikidata
+        self.latency = latency
+        self.latency_per_title = latency_per_title
+        self.max_url_length = max_url_length
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.maxlag_rate = maxlag_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._statistics = dict()
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        with self._lock:
+            self._statistics = {'requests': 0, 'post_requests': 0, 'titles': 0, 'errors': 0, 'throttled': 0,
+                                'maxlag': 0, 'too_long': 0}
+
+    def statistics(self):
+        with self._lock:
+            return dict(self._statistics)
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self._statistics[key] += amount
+
+    def draw(self, titles=1):
+        """
+        :param titles: Number of requested titles or ids.
+        :return: A tuple<latency, outcome> with outcome being one of 'error', 'throttled', 'maxlag' and 'ok'.
+        """
+        with self._lock:
+            latency = max(0.0, self._random.gauss(self.latency, self.jitter)) if self.latency or self.jitter else 0.0
+            latency += titles * self.latency_per_title
+            share = self._random.random()
+
+        for outcome, rate in (('error', self.error_rate), ('throttled', self.throttle_rate),
+                              ('maxlag', self.maxlag_rate)):
+            if share < rate:
+                return latency, outcome
+            share -= rate
+        return latency, 'ok'
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, value, headers=()):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, header_value in headers:
+            self.send_header(name, header_value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, path, parameters, method='GET'):
+        server = self.server
+        if path == '/stats':
+            return self._send_json(200, server.statistics())
+        if path == '/reset':
+            server.reset_statistics()
+            return self._send_json(200, server.statistics())
+        if path == '/edit':
+            server.mock_wikidata.edit()
+            return self._send_json(200, {'generation': server.mock_wikidata.generation})
+        if path != '/w/api.php' or parameters.get('action', [None])[0] != 'wbgetentities':
+            return self._send_json(404, {'error': {'code': 'notfound'}})
+
+        by_ids = 'ids' in parameters
+        titles = parameters.get('ids' if by_ids else 'titles', [''])[0]
+        # mediawiki's alternative multi value separator (used for titles containing '|')
+        titles = titles[1:].split('\x1f') if titles.startswith('\x1f') else titles.split('|')
+        server.count('requests')
+        server.count('titles', len(titles))
+        if method == 'POST':
+            server.count('post_requests')
+        elif server.max_url_length is not None and len(self.path) > server.max_url_length:
+            server.count('too_long')
+            return self._send_json(414, {'error': {'code': 'uri_too_long'}})
+
+        latency, outcome = server.draw(len(titles))
+        if latency > 0:
+            time.sleep(latency)
+
+        if outcome == 'error':
+            server.count('errors')
+            return self._send_json(500, {'error': {'code': 'internal_api_error'}})
+        if outcome == 'throttled':
+            server.count('throttled')
+            return self._send_json(429, {'error': {'code': 'ratelimited'}},
+                                   headers=[('Retry-After', str(server.retry_after))])
+        if outcome == 'maxlag':
+            server.count('maxlag')
+            return self._send_json(200, {'error': {'code': 'maxlag', 'lag': 6}},
+                                   headers=[('Retry-After', str(server.retry_after))])
+
+        sitefilter = tuple(parameters.get('sitefilter', ['enwiki'])[0].split('|'))
+        languages = tuple(parameters.get('languages', ['en'])[0].split('|'))
+        if by_ids:
+            return self._send_json(200, server.mock_wikidata.get_entities_by_ids(titles, sitefilter, languages))
+        normalize = parameters.get('normalize', ['0'])[0] not in ('0', '')
+        site = parameters.get('sites', ['enwiki'])[0]
+        self._send_json(200, server.mock_wikidata.get_entities(titles, normalize, site, sitefilter, languages))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self._handle(url.path, parse_qs(url.query, keep_blank_values=True))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        self._handle(urlparse(self.path).path, parse_qs(body, keep_blank_values=True), 'POST')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for wikidata's wbgetentities api. Point the linker "
+                                                 "to it using --api-url http://host:port/w/api.php")
+    parser.add_argument('-p', '--port', help="port to listen on (default=8765)", default=8765, type=int)
+    parser.add_argument('--host', help="address to listen on (default='127.0.0.1')", default='127.0.0.1')
+    parser.add_argument('--latency', help="mean latency per request in milliseconds (default=0)", default=0.0,
+                        type=float)
+    parser.add_argument('--latency-per-title', help="latency added per requested title or id in milliseconds "
+                                                    "(default=0)", default=0.0, type=float)
+    parser.add_argument('--max-url-length', help="answer GET requests with longer urls with 414 (default: no "
+                                                 "limit)", default=None, type=int)
+    parser.add_argument('--jitter', help="standard deviation of the latency in milliseconds (default=0)",
+                        default=0.0, type=float)
+    parser.add_argument('--error-rate', help="share of requests answered with 500 (default=0)", default=0.0,
+                        type=float)
+    parser.add_argument('--throttle-rate', help="share of requests answered with 429 (default=0)", default=0.0,
+                        type=float)
+    parser.add_argument('--maxlag-rate', help="share of requests answered with a maxlag error (default=0)",
+                        default=0.0, type=float)
+    parser.add_argument('--retry-after', help="Retry-After of throttled requests in seconds (default=1)", default=1,
+                        type=int)
+    parser.add_argument('--missing-ratio', help="share of titles which do not exist (default=0.2)", default=0.2,
+                        type=float)
+    parser.add_argument('--disambiguation-ratio', help="share of titles which are disambiguation pages "
+                                                       "(default=0.05)", default=0.05, type=float)
+    parser.add_argument('--redirect-ratio', help="share of titles which redirect to another page (default=0.05)",
+                        default=0.05, type=float)
+    parser.add_argument('--sitelink-ratio', help="share of items which have a page on sites other than enwiki "
+                                                 "(default=0.7)", default=0.7, type=float)
+    parser.add_argument('--edit-ratio', help="share of items edited per call of /edit (default=0.01)", default=0.01,
+                        type=float)
+
+    args_dict = vars(parser.parse_args())
+
+    server = MockWikidataServer((args_dict['host'], args_dict['port']),
+                                MockWikidata(args_dict['missing_ratio'], args_dict['disambiguation_ratio'],
+                                             args_dict['redirect_ratio'], args_dict['edit_ratio'],
+                                             args_dict['sitelink_ratio']),
+                                latency=args_dict['latency'] / 1000, jitter=args_dict['jitter'] / 1000,
+                                error_rate=args_dict['error_rate'], throttle_rate=args_dict['throttle_rate'],
+                                maxlag_rate=args_dict['maxlag_rate'], retry_after=args_dict['retry_after'],
+                                latency_per_title=args_dict['latency_per_title'] / 1000,
+                                max_url_length=args_dict['max_url_length'])
+    print(f"Serving wbgetentities at http://{args_dict['host']}:{server.server_address[1]}/w/api.php")
+    server.serve_forever()
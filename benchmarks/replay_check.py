@@ -0,0 +1,87 @@
+import argparse
+import filecmp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from linking_benchmark import free_port, linker_script, server_request, start_server, write_vocabulary
+
+# settings of the replayed runs, each batches the vocabulary differently than the recorded run. Deduplication is not
+# varied: rows collapsed into a row share its failure, so it changes which rows fail
+replay_settings = {
+    'recorded settings': [],
+    'small batches': ['--entities-per-request', '17', '-t', '3'],
+    'single thread': ['--entities-per-request', '30', '-t', '1'],
+    'many threads': ['--entities-per-request', '23', '-t', '60'],
+    'async': ['-e', 'async', '--max-in-flight', '7'],
+}
+
+
+def link(vocabulary_filename, run_directory, arguments):
+    """
+    Links the vocabulary with an empty cache by running wikidata_entity_linker.py.
+
+    :return: Tuple<filename of the linking, filename of the not found entities>.
+    """
+    output_filenames = (os.path.join(run_directory, "linking.csv"), os.path.join(run_directory, "not_found.txt"))
+    subprocess.run([sys.executable, linker_script, vocabulary_filename, '-d', ' ', '--ordered',
+                    '-c', os.path.join(run_directory, "cache.csv"), '-o', output_filenames[0],
+                    '-n', output_filenames[1]] + arguments, check=True, stdout=subprocess.DEVNULL)
+    return output_filenames
+
+
+def count_lines(filename):
+    with open(filename, "r") as file:
+        return sum(1 for _ in file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks that replaying a cassette reproduces the output of the '
+                                                 'recorded run: links a vocabulary against a failing mock of the '
+                                                 'wbgetentities api with --record, replays it with several batchings '
+                                                 'and compares the outputs. Exits with 1 if an output differs.')
+    parser.add_argument('-s', '--size', help="vocabulary size (default=3000)", default=3000, type=int)
+    parser.add_argument('--error-rate', help="share of requests the mock server answers with 500, high enough that "
+                                             "some batches fail for good (default=0.5)", default=0.5, type=float)
+    parser.add_argument('--work-directory', help="directory for the vocabulary, the cassette and the outputs "
+                                                 "(default: a temporary directory, which is removed afterwards)",
+                        default=None)
+
+    args_dict = vars(parser.parse_args())
+
+    work_directory = args_dict['work_directory'] or tempfile.mkdtemp(prefix="replay_check_")
+    os.makedirs(work_directory, exist_ok=True)
+    server, base_url = start_server(free_port(), ['--latency', '5', '--jitter', '1',
+                                                  '--error-rate', str(args_dict['error_rate'])])
+
+    differing_runs = 0
+    try:
+        vocabulary = os.path.join(work_directory, f"vocabulary_{args_dict['size']}.vec")
+        write_vocabulary(vocabulary, args_dict['size'])
+        cassette = os.path.join(work_directory, "cassette.sqlite")
+        if os.path.exists(cassette):
+            os.remove(cassette)
+
+        recorded_directory = tempfile.mkdtemp(dir=work_directory)
+        recorded_outputs = link(vocabulary, recorded_directory, ['--api-url', base_url + '/w/api.php',
+                                                                 '--record', cassette])
+        statistics = server_request(base_url, '/stats')
+        print(f"recorded: {count_lines(recorded_outputs[0]) - 1} rows linked, "
+              f"{count_lines(recorded_outputs[1])} not found, {statistics['requests']} requests "
+              f"({statistics['errors']} answered with 500)")
+
+        for name, arguments in replay_settings.items():
+            replayed_outputs = link(vocabulary, tempfile.mkdtemp(dir=work_directory), ['--replay', cassette] + arguments)
+            equal = all(filecmp.cmp(recorded, replayed, shallow=False)
+                        for recorded, replayed in zip(recorded_outputs, replayed_outputs))
+            differing_runs += 0 if equal else 1
+            print(f"replayed ({name}): {'equal' if equal else 'DIFFERENT'}")
+    finally:
+        server.terminate()
+        server.wait()
+        if args_dict['work_directory'] is None:
+            shutil.rmtree(work_directory)
+
+    sys.exit(1 if differing_runs else 0)
@@ -0,0 +1,325 @@
+import argparse
+import requests
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from entity_store import open_entity_store
+from metrics import shared_metrics
+from multi_site_linker import MultiSiteEntityLinker
+from rate_limiter import AdaptiveRateLimiter, shared_rate_limiter
+from wikidata_entity_linker import WikidataEntityLinker
+from wikidata_sites import default_site, site_language, split_cache_key
+
+seconds_per_day = 24 * 60 * 60
+
+
+class RefreshStatistics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rows_scanned = 0
+        self.rows_of_other_sites = 0
+        self.items_checked = 0
+        self.items_changed = 0
+        self.items_removed = 0
+        self.rows_updated = 0
+        self.rows_relinked = 0
+        self.negative_rows_retried = 0
+        self.negative_rows_linked = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def __str__(self):
+        return f"{self.rows_scanned} rows scanned ({self.rows_of_other_sites} of sites not refreshed), " \
+               f"{self.items_checked} linked items checked, " \
+               f"{self.items_changed} changed ({self.items_removed} deleted, merged or no longer linkable), " \
+               f"{self.rows_updated} rows updated, {self.rows_relinked} rows relinked, " \
+               f"{self.negative_rows_retried} negative rows retried ({self.negative_rows_linked} linked now)"
+
+
+class CacheRefresher:
+    """
+    Revalidates the rows of a cache against wikidata without relinking every entity.
+
+    Linked rows are revalidated by the id of their linked item: the lastrevid of up to entities_per_request items is
+    requested at once (props=info), which is much cheaper than linking by title. Only items whose revision differs
+    from the cached one are fetched again, and only rows whose linking actually changed are rewritten. Rows of items
+    which have been deleted or are no longer linkable (no sitelink to the site of the row, disambiguation page) are
+    relinked by their entity, rows of merged items are rewritten to the target of the merge. Rows whose entity is no
+    longer the title of the sitelink (moved pages, titles linked to another item) are relinked as well.
+
+    Negative rows (entities which could not be linked) are linked again once they are older than negative_ttl.
+    """
+
+    def __init__(self, store, wikidata_entity_linker_factory, negative_ttl=30 * seconds_per_day, workers=20,
+                 metrics=None):
+        """
+
+        :param store: EntityStore of the cache.
+        :param wikidata_entity_linker_factory: Callable returning a new MultiSiteEntityLinker. Every worker thread
+            uses its own linker. Only the rows of its sites are refreshed.
+        :param negative_ttl: Seconds after which negative rows are linked again. None never retries negative rows.
+        :param workers: Number of threads sending requests.
+        :param metrics: MetricsRegistry to report to. If None, the registry shared by the whole process is used.
+        """
+        self._store = store
+        self._wikidata_entity_linker_factory = wikidata_entity_linker_factory
+        self.negative_ttl = negative_ttl
+        self.workers = workers
+        self.statistics = RefreshStatistics()
+        self._local = threading.local()
+
+        metrics = metrics if metrics is not None else shared_metrics
+        self._items = metrics.counter('refresh_items_total', "Revalidated linked items by result (unchanged, "
+                                                             "changed, removed)", ('result',))
+        self._rows_written = metrics.counter('refresh_rows_written_total', "Cache rows rewritten by the refresh")
+
+    def _linker(self):
+        linker = getattr(self._local, 'linker', None)
+        if linker is None:
+            linker = self._wikidata_entity_linker_factory()
+            self._local.linker = linker
+        return linker
+
+    def _scan(self, now):
+        """
+        Reads the cache once and keeps only what is needed to revalidate it.
+
+        :return: A tuple<Dictionary<linked item, tuple<lastrevid, list<entity>>>, list<entity>>. The first value
+            contains the cached revision of every linked item (the oldest one if the rows disagree), the second one
+            all negative rows which are due to be retried.
+        """
+        items = dict()
+        due_negative_entities = []
+        rows_scanned = 0
+        rows_of_other_sites = 0
+        sites = set(self._linker().sites)
+        for entity, linked_entity, _, lastrevid, _, checked in self._store.rows():
+            rows_scanned += 1
+            if split_cache_key(entity)[0] not in sites:
+                rows_of_other_sites += 1
+                continue
+
+            if linked_entity == '':
+                if self.negative_ttl is not None and checked + self.negative_ttl <= now:
+                    due_negative_entities.append(entity)
+                continue
+
+            item = items.get(linked_entity, None)
+            if item is None:
+                items[linked_entity] = (lastrevid, [entity])
+            else:
+                item[1].append(entity)
+                if lastrevid < item[0]:
+                    items[linked_entity] = (lastrevid, item[1])
+
+        self.statistics.add(rows_scanned=rows_scanned, rows_of_other_sites=rows_of_other_sites)
+        return items, due_negative_entities
+
+    def _changed_items(self, batch, items):
+        """
+        :param batch: Ids of linked items.
+        :return: The ids of batch whose revision differs from the cached one.
+        """
+        revisions = self._linker().entities_by_ids(batch, 'info')
+        changed_items = []
+        for item_id in batch:
+            revision = revisions.get(item_id, None)
+            if revision is None or 'missing' in revision or revision.get('id', item_id) != item_id \
+                    or revision.get('lastrevid', 0) != items[item_id][0]:
+                changed_items.append(item_id)
+
+        self._items.inc(len(batch) - len(changed_items), ('unchanged',))
+        self.statistics.add(items_checked=len(batch), items_changed=len(changed_items))
+        return changed_items
+
+    @staticmethod
+    def _is_linkable(item, site):
+        if 'missing' in item or site not in item.get('sitelinks', {}):
+            return False
+        return not WikidataEntityLinker.is_disambiguation(item.get('descriptions', {}))
+
+    @staticmethod
+    def _links_title(item, entity):
+        """
+        :return: True if the sitelink of item on the site of the cache key entity is still the title entity is
+            linked by, i.e. its mediawiki_title or one of its normalization_candidates. False if the page has been
+            moved or the title now belongs to another item (and for rows of redirects, which are linked by their
+            title again to follow the redirect).
+        """
+        site, title = split_cache_key(entity)
+        sitelink = item['sitelinks'][site]
+        sitelink_title = sitelink.get('title', None) if isinstance(sitelink, dict) else sitelink
+        if sitelink_title is None:
+            return False
+        sitelink_title = WikidataEntityLinker.mediawiki_title(sitelink_title)
+        return sitelink_title == WikidataEntityLinker.mediawiki_title(title) or \
+            sitelink_title in WikidataEntityLinker.normalization_candidates(title)
+
+    def _write_changed_rows(self, rows, new_rows):
+        """
+        Writes the rows of new_rows which differ from rows (ignoring the time they were checked).
+
+        :param rows: Dictionary<entity, cached row> as returned by EntityStore.get_many.
+        :param new_rows: List of tuple<entity, linked_entity, description, lastrevid, modified, checked>.
+        :return: The number of written rows.
+        """
+        changed_rows = [row for row in new_rows if rows.get(row[0], (None,) * 4)[:4] != row[1:5]]
+        if changed_rows:
+            self._store.put_many(changed_rows)
+            self._rows_written.inc(len(changed_rows))
+        return len(changed_rows)
+
+    def _relink(self, entities, now):
+        """
+        Links entities by their titles again.
+
+        :return: A tuple<list of new rows, number of linked entities>.
+        """
+        new_rows = []
+        linked_count = 0
+        linker = self._linker()
+        for i in range(0, len(entities), linker.entities_per_request):
+            batch = entities[i:i + linker.entities_per_request]
+            linked_entities = linker.entity_ids(batch, set())
+            for entity in batch:
+                linked_entity = linked_entities.get(entity, None)
+                if linked_entity is None:
+                    new_rows.append((entity, '', '', 0, '', now))
+                else:
+                    linked_count += 1
+                    new_rows.append((entity, linked_entity.linked_entity, linked_entity.description,
+                                     linked_entity.lastrevid, linked_entity.modified, now))
+        return new_rows, linked_count
+
+    def _refresh_items(self, batch, items, now):
+        """
+        Fetches the changed items of batch and rewrites the rows linked to them.
+        """
+        fetched_items = self._linker().entities_by_ids(batch, 'info|descriptions|sitelinks')
+        entities = [entity for item_id in batch for entity in items[item_id][1]]
+        rows = self._store.get_many(entities)
+
+        new_rows = []
+        relinked_entities = []
+        removed_items = 0
+        for item_id in batch:
+            item = fetched_items.get(item_id, {'missing': ''})
+            item_removed = False
+            for entity in items[item_id][1]:
+                site = split_cache_key(entity)[0]
+                if not self._is_linkable(item, site):
+                    item_removed = True
+                    relinked_entities.append(entity)
+                    continue
+                if not self._links_title(item, entity):
+                    relinked_entities.append(entity)
+                    continue
+
+                description = self._linker().linker(site).description(item.get('descriptions', {}))
+                new_rows.append((entity, item['id'], description, item.get('lastrevid', 0), item.get('modified', ''),
+                                 now))
+            removed_items += item_removed
+
+        relinked_rows, _ = self._relink(relinked_entities, now)
+        self._items.inc(len(batch) - removed_items, ('changed',))
+        self._items.inc(removed_items, ('removed',))
+        self.statistics.add(items_removed=removed_items,
+                            rows_updated=self._write_changed_rows(rows, new_rows),
+                            rows_relinked=self._write_changed_rows(rows, relinked_rows))
+
+    def _retry_negative(self, batch, now):
+        new_rows, linked_count = self._relink(batch, now)
+        # still negative rows are rewritten as well, their checked time schedules the next retry
+        self._store.put_many(new_rows)
+        self._rows_written.inc(len(new_rows))
+        self.statistics.add(negative_rows_retried=len(batch), negative_rows_linked=linked_count)
+
+    def refresh(self, entities_per_request=50):
+        """
+        Revalidates the whole cache.
+
+        :param entities_per_request: Number of items or entities per request.
+        :return: RefreshStatistics of the refresh.
+        """
+        self.statistics = RefreshStatistics()
+        now = int(time())
+        items, due_negative_entities = self._scan(now)
+
+        # dense batches: every request asks for entities_per_request items
+        item_ids = list(items)
+        batches = [item_ids[i:i + entities_per_request] for i in range(0, len(item_ids), entities_per_request)]
+        with ThreadPoolExecutor(self.workers) as executor:
+            changed_items = [item_id for changed_batch in executor.map(lambda batch: self._changed_items(batch, items),
+                                                                       batches)
+                             for item_id in changed_batch]
+
+            changed_batches = [changed_items[i:i + entities_per_request]
+                               for i in range(0, len(changed_items), entities_per_request)]
+            list(executor.map(lambda batch: self._refresh_items(batch, items, now), changed_batches))
+
+            negative_batches = [due_negative_entities[i:i + entities_per_request]
+                                for i in range(0, len(due_negative_entities), entities_per_request)]
+            list(executor.map(lambda batch: self._retry_negative(batch, now), negative_batches))
+
+        self._store.sync()
+        return self.statistics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refreshes a cache written by wikidata_entity_linker.py. Linked rows '
+                                                 'are only rewritten if their wikidata item changed since they were '
+                                                 'fetched, negative rows are linked again once they are older than '
+                                                 '--negative-ttl.')
+    parser.add_argument('cache', help="cache to refresh (csv or SQLite)")
+    parser.add_argument('--cache-backend', help="storage backend of the cache (default: derived from the file "
+                                                "extension of the cache)", choices=['csv', 'sqlite'], default=None)
+    parser.add_argument('--negative-ttl', help="days after which entities which could not be linked are requested "
+                                               "again. 0 retries all of them, a negative value none "
+                                               "(default=30)", default=30.0, type=float)
+    parser.add_argument('-t', '--threads', help="number of parallel http requests (default=20)", default=20,
+                        type=int)
+    parser.add_argument('--entities-per-request', help="number of items or entities requested at once (default=50, "
+                                                       "the maximum allowed by wikidata)", default=50, type=int)
+    parser.add_argument('--sites', help="sites whose rows are refreshed, the rows of other sites are kept "
+                                        "(default: enwiki)", nargs='+', default=[default_site])
+    parser.add_argument('--languages', help="further languages of the descriptions in order of preference, see "
+                                            "wikidata_entity_linker.py (default: the languages of --sites)",
+                        nargs='+', default=[])
+    parser.add_argument('--api-url', help="api.php used to request wikidata, e.g. a mirror or the mock server in "
+                                          "benchmarks/ (default='{}')".format(WikidataEntityLinker.wikidata_api_url),
+                        default=None)
+    parser.add_argument('--request-rate', help="initial and maximum number of requests per second. The rate is "
+                                               "lowered whenever wikidata throttles us (default: starts at 50 and "
+                                               "grows up to 200)", default=None, type=float)
+    parser.add_argument('--request-timeout', help="seconds after which a request which has not been answered is "
+                                                  "repeated (default=60)", default=60, type=float)
+
+    args_dict = vars(parser.parse_args())
+
+    rate_limiter = shared_rate_limiter
+    if args_dict['request_rate'] is not None:
+        rate_limiter = AdaptiveRateLimiter(rate=args_dict['request_rate'], max_rate=args_dict['request_rate'])
+    negative_ttl = None if args_dict['negative_ttl'] < 0 else args_dict['negative_ttl'] * seconds_per_day
+
+    sites = list(dict.fromkeys(args_dict['sites']))
+
+    def create_wikidata_entity_linker(site):
+        languages = [site_language(site)] + args_dict['languages'] + [site_language(other_site) for other_site in sites]
+        return WikidataEntityLinker(session=requests.Session(), entities_per_request=args_dict['entities_per_request'],
+                                    rate_limiter=rate_limiter, api_url=args_dict['api_url'], site=site,
+                                    languages=list(dict.fromkeys(languages)), related_sites=sites,
+                                    request_timeout=args_dict['request_timeout'])
+
+    entity_store = open_entity_store(args_dict['cache'], args_dict['cache_backend'])
+    try:
+        refresher = CacheRefresher(
+            entity_store, lambda: MultiSiteEntityLinker([create_wikidata_entity_linker(site) for site in sites]),
+            negative_ttl=negative_ttl, workers=args_dict['threads'])
+        print(refresher.refresh(args_dict['entities_per_request']))
+    finally:
+        entity_store.close()
@@ -0,0 +1,161 @@
+import calendar
+import re
+import time
+
+from array import array
+
+
+class CompactEntityTable:
+    """
+    Memory efficient replacement for a Dictionary<entity, tuple<linked_entity, description, lastrevid, modified,
+    checked>>.
+
+    Instead of one object per row, every column is stored in a flat array:
+        - entities are kept in a list and indexed by an open addressing hash table holding row numbers,
+        - QIDs are stored as integers ('Q12345' -> 12345),
+        - descriptions are interned, every row only stores the index of its description,
+        - entities which could not be linked are marked in a bitset,
+        - revision ids and timestamps (modified, checked) are stored as 64 bit integers (timestamps in seconds since
+          the epoch), wikidata's revision ids are about to exceed 32 bits.
+    Rows are converted back to tuples only when they are accessed.
+    """
+
+    _qid_pattern = re.compile(r"Q[1-9][0-9]*")
+    _empty_slot = -1
+
+    def __init__(self):
+        self._entities = []
+        self._slots = array('q', [self._empty_slot]) * 8
+        self._qids = array('I')
+        self._description_ids = array('I')
+        self._lastrevids = array('q')
+        self._modified = array('q')
+        self._checked = array('q')
+        self._descriptions = [None]
+        self._description_index = {None: 0}
+        self._negative = bytearray()
+        # linked entities which are no QIDs (or do not fit into the array) are stored per row
+        self._other_linked_entities = dict()
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __contains__(self, entity):
+        return self._find_row(entity) is not None
+
+    def _find_slot(self, entity):
+        mask = len(self._slots) - 1
+        slot = hash(entity) & mask
+        while True:
+            row = self._slots[slot]
+            if row == self._empty_slot or self._entities[row] == entity:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _find_row(self, entity):
+        row = self._slots[self._find_slot(entity)]
+        return None if row == self._empty_slot else row
+
+    def _grow(self):
+        self._slots = array('q', [self._empty_slot]) * (len(self._slots) * 2)
+        mask = len(self._slots) - 1
+        for row, entity in enumerate(self._entities):
+            slot = hash(entity) & mask
+            while self._slots[slot] != self._empty_slot:
+                slot = (slot + 1) & mask
+            self._slots[slot] = row
+
+    def _intern_description(self, description):
+        description_id = self._description_index.get(description, None)
+        if description_id is None:
+            description_id = len(self._descriptions)
+            self._descriptions.append(description)
+            self._description_index[description] = description_id
+        return description_id
+
+    def _is_negative(self, row):
+        return self._negative[row >> 3] & (1 << (row & 7)) != 0
+
+    def _set_negative(self, row, negative):
+        if negative:
+            self._negative[row >> 3] |= 1 << (row & 7)
+        else:
+            self._negative[row >> 3] &= ~(1 << (row & 7))
+
+    @staticmethod
+    def _timestamp_to_seconds(timestamp):
+        # wikidata timestamps look like 2020-01-01T00:00:00Z, '' (unknown) is stored as 0
+        if not timestamp:
+            return 0
+        # slicing is several times faster than strptime, which matters when loading large caches
+        return calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]), int(timestamp[11:13]),
+                                int(timestamp[14:16]), int(timestamp[17:19]), 0, 0, 0))
+
+    @staticmethod
+    def _seconds_to_timestamp(seconds):
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds)) if seconds else ''
+
+    def _set_row(self, row, linked_entity, description, lastrevid, modified, checked):
+        self._other_linked_entities.pop(row, None)
+        self._set_negative(row, linked_entity == '')
+
+        qid = 0
+        if linked_entity != '':
+            if self._qid_pattern.fullmatch(linked_entity) and int(linked_entity[1:]) <= 0xFFFFFFFF:
+                qid = int(linked_entity[1:])
+            else:
+                self._other_linked_entities[row] = linked_entity
+
+        self._qids[row] = qid
+        self._description_ids[row] = self._intern_description(description)
+        self._lastrevids[row] = lastrevid
+        self._modified[row] = self._timestamp_to_seconds(modified)
+        self._checked[row] = checked
+
+    def put(self, entity, linked_entity, description, lastrevid=0, modified='', checked=0):
+        slot = self._find_slot(entity)
+        row = self._slots[slot]
+        if row == self._empty_slot:
+            row = len(self._entities)
+            self._entities.append(entity)
+            self._slots[slot] = row
+            self._qids.append(0)
+            self._description_ids.append(0)
+            self._lastrevids.append(0)
+            self._modified.append(0)
+            self._checked.append(0)
+            if row & 7 == 0:
+                self._negative.append(0)
+
+            # keep the load factor of the hash table below 2/3
+            if 3 * len(self._entities) > 2 * len(self._slots):
+                self._grow()
+
+        self._set_row(row, linked_entity, description, lastrevid, modified, checked)
+
+    def _row(self, row):
+        if self._is_negative(row):
+            linked_entity = ''
+        else:
+            linked_entity = self._other_linked_entities.get(row, None)
+            if linked_entity is None:
+                linked_entity = f"Q{self._qids[row]}"
+        return (linked_entity, self._descriptions[self._description_ids[row]], self._lastrevids[row],
+                self._seconds_to_timestamp(self._modified[row]), self._checked[row])
+
+    def get(self, entity, default=None):
+        """
+
+        :return: A tuple<linked_entity, description, lastrevid, modified, checked> or default if entity is not part
+            of the table.
+        """
+        row = self._find_row(entity)
+        return default if row is None else self._row(row)
+
+    def items(self):
+        """
+        Iterates over all tuple<entity, tuple<linked_entity, description, lastrevid, modified, checked>> in insertion
+        order.
+        """
+        for row, entity in enumerate(self._entities):
+            yield entity, self._row(row)
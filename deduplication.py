@@ -0,0 +1,145 @@
+import math
+import threading
+
+from collections import namedtuple
+
+# actions of RowDeduplicator.add
+FORWARD = 'forward'
+COLLAPSED = 'collapsed'
+ANSWERED = 'answered'
+
+DeduplicatorState = namedtuple('DeduplicatorState', ['pending_keys', 'remembered_keys', 'collapsed_rows',
+                                                     'answered_rows'])
+
+
+class BloomFilter:
+    """
+    Approximate set of strings using a fixed number of bits: a key which has been added is always contained, a key
+    which has not been added is contained with probability error_rate (as long as at most capacity keys are added).
+    Like the AliasIndex, keys are hashed using hash(), so a filter is only valid within one process.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._bit_count = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hash_count = max(1, round(self._bit_count / capacity * math.log(2)))
+        self._bits = bytearray((self._bit_count + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing, the second hash is odd so the positions differ for every power of two
+        first_hash = hash(key)
+        second_hash = hash((key, 0x9E3779B9)) | 1
+        return [(first_hash + i * second_hash) % self._bit_count for i in range(self._hash_count)]
+
+    def add(self, key):
+        """
+        :return: True if key has (definitely) not been contained before.
+        """
+        added = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not self._bits[position >> 3] & mask:
+                self._bits[position >> 3] |= mask
+                added = True
+        return added
+
+    def __contains__(self, key):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def memory(self):
+        """
+        :return: Size of the bit array in bytes.
+        """
+        return len(self._bits)
+
+
+class _PendingKey:
+    __slots__ = ['rows', 'repeated']
+
+    def __init__(self, repeated):
+        # list<tuple<sequence number, entity>> of the rows waiting for the first row of the key
+        self.rows = []
+        self.repeated = repeated
+
+
+class RowDeduplicator:
+    """
+    Collapses rows with the same lookup key before they are looked up, so a key is looked up and requested once while
+    its result is fanned out to every row:
+        - the first row of a key is forwarded, later rows wait for its result until it has been written (COLLAPSED),
+        - the results of written keys are remembered, so later rows are answered at once (ANSWERED). At most
+          max_keys results are remembered, rows of keys whose result has been forgotten are forwarded again (the cache
+          answers them).
+
+    Without a bloom filter, the results of all keys are remembered until max_keys is reached. Vocabularies mostly
+    consist of keys which occur once, hence for very large inputs a BloomFilter of the keys which have been seen can
+    be passed: only the results of keys which occurred at least twice are remembered then, a key occurring once costs
+    a few bits. A false positive of the filter only remembers a result which is never used.
+
+    Failed rows are not remembered, the next row of their key is requested again.
+    """
+
+    def __init__(self, key=None, max_keys=1000000, bloom_filter=None):
+        """
+
+        :param key: Callable returning the lookup key of an entity. Rows whose entities have the same key share one
+            result. If None, only equal entities are collapsed.
+        :param max_keys: Maximum number of remembered results.
+        :param bloom_filter: BloomFilter of the keys which have been seen, see above.
+        """
+        self.key = key if key is not None else (lambda entity: entity)
+        self.max_keys = max_keys
+        self._bloom_filter = bloom_filter
+        self._lock = threading.Lock()
+        # Dictionary<key, _PendingKey> of the keys whose first row has not been written yet
+        self._pending = dict()
+        # Dictionary<key, result>, the result is a WikidataNamedEntity or None (not found)
+        self._results = dict()
+        self._collapsed_rows = 0
+        self._answered_rows = 0
+
+    def add(self, sequence_number, entity):
+        """
+        :return: A tuple<action, result>. FORWARD: the row has to be looked up. COLLAPSED: the row waits for the
+            result of a forwarded row and is returned by complete. ANSWERED: result is the result of the row.
+        """
+        key = self.key(entity)
+        with self._lock:
+            pending_key = self._pending.get(key, None)
+            if pending_key is not None:
+                pending_key.rows.append((sequence_number, entity))
+                self._collapsed_rows += 1
+                return COLLAPSED, None
+
+            if key in self._results:
+                self._answered_rows += 1
+                return ANSWERED, self._results[key]
+
+            repeated = self._bloom_filter is None or not self._bloom_filter.add(key)
+            self._pending[key] = _PendingKey(repeated)
+            return FORWARD, None
+
+    def complete(self, entity, result, failed=False):
+        """
+        Records the result of a forwarded row.
+
+        :param failed: True if the row could not be linked, its result is not remembered.
+        :return: list<tuple<sequence number, entity>> of the rows which have been collapsed into the row, they share
+            its result.
+        """
+        key = self.key(entity)
+        with self._lock:
+            pending_key = self._pending.pop(key, None)
+            if pending_key is None:
+                return []
+
+            remember = pending_key.repeated or pending_key.rows
+            if remember and not failed and len(self._results) < self.max_keys:
+                self._results[key] = result
+            return pending_key.rows
+
+    def state(self):
+        with self._lock:
+            return DeduplicatorState(pending_keys=len(self._pending), remembered_keys=len(self._results),
+                                     collapsed_rows=self._collapsed_rows, answered_rows=self._answered_rows)
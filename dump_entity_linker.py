@@ -0,0 +1,448 @@
+import argparse
+import bz2
+import gzip
+import io
+import json
+import multiprocessing
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+
+from abc import abstractmethod
+from collections import deque
+from functools import partial
+
+from named_entity_linker import NamedEntityLinker, NamedEntityLinking
+from wikidata_entity_linker import WikidataEntityLinker, WikidataNamedEntity
+
+# wikidata item of "Wikimedia disambiguation page"
+disambiguation_page_item = "Q4167410"
+
+_parallel_decompressors = {
+    '.bz2': ['lbzip2', 'pbzip2'],
+    '.gz': ['pigz'],
+}
+
+_sql_value = re.compile(r"\(|\)|'((?:[^'\\]|\\.)*)'|([^,()']+)", re.S)
+_sql_escape = re.compile(r"\\(.)", re.S)
+_sql_escapes = {'n': '\n', 'r': '\r', 't': '\t', '0': '\0', 'Z': '\x1a'}
+
+
+class _DecompressorOutput(io.TextIOWrapper):
+    """
+    Text stream of the output of a decompressor process. Reaching the end of the stream waits for the process and
+    raises if it failed (e.g. on a truncated or corrupt dump), as bz2.open and gzip.open do. Closing the stream before
+    its end kills the process.
+    """
+
+    def __init__(self, process, stderr, command):
+        io.TextIOWrapper.__init__(self, process.stdout, encoding='utf-8', errors='replace')
+        self._process = process
+        self._stderr = stderr
+        self._command = command
+
+    def _finish(self):
+        if self._process is None:
+            return
+
+        process, self._process = self._process, None
+        return_code = process.wait()
+        with self._stderr as stderr:
+            stderr.seek(0)
+            message = stderr.read().decode('utf-8', errors='replace').strip()
+        if return_code != 0:
+            raise Exception(f"{' '.join(self._command)} failed with exit status {return_code}: {message}")
+
+    def readline(self, size=-1):
+        line = io.TextIOWrapper.readline(self, size)
+        if not line and size != 0:
+            self._finish()
+        return line
+
+    def read(self, size=-1):
+        text = io.TextIOWrapper.read(self, size)
+        if size is None or size < 0 or (not text and size != 0):
+            self._finish()
+        return text
+
+    def __next__(self):
+        try:
+            return io.TextIOWrapper.__next__(self)
+        except StopIteration:
+            self._finish()
+            raise
+
+    def close(self):
+        process, self._process = self._process, None
+        if process is not None:
+            # closed before the end of the stream
+            process.kill()
+        io.TextIOWrapper.close(self)
+        if process is not None:
+            process.wait()
+            self._stderr.close()
+
+
+def open_dump(filename):
+    """
+    Opens a (compressed) dump as text stream. bz2 and gz files are decompressed by lbzip2/pbzip2/pigz if one of them
+    is installed, so decompression uses several cores and runs in parallel to parsing. Like bz2.open and gzip.open,
+    the stream raises at its end if the dump is truncated or corrupt.
+    """
+    for extension, decompressors in _parallel_decompressors.items():
+        if not filename.endswith(extension):
+            continue
+
+        for decompressor in decompressors:
+            if shutil.which(decompressor) is not None:
+                command = [decompressor, '-dc', filename]
+                # stderr goes to a file, a pipe which is only read at the end could fill up and block the process
+                stderr = tempfile.TemporaryFile()
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+                return _DecompressorOutput(process, stderr, command)
+
+        if extension == '.bz2':
+            return bz2.open(filename, 'rt', encoding='utf-8', errors='replace')
+        return gzip.open(filename, 'rt', encoding='utf-8', errors='replace')
+
+    return open(filename, 'r', encoding='utf-8', errors='replace')
+
+
+def _unescape_sql_string(value):
+    return _sql_escape.sub(lambda match: _sql_escapes.get(match.group(1), match.group(1)), value)
+
+
+def parse_sql_insert(line):
+    """
+    Parses an 'INSERT INTO `table` VALUES (...),(...);' statement of a mediawiki sql dump.
+
+    :return: Generator of lists. Strings are unescaped, NULL is returned as None, numbers are returned as strings.
+    """
+    start = line.find(' VALUES ')
+    if start < 0:
+        return
+
+    row = None
+    for match in _sql_value.finditer(line, start + len(' VALUES ')):
+        token = match.group(0)
+        if token == '(':
+            row = []
+        elif row is None:
+            continue
+        elif token == ')':
+            yield row
+            row = None
+        elif match.group(1) is not None:
+            row.append(_unescape_sql_string(match.group(1)))
+        else:
+            value = token.strip()
+            row.append(None if value == 'NULL' else value)
+
+
+def _parse_page_lines(lines):
+    # page_id, page_namespace, page_title, ...
+    return [(int(row[0]), row[2].replace('_', ' '))
+            for line in lines for row in parse_sql_insert(line) if row[1] == '0']
+
+
+def _parse_page_props_lines(lines):
+    # pp_page, pp_propname, pp_value, ...
+    propnames = ('wikibase_item', 'wikibase-shortdesc', 'disambiguation')
+    return [(int(row[0]), row[1], row[2])
+            for line in lines for row in parse_sql_insert(line) if row[1] in propnames]
+
+
+def _parse_redirect_lines(lines):
+    # rd_from, rd_namespace, rd_title, rd_interwiki, rd_fragment
+    return [(int(row[0]), row[2].replace('_', ' '))
+            for line in lines for row in parse_sql_insert(line) if row[1] == '0' and not row[3]]
+
+
+def _parse_wikidata_lines(lines, site, language):
+    rows = []
+    for line in lines:
+        line = line.strip().rstrip(',')
+        if not line.startswith('{'):
+            continue
+
+        item = json.loads(line)
+        sitelink = item.get('sitelinks', {}).get(site, None)
+        if item.get('type', None) != 'item' or sitelink is None:
+            continue
+
+        description = item.get('descriptions', {}).get(language, {}).get('value', None)
+        is_disambiguation = any(claim.get('mainsnak', {}).get('datavalue', {}).get('value', {}).get('id', None) ==
+                                disambiguation_page_item for claim in item.get('claims', {}).get('P31', []))
+        rows.append((sitelink['title'], item['id'], description, int(is_disambiguation)))
+    return rows
+
+
+class DumpIndexBuilder:
+    """
+    Builds the on-disk index used by DumpEntityLinker from local dumps. Dumps are streamed: lines are read in chunks,
+    parsed by a pool of worker processes and written to SQLite, so memory usage does not depend on the dump size.
+    """
+
+    def __init__(self, index_filename, processes=None, lines_per_chunk=1000, max_pending_chunks=None):
+        """
+
+        :param index_filename: SQLite file to which the index will be written.
+        :param processes: Number of parsing processes (default: number of cores).
+        :param lines_per_chunk: Number of lines parsed by a worker at once. Lines of sql dumps contain up to ~1MB of
+            values, hence sql dumps are chunked by 1/100th of this value.
+        :param max_pending_chunks: Maximum number of chunks read ahead of the writer (default: 2 * processes).
+        """
+        self._processes = processes or multiprocessing.cpu_count()
+        self._lines_per_chunk = lines_per_chunk
+        self._max_pending_chunks = max_pending_chunks or 2 * self._processes
+        self._connection = sqlite3.connect(index_filename)
+        self._connection.execute("PRAGMA journal_mode=OFF")
+        self._connection.execute("PRAGMA synchronous=OFF")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS titles ("
+                                 "title TEXT PRIMARY KEY NOT NULL, "
+                                 "linked_entity TEXT NOT NULL, "
+                                 "description TEXT, "
+                                 "is_disambiguation INTEGER NOT NULL) WITHOUT ROWID")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS redirects ("
+                                 "title TEXT PRIMARY KEY NOT NULL, "
+                                 "target TEXT NOT NULL) WITHOUT ROWID")
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    @staticmethod
+    def _chunks(lines, lines_per_chunk, prefix=None):
+        chunk = []
+        for line in lines:
+            if prefix is not None and not line.startswith(prefix):
+                continue
+            chunk.append(line)
+            if len(chunk) == lines_per_chunk:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _parallel_map(self, pool, function, chunks):
+        # Pool.imap would read the whole input ahead of the workers, hence the number of pending chunks is bounded
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(function, (chunk,)))
+            if len(pending) >= self._max_pending_chunks:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def _load(self, filename, function, insert_query, sql_dump):
+        rows_written = 0
+        with open_dump(filename) as dump, multiprocessing.Pool(self._processes) as pool:
+            if sql_dump:
+                chunks = self._chunks(dump, max(1, self._lines_per_chunk // 100), prefix='INSERT INTO')
+            else:
+                chunks = self._chunks(dump, self._lines_per_chunk)
+
+            for rows in self._parallel_map(pool, function, chunks):
+                self._connection.executemany(insert_query, rows)
+                rows_written += len(rows)
+            self._connection.commit()
+
+        print(f"{rows_written} rows read from {filename}")
+
+    def add_wikidata_json_dump(self, filename, site='enwiki', language='en'):
+        """
+        Indexes all items of a wikidata json dump (latest-all.json[.bz2|.gz]) having a sitelink to site.
+        """
+        self._load(filename, partial(_parse_wikidata_lines, site=site, language=language),
+                   "INSERT OR REPLACE INTO titles (title, linked_entity, description, is_disambiguation) "
+                   "VALUES (?, ?, ?, ?)", sql_dump=False)
+
+    def add_wikipedia_sql_dumps(self, page_filename, page_props_filename, redirect_filename=None):
+        """
+        Indexes all articles of a wikipedia using its page, page_props and (optionally) redirect sql dumps. Descriptions
+        are taken from the local short descriptions of the articles.
+        """
+        connection = self._connection
+        connection.execute("CREATE TEMP TABLE page (id INTEGER PRIMARY KEY, title TEXT NOT NULL)")
+        connection.execute("CREATE TEMP TABLE page_props (page INTEGER NOT NULL, name TEXT NOT NULL, value TEXT)")
+        connection.execute("CREATE TEMP TABLE redirect (page INTEGER PRIMARY KEY, target TEXT NOT NULL)")
+
+        self._load(page_filename, _parse_page_lines, "INSERT OR REPLACE INTO page VALUES (?, ?)", sql_dump=True)
+        self._load(page_props_filename, _parse_page_props_lines, "INSERT INTO page_props VALUES (?, ?, ?)",
+                   sql_dump=True)
+        connection.execute("CREATE INDEX temp.page_props_page ON page_props (page, name)")
+
+        connection.execute("INSERT OR REPLACE INTO titles (title, linked_entity, description, is_disambiguation) "
+                           "SELECT p.title, item.value, description.value, disambiguation.page IS NOT NULL "
+                           "FROM page p "
+                           "JOIN page_props item ON item.page = p.id AND item.name = 'wikibase_item' "
+                           "LEFT JOIN page_props description "
+                           "ON description.page = p.id AND description.name = 'wikibase-shortdesc' "
+                           "LEFT JOIN page_props disambiguation "
+                           "ON disambiguation.page = p.id AND disambiguation.name = 'disambiguation'")
+
+        if redirect_filename is not None:
+            self._load(redirect_filename, _parse_redirect_lines, "INSERT OR REPLACE INTO redirect VALUES (?, ?)",
+                       sql_dump=True)
+            connection.execute("INSERT OR REPLACE INTO redirects (title, target) "
+                               "SELECT p.title, r.target FROM redirect r JOIN page p ON p.id = r.page")
+
+        connection.commit()
+        connection.execute("DROP TABLE temp.page")
+        connection.execute("DROP TABLE temp.page_props")
+        connection.execute("DROP TABLE temp.redirect")
+
+
+class TitleIndexEntityLinker(NamedEntityLinker):
+    """
+    Base class of linkers which look up entities in a local title index instead of performing http requests.
+    The linking mirrors WikidataEntityLinker: entities are looked up by their exact title first (following redirects),
+    missing entities are looked up by their normalized title afterwards. Disambiguation pages are not linked.
+    """
+
+    @abstractmethod
+    def _select_titles(self, titles):
+        """
+
+        :return: Dictionary<title, tuple<linked_entity, description, is_disambiguation>>.
+        """
+        pass
+
+    @abstractmethod
+    def _select_redirects(self, titles):
+        """
+
+        :return: Dictionary<title, redirect target title>.
+        """
+        pass
+
+    def _lookup(self, titles):
+        """
+
+        :return: Dictionary<title, tuple<linked_entity, description, is_disambiguation>> including redirected titles.
+        """
+        rows = self._select_titles(titles)
+
+        redirects = self._select_redirects([title for title in titles if title not in rows])
+        if redirects:
+            targets = self._select_titles(set(redirects.values()))
+            for title, target in redirects.items():
+                if target in targets:
+                    rows[title] = targets[target]
+
+        return rows
+
+    def _link(self, entities, titles, linked_entities, not_found_entities):
+        rows = self._lookup(set(titles.values()))
+        for entity in entities:
+            row = rows.get(titles[entity], None)
+            if row is None:
+                continue
+
+            linked_entity, description, is_disambiguation = row
+            if is_disambiguation or (description is not None and 'disambiguation page' in description):
+                not_found_entities.add(entity)
+            else:
+                linked_entities[entity] = WikidataNamedEntity(entity, linked_entity, description)
+
+    def entity_id(self, entity):
+        if not entity:
+            raise Exception("entity must not be None or empty.")
+
+        linked_entities = self.entity_ids([entity])
+        if len(linked_entities) == 0:
+            return None, NamedEntityLinking.NOT_FOUND
+
+        return linked_entities[entity], NamedEntityLinking.SUCCESS
+
+    def entity_ids(self, entities, not_found_entities=None):
+        """
+        :param entities: Collection of entities (strings). There is no limit on the number of entities.
+        :param not_found_entities: Expects a set which will be used to store entities which could not be linked.
+        :return: Returns Dictionary<entity, WikidataNamedEntity>. Entities, which could not be linked, will not be added
+            to the dictionary.
+        """
+        linked_entities = dict()
+        disambiguation_entities = set()
+        self._link(entities, {entity: entity for entity in entities}, linked_entities, disambiguation_entities)
+
+        missing_entities = [entity for entity in entities
+                            if entity not in linked_entities and entity not in disambiguation_entities]
+        titles = {entity: WikidataEntityLinker.mediawiki_title(entity) for entity in missing_entities}
+        self._link(missing_entities, titles, linked_entities, disambiguation_entities)
+
+        if not_found_entities is not None:
+            not_found_entities.update(entity for entity in entities if entity not in linked_entities)
+
+        return linked_entities
+
+
+class DumpEntityLinker(TitleIndexEntityLinker):
+    """
+    Links entities using an index built by DumpIndexBuilder. No http requests are performed.
+    """
+
+    max_parameters_per_query = 900
+
+    def __init__(self, index_filename):
+        self._index_filename = index_filename
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self._index_filename}?mode=ro", uri=True, check_same_thread=False)
+            # let the index be served from the page cache
+            connection.execute("PRAGMA mmap_size=68719476736")
+            self._local.connection = connection
+        return connection
+
+    def _select(self, query, keys):
+        keys = list(keys)
+        connection = self._connection()
+        for i in range(0, len(keys), self.max_parameters_per_query):
+            chunk = keys[i:i + self.max_parameters_per_query]
+            yield from connection.execute(query.format(','.join('?' * len(chunk))), chunk)
+
+    def _select_titles(self, titles):
+        return {title: (linked_entity, description, is_disambiguation) for title, linked_entity, description,
+                is_disambiguation in self._select("SELECT title, linked_entity, description, is_disambiguation "
+                                                  "FROM titles WHERE title IN ({})", titles)}
+
+    def _select_redirects(self, titles):
+        return dict(self._select("SELECT title, target FROM redirects WHERE title IN ({})", titles))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the index used to link entities without accessing the '
+                                                 'wikidata api. Either a wikidata json dump or the page, page_props '
+                                                 '(and redirect) sql dumps of a wikipedia are required. Dumps may '
+                                                 'be compressed using bz2 or gzip.')
+
+    parser.add_argument('index', help="SQLite file to which the index will be written")
+    parser.add_argument('--wikidata-json', help="wikidata json dump (for example latest-all.json.bz2)")
+    parser.add_argument('--site', help="site of the sitelinks to index when using a wikidata json dump "
+                                       "(default='enwiki')", default='enwiki')
+    parser.add_argument('--language', help="language of the descriptions to index when using a wikidata json dump "
+                                           "(default='en')", default='en')
+    parser.add_argument('--page', help="page sql dump (for example enwiki-latest-page.sql.gz)")
+    parser.add_argument('--page-props', help="page_props sql dump (for example enwiki-latest-page_props.sql.gz)")
+    parser.add_argument('--redirect', help="redirect sql dump (for example enwiki-latest-redirect.sql.gz)")
+    parser.add_argument('-p', '--processes', help="number of parsing processes (default: number of cores)",
+                        default=None, type=int)
+
+    args_dict = vars(parser.parse_args())
+
+    if args_dict['wikidata_json'] is None and (args_dict['page'] is None or args_dict['page_props'] is None):
+        parser.error("either --wikidata-json or --page and --page-props are required")
+
+    builder = DumpIndexBuilder(args_dict['index'], processes=args_dict['processes'])
+    if args_dict['wikidata_json'] is not None:
+        builder.add_wikidata_json_dump(args_dict['wikidata_json'], site=args_dict['site'],
+                                       language=args_dict['language'])
+    if args_dict['page'] is not None and args_dict['page_props'] is not None:
+        builder.add_wikipedia_sql_dumps(args_dict['page'], args_dict['page_props'], args_dict['redirect'])
+    builder.close()
@@ -0,0 +1,627 @@
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+import threading
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from compact_entity_table import CompactEntityTable
+from metrics import shared_metrics
+
+
+# values of the revision columns of rows which were written without them (e.g. by older versions)
+unknown_revision = (0, '', 0)
+
+
+def complete_row(row):
+    """
+    Pads a row read from a file to tuple<entity, linked_entity, description, lastrevid, modified, checked>. Files
+    written before the revision columns were added only contain the first three columns.
+    """
+    if len(row) >= 6:
+        return row[0], row[1], row[2], int(row[3] or 0), row[4], int(row[5] or 0)
+    return (row[0], row[1], row[2]) + unknown_revision
+
+
+class EntityStore(ABC):
+    """
+    Storage backend of a PersistentEntityLinker. A store maps an entity (string) to a row consisting out of the linked
+    entity, its description, the revision of the linked entity when it was fetched (lastrevid and modified timestamp
+    reported by wikidata, 0 and '' if unknown) and the time the row was fetched (checked, in seconds since the epoch,
+    0 if unknown). Entities which could not be linked are stored with an empty linked entity.
+    """
+
+    @abstractmethod
+    def get(self, entity):
+        """
+
+        :param entity:
+        :return: A tuple<linked_entity, description, lastrevid, modified, checked> or None if entity is not part of the
+            store.
+        """
+        pass
+
+    def get_many(self, entities):
+        """
+
+        :param entities: Collection of entities (strings).
+        :return: Dictionary<entity, tuple<linked_entity, description, lastrevid, modified, checked>>. Entities which
+            are not part of the store will not be added to the dictionary.
+        """
+        rows = dict()
+        for entity in entities:
+            row = self.get(entity)
+            if row is not None:
+                rows[entity] = row
+        return rows
+
+    def put(self, entity, linked_entity, description, lastrevid=0, modified='', checked=0):
+        self.put_many([(entity, linked_entity, description, lastrevid, modified, checked)])
+
+    @abstractmethod
+    def put_many(self, rows):
+        """
+
+        :param rows: Iterable of tuple<entity, linked_entity, description, lastrevid, modified, checked>.
+        """
+        pass
+
+    @abstractmethod
+    def rows(self):
+        """
+        Iterates over all tuple<entity, linked_entity, description, lastrevid, modified, checked> of the store.
+        """
+        pass
+
+    def sync(self):
+        """
+        Makes sure all rows written so far are stored durably.
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class CsvEntityStore(EntityStore):
+    """
+    Keeps the whole csv file in memory (using a CompactEntityTable). New rows are appended to the file.
+    """
+
+    header = ["entity", "linked_entity", "description", "lastrevid", "modified", "checked"]
+
+    def __init__(self, filename):
+        self._filename = filename
+        # lookups only wait for updates of the table, not for writes to the file
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._rows = CompactEntityTable()
+        self._initialize_rows()
+        self._file = open(filename, mode='a')
+
+    def _initialize_rows(self):
+        try:
+            with open(self._filename, "r") as file:
+                reader = csv.reader(file, delimiter=',')
+                next(reader)
+                for row in reader:
+                    self._rows.put(*complete_row(row))
+
+        except FileNotFoundError:
+            with open(self._filename, "a") as file:
+                csv.writer(file).writerow(self.header)
+
+    def sync(self):
+        with self._file_lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._file_lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def get(self, entity):
+        with self._lock:
+            return self._rows.get(entity, None)
+
+    def rows(self):
+        for entity, row in self._rows.items():
+            yield (entity,) + row
+
+    def put_many(self, rows):
+        rows = list(rows)
+        with self._file_lock:
+            writer = csv.writer(self._file, delimiter=',')
+            if self._file.tell() == 0:
+                writer.writerow(self.header)
+
+            writer.writerows(rows)
+            self._file.flush()
+
+        with self._lock:
+            for row in rows:
+                self._rows.put(*row)
+
+
+class SqliteEntityStore(EntityStore):
+    """
+    Stores all rows in an indexed SQLite database, hence nothing has to be loaded on startup. The database is opened in
+    WAL mode, so several processes may read from and write to the same file at once.
+    """
+
+    # SQLite limits the number of host parameters per statement (999 for versions prior to 3.32)
+    max_parameters_per_query = 900
+
+    def __init__(self, filename, timeout=60):
+        self._filename = filename
+        self._timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS entities ("
+                           "entity TEXT PRIMARY KEY NOT NULL, "
+                           "linked_entity TEXT NOT NULL, "
+                           "description TEXT, "
+                           "lastrevid INTEGER NOT NULL DEFAULT 0, "
+                           "modified TEXT NOT NULL DEFAULT '', "
+                           "checked INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID")
+        # databases created before the revision columns were added
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(entities)")}
+        for column, definition in (('lastrevid', "INTEGER NOT NULL DEFAULT 0"),
+                                   ('modified', "TEXT NOT NULL DEFAULT ''"),
+                                   ('checked', "INTEGER NOT NULL DEFAULT 0")):
+            if column not in columns:
+                connection.execute(f"ALTER TABLE entities ADD COLUMN {column} {definition}")
+        connection.commit()
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads, hence every thread gets its own one
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._filename, timeout=self._timeout, check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def get(self, entity):
+        cursor = self._connection().execute("SELECT linked_entity, description, lastrevid, modified, checked "
+                                            "FROM entities WHERE entity = ?", (entity,))
+        return cursor.fetchone()
+
+    def get_many(self, entities):
+        entities = list(entities)
+        rows = dict()
+        connection = self._connection()
+        for i in range(0, len(entities), self.max_parameters_per_query):
+            chunk = entities[i:i + self.max_parameters_per_query]
+            query = f"SELECT entity, linked_entity, description, lastrevid, modified, checked FROM entities " \
+                    f"WHERE entity IN ({','.join('?' * len(chunk))})"
+            for row in connection.execute(query, chunk):
+                rows[row[0]] = row[1:]
+        return rows
+
+    def rows(self):
+        # a cursor of its own, so other queries of this thread do not reset the iteration
+        return self._connection().cursor().execute("SELECT entity, linked_entity, description, lastrevid, modified, "
+                                                   "checked FROM entities")
+
+    def put_many(self, rows):
+        connection = self._connection()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO entities (entity, linked_entity, description, lastrevid, "
+                                   "modified, checked) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def sync(self):
+        # with synchronous=NORMAL, WAL commits only become durable once they are checkpointed
+        self._connection().execute("PRAGMA wal_checkpoint(FULL)")
+
+
+class WriteBehindEntityStore(EntityStore):
+    """
+    Wraps a store and persists new rows in the background. Rows are visible to lookups as soon as they are put, a
+    writer thread flushes them to the wrapped store in batches (a single write/transaction per batch).
+    """
+
+    fsync_policies = ('never', 'batch')
+
+    def __init__(self, store, batch_size=1000, max_latency=1.0, fsync='never'):
+        """
+
+        :param store: The EntityStore to write to.
+        :param batch_size: Number of staged rows which triggers a flush.
+        :param max_latency: Maximum time in seconds a row stays staged before it is flushed.
+        :param fsync: 'never' leaves syncing to the operating system, 'batch' syncs the store after every flush.
+        """
+        if fsync not in self.fsync_policies:
+            raise Exception(f"Unknown fsync policy {fsync}. Supported policies: {', '.join(self.fsync_policies)}")
+
+        self._store = store
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.fsync = fsync
+
+        self._condition = threading.Condition()
+        self._staged_rows = dict()
+        self._pending_rows = []
+        self._flush_requested = False
+        self._closing = False
+        self._closed = False
+        self._error = None
+        self._writer = threading.Thread(target=self._write_batches, daemon=True)
+        self._writer.start()
+
+    def _raise_writer_error(self):
+        if self._error is not None:
+            raise Exception(f"writing to the entity store failed: {self._error}") from self._error
+
+    def _write_batches(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closing or self._flush_requested or
+                                         len(self._pending_rows) >= self.batch_size, timeout=self.max_latency)
+                self._flush_requested = False
+                if not self._pending_rows:
+                    if self._closing:
+                        return
+                    continue
+
+                batch = self._pending_rows
+                self._pending_rows = []
+
+            try:
+                self._store.put_many(batch)
+                if self.fsync == 'batch':
+                    self._store.sync()
+            except Exception as ex:
+                with self._condition:
+                    self._error = ex
+                    self._closing = True
+                return
+
+            with self._condition:
+                for row in batch:
+                    # the row may have been replaced while the batch was written
+                    if self._staged_rows.get(row[0], None) == row[1:]:
+                        del self._staged_rows[row[0]]
+                self._condition.notify_all()
+
+    def get(self, entity):
+        with self._condition:
+            row = self._staged_rows.get(entity, None)
+        if row is not None:
+            return row
+        return self._store.get(entity)
+
+    def get_many(self, entities):
+        rows = dict()
+        missing_entities = []
+        with self._condition:
+            for entity in entities:
+                row = self._staged_rows.get(entity, None)
+                if row is None:
+                    missing_entities.append(entity)
+                else:
+                    rows[entity] = row
+
+        rows.update(self._store.get_many(missing_entities))
+        return rows
+
+    def rows(self):
+        self.sync()
+        return self._store.rows()
+
+    def put_many(self, rows):
+        with self._condition:
+            self._raise_writer_error()
+            # the writer thread stops once closing, rows staged now would never be written
+            if self._closing:
+                raise ValueError("store is closed")
+            for row in rows:
+                row = tuple(row)
+                self._staged_rows[row[0]] = row[1:]
+                self._pending_rows.append(row)
+
+            if len(self._pending_rows) >= self.batch_size:
+                self._condition.notify_all()
+
+    def sync(self):
+        """
+        Blocks until all staged rows have been written and syncs the wrapped store.
+        """
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: not self._staged_rows or self._error is not None)
+            self._raise_writer_error()
+        self._store.sync()
+
+    def close(self):
+        """
+        Writes all staged rows and closes the wrapped store.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._closing = True
+            self._condition.notify_all()
+        self._writer.join()
+
+        if self.fsync == 'batch' and self._error is None:
+            self._store.sync()
+        self._store.close()
+        self._raise_writer_error()
+
+
+sqlite_extensions = ('.sqlite', '.sqlite3', '.db')
+
+
+class LayeredEntityStore(EntityStore):
+    """
+    Reads from a writable store first and from a read-only base store second. All new rows are written to the writable
+    store only, which allows several processes to share one base cache while each of them writes its own segment.
+    """
+
+    def __init__(self, store, base_store):
+        self._store = store
+        self._base_store = base_store
+
+    def get(self, entity):
+        row = self._store.get(entity)
+        if row is not None:
+            return row
+        return self._base_store.get(entity)
+
+    def get_many(self, entities):
+        entities = list(entities)
+        rows = self._store.get_many(entities)
+        rows.update(self._base_store.get_many([entity for entity in entities if entity not in rows]))
+        return rows
+
+    def put_many(self, rows):
+        self._store.put_many(rows)
+
+    def rows(self):
+        # only the rows of the writable store, the base store is not owned by this store
+        return self._store.rows()
+
+    def sync(self):
+        self._store.sync()
+
+    def close(self):
+        self._store.close()
+        self._base_store.close()
+
+
+class _MemoryTierStripe:
+    __slots__ = ('lock', 'rows', 'bytes', 'hits', 'misses', 'evictions')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Dictionary<entity, tuple<row, size in bytes>> in least recently used order
+        self.rows = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+class TieredEntityStore(EntityStore):
+    """
+    Keeps the recently used rows of a (usually on-disk) store in a bounded memory tier. The memory tier holds at most
+    max_entries rows and max_bytes bytes (estimated) and evicts the least recently used rows first.
+
+    The memory tier is split into stripes by the hash of the entity. Every stripe has its own lock and its own share of
+    the bounds, hence concurrent lookups of different entities rarely wait for each other. Rows are written through to
+    the wrapped store.
+    """
+
+    def __init__(self, store, max_entries=None, max_bytes=None, stripes=16, metrics=None):
+        """
+
+        :param store: The EntityStore behind the memory tier (the disk tier).
+        :param max_entries: Maximum number of rows of the memory tier (not bounded if None).
+        :param max_bytes: Maximum estimated size of the rows of the memory tier in bytes (not bounded if None).
+        :param stripes: Number of independently locked parts of the memory tier.
+        :param metrics: MetricsRegistry to report to. If None, the registry shared by the whole process is used.
+        """
+        if max_entries is None and max_bytes is None:
+            raise Exception("At least one of max_entries and max_bytes must be defined.")
+
+        self._store = store
+        self._stripes = [_MemoryTierStripe() for _ in range(stripes)]
+        self._max_entries_per_stripe = None if max_entries is None else max(1, max_entries // stripes)
+        self._max_bytes_per_stripe = None if max_bytes is None else max(1, max_bytes // stripes)
+        self._statistics_lock = threading.Lock()
+        self._disk_hits = 0
+        self._disk_misses = 0
+
+        metrics = metrics if metrics is not None else shared_metrics
+        self._lookups = metrics.counter('cache_tier_lookups_total', "Lookups per cache tier (memory, disk) by result "
+                                                                    "(hit, miss)", ('tier', 'result'))
+        metrics.gauge('cache_memory_tier_entries', "Rows held by the memory tier of the cache",
+                      lambda: sum(len(stripe.rows) for stripe in self._stripes))
+        metrics.gauge('cache_memory_tier_bytes', "Estimated size of the rows held by the memory tier of the cache",
+                      lambda: sum(stripe.bytes for stripe in self._stripes))
+
+    @staticmethod
+    def _size(entity, row):
+        # strings, the row tuple and the OrderedDict entry; the integers of a row are mostly cached small ints or
+        # shared with the disk tier and are counted with a fixed size
+        return sys.getsizeof(entity) + sum(sys.getsizeof(value) for value in row if isinstance(value, str)) + 200
+
+    def _stripe(self, entity):
+        return self._stripes[hash(entity) % len(self._stripes)]
+
+    def _insert(self, stripe, entity, row):
+        """
+        Adds row to stripe and evicts least recently used rows. The lock of stripe must be held.
+        """
+        previous = stripe.rows.pop(entity, None)
+        if previous is not None:
+            stripe.bytes -= previous[1]
+
+        size = self._size(entity, row)
+        stripe.rows[entity] = (row, size)
+        stripe.bytes += size
+        while len(stripe.rows) > 1 and \
+                (self._max_entries_per_stripe is not None and len(stripe.rows) > self._max_entries_per_stripe or
+                 self._max_bytes_per_stripe is not None and stripe.bytes > self._max_bytes_per_stripe):
+            _, (_, evicted_size) = stripe.rows.popitem(last=False)
+            stripe.bytes -= evicted_size
+            stripe.evictions += 1
+
+    def _count_disk_lookups(self, hits, misses):
+        with self._statistics_lock:
+            self._disk_hits += hits
+            self._disk_misses += misses
+        self._lookups.inc(hits, ('disk', 'hit'))
+        self._lookups.inc(misses, ('disk', 'miss'))
+
+    def get(self, entity):
+        return self.get_many([entity]).get(entity, None)
+
+    def get_many(self, entities):
+        entities_by_stripe = dict()
+        for entity in entities:
+            entities_by_stripe.setdefault(hash(entity) % len(self._stripes), []).append(entity)
+
+        rows = dict()
+        missing_entities = []
+        for stripe_index, stripe_entities in entities_by_stripe.items():
+            stripe = self._stripes[stripe_index]
+            with stripe.lock:
+                for entity in stripe_entities:
+                    cached = stripe.rows.get(entity, None)
+                    if cached is None:
+                        stripe.misses += 1
+                        missing_entities.append(entity)
+                    else:
+                        stripe.hits += 1
+                        stripe.rows.move_to_end(entity)
+                        rows[entity] = cached[0]
+        self._lookups.inc(len(rows), ('memory', 'hit'))
+        self._lookups.inc(len(missing_entities), ('memory', 'miss'))
+
+        if missing_entities:
+            # entities may be looked up more than once per call
+            missing_entities = list(dict.fromkeys(missing_entities))
+            disk_rows = self._store.get_many(missing_entities)
+            self._count_disk_lookups(len(disk_rows), len(missing_entities) - len(disk_rows))
+            for entity, row in disk_rows.items():
+                stripe = self._stripe(entity)
+                with stripe.lock:
+                    # a row put meanwhile is newer than the one read from disk
+                    if entity not in stripe.rows:
+                        self._insert(stripe, entity, tuple(row))
+            rows.update(disk_rows)
+
+        return rows
+
+    def put_many(self, rows):
+        rows = [tuple(row) for row in rows]
+        self._store.put_many(rows)
+        for row in rows:
+            stripe = self._stripe(row[0])
+            with stripe.lock:
+                self._insert(stripe, row[0], row[1:])
+
+    def rows(self):
+        return self._store.rows()
+
+    def statistics(self):
+        """
+
+        :return: Dictionary<tier, Dictionary<name, int>> containing the hits and misses of the memory and the disk tier
+            as well as the rows, estimated bytes and evictions of the memory tier.
+        """
+        memory = {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0, 'evictions': 0}
+        for stripe in self._stripes:
+            with stripe.lock:
+                memory['hits'] += stripe.hits
+                memory['misses'] += stripe.misses
+                memory['entries'] += len(stripe.rows)
+                memory['bytes'] += stripe.bytes
+                memory['evictions'] += stripe.evictions
+        with self._statistics_lock:
+            disk = {'hits': self._disk_hits, 'misses': self._disk_misses}
+        return {'memory': memory, 'disk': disk}
+
+    def sync(self):
+        self._store.sync()
+
+    def close(self):
+        self._store.close()
+
+
+def open_entity_store(filename, backend=None):
+    """
+    Opens the store for filename.
+
+    :param filename: Path to the cache.
+    :param backend: 'csv' or 'sqlite'. If None, the backend is derived from the extension of filename.
+    """
+    if backend is None:
+        backend = 'sqlite' if filename.endswith(sqlite_extensions) else 'csv'
+
+    if backend == 'sqlite':
+        return SqliteEntityStore(filename)
+    if backend == 'csv':
+        return CsvEntityStore(filename)
+
+    raise Exception(f"Unknown entity store backend {backend}.")
+
+
+def import_csv_cache(csv_filename, store, rows_per_transaction=100000):
+    """
+    Copies all rows of a csv cache (as written by CsvEntityStore) into store. The csv file is streamed, hence it does
+    not have to fit into memory.
+
+    :return: The number of imported rows.
+    """
+    imported_rows = 0
+    with open(csv_filename, "r") as file:
+        reader = csv.reader(file, delimiter=',')
+        next(reader)
+
+        rows = []
+        for row in reader:
+            rows.append(complete_row(row))
+            if len(rows) == rows_per_transaction:
+                store.put_many(rows)
+                imported_rows += len(rows)
+                rows.clear()
+
+        store.put_many(rows)
+        imported_rows += len(rows)
+
+    return imported_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Imports a csv cache into a SQLite cache.')
+
+    parser.add_argument('csv_cache', help="csv file written by a previous run (for example cache.csv)")
+    parser.add_argument('sqlite_cache', help="SQLite file to which the cache will be imported (for example "
+                                             "cache.sqlite). The file will be created if it does not exist.")
+
+    args_dict = vars(parser.parse_args())
+
+    sqlite_store = SqliteEntityStore(args_dict['sqlite_cache'])
+    print(f"{import_csv_cache(args_dict['csv_cache'], sqlite_store)} rows imported")
+    sqlite_store.close()
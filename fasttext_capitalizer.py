@@ -1,28 +1,62 @@
+import argparse
 import csv
 
-if __name__ == '__main__':
-    fasttext_model_path = "/home/mapp/masterprojekt/named-entity-linker/wiki-news-300d-1M.vec"
-    fasttext_model_linking = "/home/mapp/masterprojekt/named-entity-linker/improved_linking_fasttext.csv"
-    output_fasttext_path = "all_caps_linking.csv"
+from vocabulary_reader import CaseFoldedIndex, formats, read_vocabulary
+
+strategies = ('upper', 'vocabulary')
+
+
+def capitalize_label(label, index, strategy='upper'):
+    """
+    Chooses the spelling of a linked label used in the embedding.
+
+    :param index: CaseFoldedIndex of the embedding vocabulary.
+    :param strategy: 'upper' uses the all caps spelling if the embedding contains it. 'vocabulary' additionally uses
+        the only spelling of the embedding if it does not contain the label itself.
+    """
+    spellings = index.spellings(label)
+    if label.upper() in spellings:
+        return label.upper()
+
+    if strategy == 'vocabulary' and label not in spellings and len(spellings) == 1:
+        return spellings[0]
+    return label
 
-    with open(fasttext_model_path, "r") as model_file:
-        csv_reader = csv.reader(model_file, delimiter=" ", quoting=csv.QUOTE_NONE)
-        next(csv_reader)
-        tags = {row[0] for row in csv_reader}
 
-    tag_id_pairs = []
-    with open(fasttext_model_linking, "r") as linking_file:
+def read_linking(filename):
+    with open(filename, "r") as linking_file:
         csv_reader = csv.reader(linking_file)
         next(csv_reader)
-        tag_id_pairs = [(row[0], row[1]) for row in csv_reader]
+        return [(row[0], row[1]) for row in csv_reader]
 
-    with open(output_fasttext_path, "w+") as output_file:
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replaces the labels of a linking with the spelling used by an '
+                                                 'embedding, e.g. the all caps spelling of abbreviations.')
+    parser.add_argument('embedding', help="embedding file whose vocabulary is used: .vec (fasttext), GloVe .txt, "
+                                          "word2vec .bin, text files may be compressed (.gz, .bz2)")
+    parser.add_argument('linking', help="csv file written by wikidata_entity_linker.py")
+    parser.add_argument('-o', '--output', help="csv file to which the capitalized linking will be saved "
+                                               "(default='all_caps_linking.csv')", default="all_caps_linking.csv")
+    parser.add_argument('-f', '--format', help="format of the embedding file (default: detected from the file)",
+                        choices=formats, default=None)
+    parser.add_argument('-p', '--processes', help="number of processes scanning the embedding file (default=1)",
+                        default=1, type=int)
+    parser.add_argument('-s', '--strategy', help="'upper' uses the all caps spelling of a label if the embedding "
+                                                 "contains it, 'vocabulary' additionally uses the only spelling of "
+                                                 "the embedding for labels the embedding does not contain "
+                                                 "(default='upper')", choices=strategies, default='upper')
+
+    args_dict = vars(parser.parse_args())
+
+    tag_id_pairs = read_linking(args_dict['linking'])
+
+    # only the spellings of linked labels are kept, not the whole vocabulary
+    index = CaseFoldedIndex(tag for tag, _ in tag_id_pairs)
+    index.update(read_vocabulary(args_dict['embedding'], args_dict['format'], args_dict['processes']))
+
+    with open(args_dict['output'], "w+") as output_file:
         csv_writer = csv.writer(output_file)
         csv_writer.writerow(["embedding_label", "knowledgebase_id"])
-        for tag_id_pair in tag_id_pairs:
-            tag = tag_id_pair[0]
-            if tag.upper() in tags:
-                csv_writer.writerow([tag.upper(), tag_id_pair[1]])
-            else:
-                csv_writer.writerow([tag, tag_id_pair[1]])
-
+        for tag, linked_entity in tag_id_pairs:
+            csv_writer.writerow([capitalize_label(tag, index, args_dict['strategy']), linked_entity])
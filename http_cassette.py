@@ -0,0 +1,235 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import zlib
+
+from time import time
+
+cassette_modes = ('record', 'replay')
+# parameters which do not change the answer of a request
+_ignored_params = ('maxlag',)
+# parameters listing several titles or ids, every value is indexed on its own
+_multi_value_params = ('titles', 'ids')
+# parameters which are not part of the index of a value: a title requested alone is normalized by wikidata, in a batch
+# it is not (see WikidataEntityLinker._link_entities), but both answers link it
+_value_ignored_params = ('normalize',)
+
+
+class CassetteMiss(Exception):
+    """
+    Raised if a replayed request contains values (titles or ids) which have not been recorded. values lists them, so
+    the request can be replayed without them.
+    """
+
+    def __init__(self, message, values=()):
+        Exception.__init__(self, message)
+        self.values = list(values)
+
+
+class HttpCassette:
+    """
+    Archive of 'wbgetentities' request/response pairs in an indexed SQLite file, so a run can be replayed without
+    wikidata at local-disk speed, e.g. for regression runs, profiling or comparing two versions of the linker.
+
+    Requests are identified by their parameters (how they have been sent, GET or POST, does not matter), responses
+    are stored zlib compressed. Only successful responses are recorded; recording a request again replaces its
+    response. The rows whose batch failed are recorded as well (see record_failures), so a replayed run fails exactly
+    these rows.
+
+    Which entities end up in one batch depends on timing (incomplete batches, coalescing, adaptive batch sizing), so
+    a replayed run does not necessarily send the requests which have been recorded. Hence every title (or id) of a
+    recorded request is indexed as well: a request which has not been recorded is answered by the recorded exchanges
+    containing its titles, see replay. Titles which have not been recorded are reported by CassetteMiss one by one, so
+    only their rows fail.
+    """
+
+    def __init__(self, filename, mode='replay', compression_level=6, timeout=60):
+        """
+
+        :param mode: 'record' stores the responses passed to record, 'replay' serves them by replay.
+        """
+        if mode not in cassette_modes:
+            raise Exception(f"Unknown cassette mode {mode}, expected one of {', '.join(cassette_modes)}.")
+
+        self.filename = filename
+        self.mode = mode
+        self.compression_level = compression_level
+        self._timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._statistics_lock = threading.Lock()
+        self._statistics = {'recorded_exchanges': 0, 'recorded_failures': 0, 'recorded_bytes': 0, 'stored_bytes': 0,
+                            'replayed_exchanges': 0, 'assembled_requests': 0, 'missed_requests': 0}
+
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS exchanges ("
+                           "request_hash BLOB PRIMARY KEY NOT NULL, "
+                           "request BLOB NOT NULL, "
+                           "response BLOB NOT NULL, "
+                           "recorded REAL NOT NULL) WITHOUT ROWID")
+        # maps every title (or id) of a recorded request to the request, keyed by the request of this value alone
+        connection.execute("CREATE TABLE IF NOT EXISTS request_values ("
+                           "value_hash BLOB PRIMARY KEY NOT NULL, "
+                           "request_hash BLOB NOT NULL) WITHOUT ROWID")
+        # rows (sequence numbers of the LinkingPipeline) which could not be linked
+        connection.execute("CREATE TABLE IF NOT EXISTS failed_rows (sequence_number INTEGER PRIMARY KEY NOT NULL)")
+        connection.commit()
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads, hence every thread gets its own one
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, timeout=self._timeout, check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def _count(self, **amounts):
+        with self._statistics_lock:
+            for name, amount in amounts.items():
+                self._statistics[name] += amount
+
+    def statistics(self):
+        with self._statistics_lock:
+            return dict(self._statistics)
+
+    @staticmethod
+    def _request(params):
+        """
+        :return: The canonical form of params, a json object with sorted keys and string values.
+        """
+        return json.dumps({key: str(value) for key, value in params.items() if key not in _ignored_params},
+                          sort_keys=True, ensure_ascii=False)
+
+    @classmethod
+    def _hash(cls, params):
+        return hashlib.blake2b(cls._request(params).encode('utf-8'), digest_size=16).digest()
+
+    @staticmethod
+    def split_values(value):
+        """
+        Splits the value of a multi-value parameter (see WikidataEntityLinker.join_titles).
+        """
+        if value.startswith('\x1f'):
+            return value[1:].split('\x1f')
+        return value.split('|')
+
+    @staticmethod
+    def _multi_value_param(params):
+        for name in _multi_value_params:
+            if name in params:
+                return name
+        return None
+
+    def _value_hashes(self, params):
+        """
+        :return: list<tuple<value, hash of the request of the value alone>> of the multi-value parameter of params.
+        """
+        name = self._multi_value_param(params)
+        if name is None:
+            return []
+        value_params = {key: value for key, value in params.items() if key not in _value_ignored_params}
+        return [(value, self._hash(dict(value_params, **{name: value}))) for value in self.split_values(params[name])]
+
+    def record(self, params, content):
+        """
+        Records the successful response to params.
+
+        :param content: Body of the response (bytes).
+        """
+        request_hash = self._hash(params)
+        request = zlib.compress(self._request(params).encode('utf-8'), self.compression_level)
+        response = zlib.compress(content, self.compression_level)
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO exchanges (request_hash, request, response, recorded) "
+                               "VALUES (?, ?, ?, ?)", (request_hash, request, response, time()))
+            connection.executemany("INSERT OR REPLACE INTO request_values (value_hash, request_hash) VALUES (?, ?)",
+                                   [(value_hash, request_hash) for _, value_hash in self._value_hashes(params)])
+        self._count(recorded_exchanges=1, recorded_bytes=len(content), stored_bytes=len(request) + len(response))
+
+    def record_failures(self, sequence_numbers):
+        """
+        Records that the rows of a failed batch could not be linked (even if some requests of the batch have been
+        recorded before it failed).
+
+        :param sequence_numbers: Sequence numbers of the rows (see LinkingPipeline).
+        """
+        connection = self._connection()
+        with connection:
+            connection.executemany("INSERT OR IGNORE INTO failed_rows (sequence_number) VALUES (?)",
+                                   [(sequence_number,) for sequence_number in sequence_numbers])
+        self._count(recorded_failures=1)
+
+    def failed_rows(self, sequence_numbers):
+        """
+        :return: Set of the sequence_numbers whose rows could not be linked in the recorded run.
+        """
+        connection = self._connection()
+        return {sequence_number for sequence_number in sequence_numbers
+                if connection.execute("SELECT 1 FROM failed_rows WHERE sequence_number = ?",
+                                      (sequence_number,)).fetchone() is not None}
+
+    def _exchange(self, request_hash):
+        """
+        :return: A tuple<params, decoded json response> or None if request_hash has not been recorded.
+        """
+        row = self._connection().execute("SELECT request, response FROM exchanges WHERE request_hash = ?",
+                                         (request_hash,)).fetchone()
+        if row is None:
+            return None
+        request, response = row
+        return json.loads(zlib.decompress(request)), json.loads(zlib.decompress(response))
+
+    def replay(self, params):
+        """
+        Answers params by recorded exchanges: the exchange of params itself if it has been recorded, otherwise the
+        exchanges recorded for its titles (or ids) one by one, every exchange once.
+
+        :return: list<tuple<list of values, decoded json response>>, the values are the titles (or ids) of the
+            recorded request in request order. Together, they contain every value of params.
+        :raises CassetteMiss: If values of params have never been recorded, CassetteMiss.values contains all of them.
+        """
+        name = self._multi_value_param(params)
+        exchange = self._exchange(self._hash(params))
+        if exchange is not None:
+            recorded_params, response = exchange
+            self._count(replayed_exchanges=1)
+            return [(self.split_values(recorded_params[name]) if name is not None else [], response)]
+        if name is None:
+            self._count(missed_requests=1)
+            raise CassetteMiss(f"Request {self._request(params)} has not been recorded in {self.filename}.")
+
+        request_hashes = dict()
+        missing_values = []
+        connection = self._connection()
+        for value, value_hash in self._value_hashes(params):
+            row = connection.execute("SELECT request_hash FROM request_values WHERE value_hash = ?",
+                                     (value_hash,)).fetchone()
+            if row is None:
+                missing_values.append(value)
+            else:
+                request_hashes.setdefault(row[0], None)
+        if missing_values:
+            self._count(missed_requests=1)
+            raise CassetteMiss(f"{len(missing_values)} values have not been recorded in {self.filename} (request: "
+                               f"{self._request(params)})", missing_values)
+
+        exchanges = []
+        for request_hash in request_hashes:
+            recorded_params, response = self._exchange(request_hash)
+            exchanges.append((self.split_values(recorded_params[name]), response))
+        self._count(replayed_exchanges=len(exchanges), assembled_requests=1)
+        return exchanges
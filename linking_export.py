@@ -0,0 +1,303 @@
+import argparse
+import csv
+import json
+import os
+import sys
+
+from array import array
+
+from vocabulary_reader import formats, read_vocabulary
+
+# QID of rows which could not be linked (or whose linked entity is no QID fitting into an int32)
+unlinked_qid = -1
+export_formats = ('npy', 'arrow', 'parquet')
+model_formats = ('csv',) + formats
+
+_npy_files = {
+    'qids': ('qids.npy', '<i4'),
+    'mask': ('mask.npy', '|b1'),
+    'label_ids': ('label_ids.npy', '<i4'),
+    'label_offsets': ('label_offsets.npy', '<i8'),
+    'label_bytes': ('label_bytes.npy', '|u1'),
+}
+
+
+def qid_to_int(linked_entity):
+    """
+    :return: 12345 for 'Q12345', unlinked_qid for everything which is no QID or does not fit into an int32.
+    """
+    if linked_entity[:1] == 'Q' and linked_entity[1:].isdigit():
+        qid = int(linked_entity[1:])
+        if qid <= 0x7FFFFFFF:
+            return qid
+    return unlinked_qid
+
+
+def read_linking(filename):
+    """
+    Reads a linking csv written by wikidata_entity_linker.py.
+
+    :return: A tuple<Dictionary<label, int QID>, int>. The second value counts the linked entities which can not be
+        represented as int QID (they are exported as unlinked).
+    """
+    linking = dict()
+    not_representable = 0
+    with open(filename, "r") as linking_file:
+        reader = csv.reader(linking_file)
+        next(reader, None)
+        for row in reader:
+            if row[0] in linking:
+                continue
+            qid = qid_to_int(row[1])
+            if qid == unlinked_qid:
+                not_representable += 1
+            linking[row[0]] = qid
+    return linking, not_representable
+
+
+def read_model_labels(filename, model_format='csv', delimiter=' ', quotechar=''):
+    """
+    Iterates over the labels of a model file in row order.
+
+    :param model_format: 'csv' reads the first column of a csv file with a header row, exactly like
+        wikidata_entity_linker.py does. All other formats are embedding files read by vocabulary_reader.
+    """
+    if model_format != 'csv':
+        yield from read_vocabulary(filename, model_format)
+        return
+
+    quoting = csv.QUOTE_NONE if quotechar == "" else csv.QUOTE_MINIMAL
+    with open(filename, "r") as model_file:
+        reader = csv.reader(model_file, delimiter=delimiter, quoting=quoting, quotechar=quotechar or None)
+        next(reader)
+        for row in reader:
+            yield row[0]
+
+
+class AlignedLinking:
+    """
+    A linking aligned to the rows of a model file, stored in columns:
+        - qids: the int QID of every row (unlinked_qid if the row has not been linked),
+        - mask: 1 for every linked row, 0 otherwise,
+        - label_ids: the index of the label of every row into labels,
+        - labels: every distinct label once (interned), in order of first occurrence.
+    """
+
+    def __init__(self):
+        self.qids = array('i')
+        self.mask = bytearray()
+        self.label_ids = array('i')
+        self.labels = []
+        self._label_index = dict()
+        self.not_in_model = 0
+
+    def __len__(self):
+        return len(self.qids)
+
+    def linked_rows(self):
+        return sum(self.mask)
+
+    def add(self, label, qid):
+        label_id = self._label_index.get(label, None)
+        if label_id is None:
+            label_id = len(self.labels)
+            self.labels.append(label)
+            self._label_index[label] = label_id
+
+        self.qids.append(qid)
+        self.mask.append(qid != unlinked_qid)
+        self.label_ids.append(label_id)
+
+    @classmethod
+    def align(cls, labels, linking):
+        """
+
+        :param labels: Iterable of the labels of the model in row order.
+        :param linking: Dictionary<label, int QID> as returned by read_linking.
+        """
+        aligned_linking = cls()
+        found_labels = set()
+        for label in labels:
+            qid = linking.get(label, unlinked_qid)
+            if qid != unlinked_qid:
+                found_labels.add(label)
+            aligned_linking.add(label, qid)
+
+        # usually caused by exporting the linking of another model
+        aligned_linking.not_in_model = sum(1 for label, qid in linking.items()
+                                           if qid != unlinked_qid and label not in found_labels)
+        return aligned_linking
+
+    def label_table(self):
+        """
+        :return: A tuple<array of int64 offsets, bytes>. Label i is the UTF-8 string bytes[offsets[i]:offsets[i + 1]].
+        """
+        offsets = array('q', [0])
+        label_bytes = bytearray()
+        for label in self.labels:
+            label_bytes += label.encode('utf-8')
+            offsets.append(len(label_bytes))
+        return offsets, bytes(label_bytes)
+
+
+def _little_endian(values):
+    if sys.byteorder == 'big' and isinstance(values, array):
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+def write_npy(filename, values, dtype):
+    """
+    Writes a one dimensional array in the .npy format (version 1.0), so it can be read using numpy.load (also
+    memory mapped) without numpy being needed here.
+
+    :param values: array or bytes-like object whose items match dtype.
+    :param dtype: Little endian numpy type string, e.g. '<i4'.
+    """
+    item_size = int(dtype[2:])
+    data = memoryview(_little_endian(values)).cast('B')
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (dtype, len(data) // item_size)
+    # the data starts at a multiple of 64 bytes, the header ends with a newline
+    header += ' ' * (63 - (10 + len(header)) % 64) + '\n'
+    with open(filename, 'wb') as file:
+        file.write(b'\x93NUMPY\x01\x00')
+        file.write(len(header).to_bytes(2, 'little'))
+        file.write(header.encode('latin1'))
+        file.write(data)
+
+
+def write_npy_export(directory, aligned_linking, metadata):
+    """
+    Writes aligned_linking as .npy files (see _npy_files) and a metadata.json into directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    label_offsets, label_bytes = aligned_linking.label_table()
+    columns = {'qids': aligned_linking.qids, 'mask': aligned_linking.mask, 'label_ids': aligned_linking.label_ids,
+               'label_offsets': label_offsets, 'label_bytes': label_bytes}
+    for name, (filename, dtype) in _npy_files.items():
+        write_npy(os.path.join(directory, filename), columns[name], dtype)
+
+    metadata = dict(metadata, files={name: filename for name, (filename, _) in _npy_files.items()})
+    with open(os.path.join(directory, 'metadata.json'), 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+
+
+def _arrow_table(aligned_linking, metadata):
+    import pyarrow
+
+    def column(values, arrow_type):
+        return pyarrow.Array.from_buffers(arrow_type, len(aligned_linking),
+                                          [None, pyarrow.py_buffer(_little_endian(values))])
+
+    labels = pyarrow.DictionaryArray.from_arrays(column(aligned_linking.label_ids, pyarrow.int32()),
+                                                 pyarrow.array(aligned_linking.labels, pyarrow.string()))
+    schema_metadata = {'linking_export': json.dumps(metadata)}
+    return pyarrow.table({'label': labels,
+                          'qid': column(aligned_linking.qids, pyarrow.int32()),
+                          'linked': column(aligned_linking.mask, pyarrow.uint8()).cast(pyarrow.bool_())}
+                         ).replace_schema_metadata(schema_metadata)
+
+
+def write_arrow_export(filename, aligned_linking, metadata):
+    """
+    Writes aligned_linking as uncompressed Arrow IPC file (Feather v2), which can be memory mapped. The labels are
+    dictionary encoded.
+    """
+    from pyarrow import feather
+
+    feather.write_feather(_arrow_table(aligned_linking, metadata), filename, compression='uncompressed')
+
+
+def write_parquet_export(filename, aligned_linking, metadata):
+    from pyarrow import parquet
+
+    parquet.write_table(_arrow_table(aligned_linking, metadata), filename)
+
+
+class LinkingExport:
+    """
+    Read access to an export written by write_npy_export. The columns are numpy arrays (memory mapped by default),
+    labels are decoded on access.
+    """
+
+    def __init__(self, directory, mmap_mode='r'):
+        import numpy
+
+        with open(os.path.join(directory, 'metadata.json'), 'r') as metadata_file:
+            self.metadata = json.load(metadata_file)
+        columns = {name: numpy.load(os.path.join(directory, filename), mmap_mode=mmap_mode)
+                   for name, filename in self.metadata['files'].items()}
+        self.qids = columns['qids']
+        self.mask = columns['mask']
+        self.label_ids = columns['label_ids']
+        self._label_offsets = columns['label_offsets']
+        self._label_bytes = columns['label_bytes']
+
+    def __len__(self):
+        return len(self.qids)
+
+    def label(self, row):
+        """
+        :return: The label of row of the model.
+        """
+        label_id = self.label_ids[row]
+        start, end = self._label_offsets[label_id], self._label_offsets[label_id + 1]
+        return self._label_bytes[start:end].tobytes().decode('utf-8')
+
+
+def default_output(linking_filename, export_format):
+    root, _ = os.path.splitext(linking_filename)
+    return root + ('.npy-export' if export_format == 'npy' else f".{export_format}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports a linking written by wikidata_entity_linker.py as columns '
+                                                 'aligned to the rows of its model file: an int32 QID per row '
+                                                 f'({unlinked_qid} if the row is not linked), a boolean mask of the '
+                                                 'linked rows and the index of every row into a table of interned '
+                                                 'labels. Row i of the export belongs to row i of the embedding '
+                                                 'matrix, so no parsing or joining by string is needed.')
+    parser.add_argument('model', help="model file the linking was created from")
+    parser.add_argument('linking', help="csv file written by wikidata_entity_linker.py")
+    parser.add_argument('-o', '--output', help="output directory (npy) or file (arrow, parquet). (default: the "
+                                               "linking with the suffix '.npy-export', '.arrow' or '.parquet')",
+                        default=None)
+    parser.add_argument('-f', '--format', help="'npy' writes one .npy file per column and a metadata.json, which "
+                                               "numpy.load can memory map and which needs no further dependency. "
+                                               "'arrow' (memory mappable Feather v2) and 'parquet' write a table "
+                                               "with the columns label, qid and linked and require pyarrow "
+                                               "(default='npy')", choices=export_formats, default='npy')
+    parser.add_argument('--model-format', help="'csv' reads the first column of a csv file with header row like "
+                                               "wikidata_entity_linker.py, the other formats read the tokens of an "
+                                               "embedding file (default='csv')", choices=model_formats,
+                        default='csv')
+    parser.add_argument('-d', '--delimiter', help="delimiter of the csv model file (default=' ')", default=' ')
+    parser.add_argument('-q', '--quotechar', help='quote character of the csv model file (default="")', default="")
+
+    args_dict = vars(parser.parse_args())
+
+    export_format = args_dict['format']
+    output = args_dict['output'] or default_output(args_dict['linking'], export_format)
+
+    linking, not_representable = read_linking(args_dict['linking'])
+    aligned_linking = AlignedLinking.align(read_model_labels(args_dict['model'], args_dict['model_format'],
+                                                             args_dict['delimiter'], args_dict['quotechar']),
+                                           linking)
+    metadata = {'model': os.path.abspath(args_dict['model']), 'linking': os.path.abspath(args_dict['linking']),
+                'rows': len(aligned_linking), 'linked_rows': aligned_linking.linked_rows(),
+                'labels': len(aligned_linking.labels), 'unlinked_qid': unlinked_qid}
+
+    if export_format == 'npy':
+        write_npy_export(output, aligned_linking, metadata)
+    elif export_format == 'arrow':
+        write_arrow_export(output, aligned_linking, metadata)
+    else:
+        write_parquet_export(output, aligned_linking, metadata)
+
+    print(f"{len(aligned_linking)} rows exported to {output}, {metadata['linked_rows']} linked, "
+          f"{len(aligned_linking.labels)} distinct labels")
+    if not_representable:
+        print(f"{not_representable} linked entities are no int32 QIDs and have been exported as unlinked")
+    if aligned_linking.not_in_model:
+        print(f"{aligned_linking.not_in_model} labels of the linking are not part of the model")
@@ -0,0 +1,578 @@
+import asyncio
+import json
+import os
+import queue
+import threading
+
+from deduplication import ANSWERED, COLLAPSED
+from http_cassette import CassetteMiss
+from metrics import shared_metrics
+
+# marks rows which produce no output (entities which can not be requested, batches which failed)
+_no_output = object()
+_end_of_stream = None
+
+
+class _AnsweredResults(list):
+    """
+    Results the reader took from the deduplicator, they belong to no forwarded row.
+    """
+
+
+class _RowWindow:
+    """
+    Limits the number of rows between the reader and the writer, which bounds the memory of all queues and of the
+    reorder buffer of the writer.
+    """
+
+    def __init__(self, max_rows):
+        self._max_rows = max_rows
+        self._rows = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, rows, aborted):
+        with self._condition:
+            # a single chunk may exceed the window, it is admitted once all other rows have left the pipeline
+            while self._rows > 0 and self._rows + rows > self._max_rows and not aborted.is_set():
+                self._condition.wait(0.1)
+            self._rows += rows
+
+    def release(self, rows):
+        with self._condition:
+            self._rows -= rows
+            self._condition.notify_all()
+
+
+class RunCheckpoint:
+    """
+    Records how many rows of the model have been written and the size of every output file at that point. Resuming
+    truncates the output files to these sizes, which removes rows written after the checkpoint, and skips the rows
+    which have already been written.
+    """
+
+    def __init__(self, filename, model_filename, output_filenames):
+        self.filename = filename
+        self.model_filename = model_filename
+        self.output_filenames = output_filenames
+        self._files = None
+
+    def load(self):
+        """
+        Truncates the output files to the state of the last checkpoint.
+
+        :return: Number of rows which have been written by the previous run or None if there is no checkpoint.
+        """
+        if not os.path.exists(self.filename):
+            return None
+
+        with open(self.filename, 'r') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+
+        if checkpoint['model'] != os.path.abspath(self.model_filename):
+            raise Exception(f"Checkpoint {self.filename} belongs to {checkpoint['model']}, not to "
+                            f"{self.model_filename}.")
+
+        for output_filename, size in zip(self.output_filenames, checkpoint['output_sizes']):
+            if not os.path.exists(output_filename) or os.path.getsize(output_filename) < size:
+                raise Exception(f"{output_filename} is smaller than recorded in checkpoint {self.filename}.")
+            os.truncate(output_filename, size)
+
+        return checkpoint['rows_written']
+
+    def attach(self, files):
+        """
+
+        :param files: Open output files, in the same order as output_filenames.
+        """
+        self._files = files
+
+    def save(self, rows_written):
+        output_sizes = []
+        for file in self._files:
+            file.flush()
+            os.fsync(file.fileno())
+            output_sizes.append(file.tell())
+
+        # write and rename, so a crash never leaves a partial checkpoint
+        temporary_filename = self.filename + '.tmp'
+        with open(temporary_filename, 'w') as checkpoint_file:
+            json.dump({'model': os.path.abspath(self.model_filename), 'rows_written': rows_written,
+                       'output_sizes': output_sizes}, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temporary_filename, self.filename)
+
+
+class PipelineStatistics:
+
+    def __init__(self):
+        self.rows_read = 0
+        self.rows_written = 0
+        self.rows_skipped = 0
+        self.cache_hits = 0
+        self.deduplicated_rows = 0
+        self.requested_entities = 0
+        self.linked_rows = 0
+        self.not_found_rows = 0
+        self.failed_rows = 0
+
+    def __str__(self):
+        return f"{self.rows_skipped} rows skipped (written by a previous run), {self.rows_read} rows read, " \
+               f"{self.deduplicated_rows} duplicate rows collapsed, {self.cache_hits} cache hits, " \
+               f"{self.requested_entities} entities " \
+               f"requested, {self.linked_rows} rows linked, {self.not_found_rows} rows not found, " \
+               f"{self.failed_rows} rows failed"
+
+
+class LinkingPipeline:
+    """
+    Links a stream of entities in stages connected by bounded queues:
+
+        reader -> cache filter -> batcher -> network workers -> writer
+                       |                                          ^
+                       +------------------------------------------+
+
+    The reader numbers every row and passes chunks of rows on. If a deduplicator is given, the reader only passes the
+    first row of every lookup key on, the writer fans its result out to the rows with the same key. The cache filter answers cached entities in bulk and
+    forwards only uncached ones. The batcher packs them into full batches of unique entities. The network workers
+    request these batches (one thread per worker, or a single event loop when using an async linker). The writer
+    writes the linking and the not found entities, optionally in input order.
+
+    Full queues block the stages in front of them, and the number of rows inside the pipeline is limited by
+    max_rows_in_flight, so memory usage does not depend on the size of the input.
+    """
+
+    def __init__(self, proxy_factory, persistent_entity_linker, output_file_writer, not_found_entities_file_writer,
+                 entities_per_request=50, batch_sizer=None, workers=20, ordered=False, chunk_size=1000, queue_size=16,
+                 max_rows_in_flight=100000, max_in_flight=None, batch_timeout=0.1, progress_interval=10000,
+                 checkpoint=None, checkpoint_interval=10000, rows_skipped=0, deduplicator=None, cassette=None,
+                 metrics=None):
+        """
+
+        :param proxy_factory: Callable returning a WikidataEntityLinkerProxy. Every network worker gets its own proxy.
+        :param persistent_entity_linker: Cache used by the cache filter.
+        :param batch_sizer: AdaptiveBatchSizer deciding how many entities the batcher packs into a batch. If None,
+            batches contain entities_per_request entities.
+        :param workers: Number of network worker threads. Ignored if max_in_flight is set.
+        :param ordered: Write the output in input order.
+        :param chunk_size: Number of rows the reader and the cache filter process at once.
+        :param queue_size: Capacity (in chunks/batches) of every queue.
+        :param max_rows_in_flight: Maximum number of rows which have been read but not written yet.
+        :param max_in_flight: If set, a single worker requests up to max_in_flight batches concurrently using
+            async_entity_ids of its proxy.
+        :param batch_timeout: Seconds the batcher waits for more entities before sending an incomplete batch.
+        :param progress_interval: Number of written rows after which the progress is printed (0 disables progress).
+        :param checkpoint: RunCheckpoint which is saved every checkpoint_interval written rows and after the last row.
+            Requires ordered output, because a checkpoint can only describe a contiguous range of rows.
+        :param rows_skipped: Number of rows which have been written by a previous run and are not passed to run.
+        :param deduplicator: RowDeduplicator collapsing rows with the same lookup key. If None, every row is looked
+            up (duplicates within a batch are still requested once).
+        :param cassette: HttpCassette the linker records to or replays from. Recording, the rows of failed batches
+            are recorded. Replaying, they fail again, and a batch containing entities which have not been recorded
+            fails only for them, so the replayed run writes the output of the recorded one whatever its batches are.
+        :param metrics: MetricsRegistry to report to. If None, the registry shared by the whole process is used.
+        """
+        if checkpoint is not None and not ordered:
+            raise Exception("Checkpoints require ordered output.")
+
+        self._proxy_factory = proxy_factory
+        self._persistent_entity_linker = persistent_entity_linker
+        self._output_file_writer = output_file_writer
+        self._not_found_entities_file_writer = not_found_entities_file_writer
+        self.entities_per_request = entities_per_request
+        self.batch_sizer = batch_sizer
+        self.workers = 1 if max_in_flight is not None else workers
+        self.ordered = ordered
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.batch_timeout = batch_timeout
+        self.progress_interval = progress_interval
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.rows_skipped = rows_skipped
+        self.deduplicator = deduplicator
+        self.cassette = cassette
+
+        self._cache_queue = queue.Queue(queue_size)
+        self._batch_queue = queue.Queue(queue_size)
+        self._network_queue = queue.Queue(queue_size)
+        self._write_queue = queue.Queue(queue_size)
+        self._window = _RowWindow(max_rows_in_flight)
+        self._aborted = threading.Event()
+        self._errors = []
+        self.statistics = PipelineStatistics()
+
+        metrics = metrics if metrics is not None else shared_metrics
+        self._rows_read = metrics.counter('pipeline_rows_read_total', "Rows read from the model")
+        self._rows_deduplicated = metrics.counter('pipeline_rows_deduplicated_total', "Rows sharing the result of "
+                                                                                      "an earlier row with the same "
+                                                                                      "lookup key (collapsed, "
+                                                                                      "answered)", ('action',))
+        self._rows_written = metrics.counter('pipeline_rows_written_total', "Rows written by result (linked, "
+                                                                            "not_found, failed)",
+                                             ('result',))
+        self._stage_seconds = metrics.histogram('pipeline_stage_seconds', "Time spent per chunk/batch in a stage "
+                                                                          "(cache_filter, network, write, checkpoint)", ('stage',))
+        for name, stage_queue in (('cache_filter', self._cache_queue), ('batcher', self._batch_queue),
+                                  ('network', self._network_queue), ('writer', self._write_queue)):
+            metrics.gauge(f'pipeline_{name}_queue_length', f"Items waiting in the input queue of the {name} stage",
+                          stage_queue.qsize)
+
+    def _batch_size(self):
+        if self.batch_sizer is None:
+            return self.entities_per_request
+        return min(self.entities_per_request, self.batch_sizer.size())
+
+    def _put(self, target_queue, item):
+        while not self._aborted.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, source_queue, timeout=None):
+        """
+
+        :return: The next item, _end_of_stream if the pipeline was aborted or raises queue.Empty after timeout.
+        """
+        waited = 0.0
+        while not self._aborted.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                waited += 0.1
+                if timeout is not None and waited >= timeout:
+                    raise
+        return _end_of_stream
+
+    def _stage(self, target, *args):
+        def run():
+            try:
+                target(*args)
+            except BaseException as ex:
+                self._errors.append(ex)
+                self._aborted.set()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def _deduplicate(self, chunk):
+        """
+
+        :return: A tuple<list<row>, list<result>> containing the rows which have to be looked up and the results of
+            the rows the deduplicator answered. Collapsed rows are in neither list, the writer writes them.
+        """
+        forwarded_rows = []
+        results = _AnsweredResults()
+        for sequence_number, entity in chunk:
+            action, result = self.deduplicator.add(sequence_number, entity)
+            if action == ANSWERED:
+                results.append((sequence_number, entity, result))
+            elif action != COLLAPSED:
+                forwarded_rows.append((sequence_number, entity))
+
+        collapsed_rows = len(chunk) - len(forwarded_rows) - len(results)
+        self.statistics.deduplicated_rows += len(chunk) - len(forwarded_rows)
+        self._rows_deduplicated.inc(collapsed_rows, ('collapsed',))
+        self._rows_deduplicated.inc(len(results), ('answered',))
+        return forwarded_rows, results
+
+    def _pass_on(self, chunk):
+        # collapsed rows stay in the window until the writer has written them
+        self._window.acquire(len(chunk), self._aborted)
+        self._rows_read.inc(len(chunk))
+        if self.deduplicator is not None:
+            chunk, results = self._deduplicate(chunk)
+            if results:
+                self._put(self._write_queue, results)
+        if chunk:
+            self._put(self._cache_queue, chunk)
+
+    def _read(self, entities):
+        chunk = []
+        sequence_number = 0
+        for entity in entities:
+            chunk.append((sequence_number, entity))
+            sequence_number += 1
+            if len(chunk) == self.chunk_size:
+                self._pass_on(chunk)
+                chunk = []
+            if self._aborted.is_set():
+                return
+
+        if chunk:
+            self._pass_on(chunk)
+        self.statistics.rows_read = sequence_number
+        self._put(self._cache_queue, _end_of_stream)
+
+    def _filter_cached(self):
+        while True:
+            chunk = self._get(self._cache_queue)
+            if chunk is _end_of_stream:
+                self._put(self._batch_queue, _end_of_stream)
+                self._put(self._write_queue, _end_of_stream)
+                return
+
+            with self._stage_seconds.time(('cache_filter',)):
+                results, not_cached_rows = self._filter_chunk(chunk)
+
+            self.statistics.cache_hits += len(chunk) - len(not_cached_rows)
+            if results:
+                self._put(self._write_queue, results)
+            if not_cached_rows:
+                self._put(self._batch_queue, not_cached_rows)
+
+    def _filter_chunk(self, chunk):
+        """
+
+        :return: A tuple<list<result>, list<row>> containing the results of all cached rows and the rows which have to
+            be requested.
+        """
+        results = []
+        not_found_entities = set()
+        linked_entities, _ = self._persistent_entity_linker.cached_entity_ids([entity for _, entity in chunk],
+                                                                              not_found_entities)
+        not_cached_rows = []
+        for sequence_number, entity in chunk:
+            if entity in linked_entities:
+                results.append((sequence_number, entity, linked_entities[entity]))
+            elif entity in not_found_entities:
+                results.append((sequence_number, entity, None))
+            else:
+                not_cached_rows.append((sequence_number, entity))
+
+        return results, not_cached_rows
+
+    def _batch(self):
+        # Dictionary<entity, list<sequence number>>, duplicate entities are requested once
+        batch = dict()
+        while True:
+            try:
+                rows = self._get(self._batch_queue, timeout=self.batch_timeout if batch else None)
+            except queue.Empty:
+                # send incomplete batches instead of waiting for rows which are held back by the writer
+                self._put(self._network_queue, batch)
+                batch = dict()
+                continue
+
+            if rows is _end_of_stream:
+                if batch:
+                    self._put(self._network_queue, batch)
+                for _ in range(self.workers):
+                    self._put(self._network_queue, _end_of_stream)
+                return
+
+            for sequence_number, entity in rows:
+                batch.setdefault(entity, []).append(sequence_number)
+                if len(batch) >= self._batch_size():
+                    self._put(self._network_queue, batch)
+                    batch = dict()
+
+    def _results(self, batch, linked_entities, failed_rows=()):
+        self.statistics.requested_entities += len(batch)
+        results = []
+        for entity, sequence_numbers in batch.items():
+            linked_entity = linked_entities.get(entity, None) if linked_entities is not None else _no_output
+            for sequence_number in sequence_numbers:
+                results.append((sequence_number, entity,
+                                linked_entity if sequence_number not in failed_rows else _no_output))
+        return results
+
+    def _link_batches(self):
+        proxy = self._proxy_factory()
+        while True:
+            batch = self._get(self._network_queue)
+            if batch is _end_of_stream:
+                self._put(self._write_queue, _end_of_stream)
+                return
+
+            entities, failed_rows = self._replay_failures(batch)
+            linked_entities = dict()
+            while entities:
+                try:
+                    with self._stage_seconds.time(('network',)):
+                        linked_entities = proxy.entity_ids(entities, set())
+                except Exception as ex:
+                    if self._fail_missed_entities(ex, batch, entities, failed_rows):
+                        continue
+                    print(f"{'|'.join(entities)} caused exception: {ex}")
+                    self._record_failures(batch, entities)
+                    linked_entities = None
+                break
+            self._put(self._write_queue, self._results(batch, linked_entities, failed_rows))
+
+    def _replay_failures(self, batch):
+        """
+        :return: A tuple<list, set> containing the entities of batch which have to be linked and the sequence numbers
+            of the rows which fail, because they failed in the recorded run which is replayed.
+        """
+        if self.cassette is None or self.cassette.mode != 'replay':
+            return list(batch.keys()), set()
+        failed_rows = self.cassette.failed_rows([sequence_number for sequence_numbers in batch.values()
+                                                 for sequence_number in sequence_numbers])
+        return [entity for entity, sequence_numbers in batch.items() if not failed_rows.issuperset(sequence_numbers)], \
+            failed_rows
+
+    def _record_failures(self, batch, entities):
+        if self.cassette is not None and self.cassette.mode == 'record':
+            self.cassette.record_failures([sequence_number for entity in entities for sequence_number in batch[entity]])
+
+    @staticmethod
+    def _fail_missed_entities(exception, batch, entities, failed_rows):
+        """
+        A replayed batch fails only for the entities which have not been recorded: they are removed from entities and
+        their rows are added to failed_rows.
+
+        :return: True if the remaining entities have to be linked again.
+        """
+        if not isinstance(exception, CassetteMiss):
+            return False
+        missed_entities = set(exception.values).intersection(entities)
+        if not missed_entities or len(missed_entities) == len(entities):
+            return False
+        failed_rows.update(sequence_number for entity in missed_entities for sequence_number in batch[entity])
+        entities[:] = [entity for entity in entities if entity not in missed_entities]
+        return True
+
+    def _link_batches_async(self):
+        asyncio.run(self._async_link_batches())
+
+    async def _async_link_batches(self):
+        proxy = self._proxy_factory()
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        async def link_batch(batch):
+            try:
+                entities, failed_rows = self._replay_failures(batch)
+                linked_entities = dict()
+                while entities:
+                    try:
+                        with self._stage_seconds.time(('network',)):
+                            linked_entities = await proxy.async_entity_ids(entities, set())
+                    except Exception as ex:
+                        if self._fail_missed_entities(ex, batch, entities, failed_rows):
+                            continue
+                        print(f"{'|'.join(entities)} caused exception: {ex}")
+                        self._record_failures(batch, entities)
+                        linked_entities = None
+                    break
+            finally:
+                semaphore.release()
+            await loop.run_in_executor(None, self._put, self._write_queue,
+                                       self._results(batch, linked_entities, failed_rows))
+
+        tasks = set()
+        while True:
+            batch = await loop.run_in_executor(None, self._get, self._network_queue)
+            if batch is _end_of_stream:
+                break
+
+            await semaphore.acquire()
+            task = asyncio.ensure_future(link_batch(batch))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
+        self._put(self._write_queue, _end_of_stream)
+
+    def _write_result(self, entity, linked_entity):
+        if linked_entity is _no_output:
+            self.statistics.failed_rows += 1
+            self._rows_written.inc(labels=('failed',))
+        elif linked_entity is None:
+            self._not_found_entities_file_writer.writerow([entity])
+            self.statistics.not_found_rows += 1
+            self._rows_written.inc(labels=('not_found',))
+        else:
+            self._output_file_writer.writerow([entity, linked_entity.linked_entity])
+            self.statistics.linked_rows += 1
+            self._rows_written.inc(labels=('linked',))
+
+        self.statistics.rows_written += 1
+        if self.progress_interval and self.statistics.rows_written % self.progress_interval == 0:
+            print(f"{self.statistics.rows_written} entities processed")
+
+    def _fan_out(self, results):
+        """
+        :return: results and the results of the rows which have been collapsed into them.
+        """
+        fanned_out_results = list(results)
+        for _, entity, linked_entity in results:
+            collapsed_rows = self.deduplicator.complete(entity, linked_entity, failed=linked_entity is _no_output)
+            fanned_out_results.extend((sequence_number, collapsed_entity, linked_entity)
+                                      for sequence_number, collapsed_entity in collapsed_rows)
+        return fanned_out_results
+
+    def _write(self):
+        # the cache filter and every network worker signal the end of their stream
+        running_stages = 1 + self.workers
+        reorder_buffer = dict()
+        next_sequence_number = 0
+        last_checkpoint = 0
+        # checkpoints must not pass rows which failed, otherwise a resumed run would never request them again
+        checkpointing = self.checkpoint is not None
+
+        while running_stages > 0:
+            results = self._get(self._write_queue)
+            if results is _end_of_stream:
+                running_stages -= 1
+                continue
+
+            if self.deduplicator is not None and not isinstance(results, _AnsweredResults):
+                results = self._fan_out(results)
+
+            if not self.ordered:
+                with self._stage_seconds.time(('write',)):
+                    for sequence_number, entity, linked_entity in results:
+                        self._write_result(entity, linked_entity)
+                self._window.release(len(results))
+                continue
+
+            for sequence_number, entity, linked_entity in results:
+                reorder_buffer[sequence_number] = (entity, linked_entity)
+
+            written_rows = 0
+            with self._stage_seconds.time(('write',)):
+                while next_sequence_number in reorder_buffer:
+                    entity, linked_entity = reorder_buffer.pop(next_sequence_number)
+                    if checkpointing and linked_entity is _no_output:
+                        self.checkpoint.save(self.rows_skipped + next_sequence_number)
+                        checkpointing = False
+                    self._write_result(entity, linked_entity)
+                    next_sequence_number += 1
+                    written_rows += 1
+            self._window.release(written_rows)
+
+            if checkpointing and next_sequence_number - last_checkpoint >= self.checkpoint_interval:
+                with self._stage_seconds.time(('checkpoint',)):
+                    self.checkpoint.save(self.rows_skipped + next_sequence_number)
+                last_checkpoint = next_sequence_number
+
+        if checkpointing:
+            self.checkpoint.save(self.rows_skipped + next_sequence_number)
+
+    def run(self, entities):
+        """
+        Links all entities.
+
+        :param entities: Iterable of entities (strings), for example the first column of a model file.
+        :return: PipelineStatistics of the run.
+        """
+        self.statistics.rows_skipped = self.rows_skipped
+        link_batches = self._link_batches_async if self.max_in_flight is not None else self._link_batches
+        stages = [self._stage(self._read, entities), self._stage(self._filter_cached), self._stage(self._batch)]
+        stages += [self._stage(link_batches) for _ in range(self.workers)]
+        writer = self._stage(self._write)
+
+        writer.join()
+        self._aborted.set()
+        for stage in stages:
+            stage.join()
+
+        if self._errors:
+            raise self._errors[0]
+        return self.statistics
@@ -1,82 +1,317 @@
+import argparse
 import csv
-import mysql.connector
-
-def missing_in_cache():
-    source_set = set()
-    cache_set = set()
-    with open("living_people_wikipedia_page_id.csv") as source_file, open("living_people_cache.csv") as cache_file:
-        source_reader = csv.reader(source_file)
-        next(source_reader)
-        cache_reader = csv.reader(cache_file)
-        next(cache_reader)
-
-        for row in source_reader:
-            source_set.add(row[0])
-
-        for row in cache_reader:
-            cache_set.add(row[0])
-
-    diff = source_set.difference(cache_set);
-
-    for i in diff:
-        print(i)
-
-def list_incorrectly_linked_entities():
-    connection = mysql.connector.connect(host='localhost',
-                             user='root',
-                             password='toor',
-                             database='mpss2019',
-                                         use_pure=True)
-
-    cursor = connection.cursor(prepared=True)
-    #query = "select pp_value from page_props where pp_propname='wikibase_item' and pp_page = %s and pp_value = %s;"
-    query = "select pp_value, title " \
-            "from page_props pp, living_people lv "\
-            "where pp.pp_propname='wikibase_item' and pp_page = lv.page_id"
-
-    with open("living_people_wikipedia_page_id.csv") as source_file, open("living_people_linking.csv") as linking_file:
-        source_reader = csv.reader(source_file)
-        next(source_reader)
-        linking_reader = csv.reader(linking_file)
-        next(linking_reader)
-        linking = dict()
+import functools
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
 
+from itertools import groupby
+from operator import itemgetter
+
+from entity_store import open_entity_store
+from merger import sorted_linking
+
+strategies = ('hash', 'sorted')
+
+# titles of the living people and the wikidata ids of their pages
+ground_truth_query = "select pp_value, title " \
+                     "from page_props pp, living_people lv " \
+                     "where pp.pp_propname='wikibase_item' and pp_page = lv.page_id"
+# pp_value is varbinary, hence the server sorts bytewise like python sorts the (ascii) ids of the linking
+sorted_ground_truth_query = ground_truth_query + " order by pp_value"
+
+issue_columns = ["issue", "embedding_label", "knowledgebase_id", "expected_label"]
+
+
+def _decode(value):
+    # mediawiki stores titles and page props as varbinary
+    return value.decode('utf-8') if isinstance(value, (bytes, bytearray)) else value
+
+
+def stream_query(connection, query, chunk_size=10000):
+    """
+    Iterates over the rows of query without loading the whole result. The rows are fetched in chunks of chunk_size
+    from an unbuffered (server-side) cursor.
+    """
+    cursor = connection.cursor()
+    try:
         cursor.execute(query)
-        records = cursor.fetchall()
-        true_dict = dict()
-
-        for record in records:
-            true_dict[record[0]] = record[1]
-
-        for row in linking_reader:
-            wikidata_id = row[1]
-            entity_name = row[0]
-            name_in_db = true_dict.get(wikidata_id, None)
-            if name_in_db is None:
-                print(f"{wikidata_id} not in db")
-            elif name_in_db != entity_name:
-                print(f"{wikidata_id} linked to {entity_name} instead of {name_in_db}")
-
-
-
-        #
-        # i = 0
-        # for row in source_reader:
-        #     i = i + 1;
-        #     if i%1000 == 0:
-        #         print(i)
-        #     name = row[0]
-        #     wikipedia_page_id = int(row[1])
-        #     wikidata_id = linking.get(name, None)
-        #     if wikidata_id is None:
-        #         #print(f"{name} not found.")
-        #         pass
-        #     else:
-        #         cursor.execute(query, (wikipedia_page_id, wikidata_id))
-        #         cursor.fetchone()
-        #         if cursor.rowcount <= 0:
-        #             print(f"{name}({wikipedia_page_id}) not found.")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            for row in rows:
+                yield tuple(_decode(value) for value in row)
+    finally:
+        cursor.close()
+
+
+class ValidationReport:
+    """
+    Counts the rows of a validated linking. Mismatches and ids missing in the database are written to issues_file as
+    they are found, so the report does not grow with the size of the linking.
+    """
+
+    def __init__(self, linking_filename, issues_file):
+        self.linking_filename = linking_filename
+        self.rows = 0
+        self.correct = 0
+        self.mismatched = 0
+        self.missing_in_db = 0
+        self._issues_writer = csv.writer(issues_file)
+        self._issues_writer.writerow(issue_columns)
+
+    def add(self, linked_entity, labels, titles):
+        """
+        Validates the labels linked to linked_entity against the titles the database knows for it.
+
+        :param labels: List of labels of the linking which were linked to linked_entity.
+        :param titles: List of titles of linked_entity in the database (empty if the database does not contain it).
+        """
+        for label in labels:
+            self.rows += 1
+            if not titles:
+                self.missing_in_db += 1
+                self._issues_writer.writerow(["missing_in_db", label, linked_entity, ""])
+            elif label in titles:
+                self.correct += 1
+            else:
+                self.mismatched += 1
+                self._issues_writer.writerow(["mismatch", label, linked_entity, titles[0]])
+
+    @property
+    def precision(self):
+        validated = self.correct + self.mismatched
+        return self.correct / validated if validated else 0.0
+
+    def to_dict(self):
+        return {'linking': self.linking_filename, 'rows': self.rows, 'correct': self.correct,
+                'mismatched': self.mismatched, 'missing_in_db': self.missing_in_db, 'precision': self.precision}
+
+
+def hash_join(linking_filename, ground_truth, report):
+    """
+    Validates a linking by building a hash table of its rows and streaming the ground truth through it. Only the
+    linking has to fit into memory, not the ground truth.
+
+    :param ground_truth: Iterable of tuple<linked entity, title> in any order.
+    """
+    labels = dict()
+    with open(linking_filename, "r") as linking_file:
+        reader = csv.reader(linking_file)
+        next(reader)
+        for row in reader:
+            labels.setdefault(row[1], []).append(row[0])
+
+    titles = dict()
+    for linked_entity, title in ground_truth:
+        if linked_entity in labels:
+            titles.setdefault(linked_entity, []).append(title)
+
+    for linked_entity, entity_labels in labels.items():
+        report.add(linked_entity, entity_labels, titles.get(linked_entity, []))
+
+
+def merge_join(sorted_rows, sorted_ground_truth, report):
+    """
+    Validates a linking by merging it with the ground truth. Neither side has to fit into memory.
+
+    :param sorted_rows: Iterable of tuple<label, linked entity> sorted by linked entity (see merger.sorted_linking).
+    :param sorted_ground_truth: Iterable of tuple<linked entity, title> sorted by linked entity.
+    """
+    truth_groups = groupby(sorted_ground_truth, key=itemgetter(0))
+    truth = next(truth_groups, None)
+    for linked_entity, rows in groupby(sorted_rows, key=itemgetter(1)):
+        while truth is not None and truth[0] < linked_entity:
+            truth = next(truth_groups, None)
+
+        titles = [title for _, title in truth[1]] if truth is not None and truth[0] == linked_entity else []
+        report.add(linked_entity, [label for label, _ in rows], titles)
+
+
+def report_filenames(linking_filename, reports_directory=None):
+    """
+    :return: A tuple<report filename, issues filename>, e.g. glove-linking.report.json and glove-linking.issues.csv
+        next to the linking or inside reports_directory.
+    """
+    root = os.path.splitext(linking_filename)[0]
+    if reports_directory is not None:
+        root = os.path.join(reports_directory, os.path.basename(root))
+    return f"{root}.report.json", f"{root}.issues.csv"
+
+
+def validate_linking(linking_filename, connect, strategy='hash', reports_directory=None, chunk_size=10000,
+                     max_rows_in_memory=5000000, temporary_directory=None):
+    """
+    Validates a linking against the living people of the database and writes its report and issues.
+
+    :param connect: Callable returning a new DB-API connection, e.g. functools.partial(mysql.connector.connect, ...).
+    :param strategy: 'hash' keeps the linking in memory, 'sorted' sorts it (externally if it has more than
+        max_rows_in_memory rows) and merges it with the ground truth sorted by the database.
+    :return: The report as dictionary.
+    """
+    if strategy not in strategies:
+        raise Exception(f"Unknown validation strategy {strategy}.")
+
+    report_filename, issues_filename = report_filenames(linking_filename, reports_directory)
+    connection = connect()
+    try:
+        with open(issues_filename, "w+") as issues_file:
+            report = ValidationReport(linking_filename, issues_file)
+            if strategy == 'hash':
+                hash_join(linking_filename, stream_query(connection, ground_truth_query, chunk_size), report)
+            else:
+                run_directory = tempfile.mkdtemp(dir=temporary_directory)
+                try:
+                    merge_join(sorted_linking(linking_filename, run_directory, max_rows_in_memory,
+                                              key=itemgetter(1)),
+                               stream_query(connection, sorted_ground_truth_query, chunk_size), report)
+                finally:
+                    shutil.rmtree(run_directory)
+    finally:
+        connection.close()
+
+    result = dict(report.to_dict(), strategy=strategy, issues=issues_filename)
+    with open(report_filename, "w+") as report_file:
+        json.dump(result, report_file, indent=2)
+    return result
+
+
+def _validate_linking_of_arguments(arguments):
+    linking_filename, keyword_arguments = arguments
+    return validate_linking(linking_filename, **keyword_arguments)
+
+
+def validate_linkings(linking_filenames, connect, processes=1, **keyword_arguments):
+    """
+    Validates several linkings, each in its own process (at most processes at a time) with its own connection.
+
+    :param connect: Picklable callable returning a new DB-API connection.
+    :return: Generator of the reports (see validate_linking) in the order of linking_filenames.
+    """
+    arguments = [(linking_filename, dict(keyword_arguments, connect=connect)) for linking_filename in linking_filenames]
+    if processes <= 1 or len(arguments) <= 1:
+        yield from map(_validate_linking_of_arguments, arguments)
+        return
+
+    with multiprocessing.Pool(min(processes, len(arguments))) as pool:
+        yield from pool.imap(_validate_linking_of_arguments, arguments)
+
+
+def missing_in_cache(source_filename, cache_filename, output_file, chunk_size=10000):
+    """
+    Writes the entities (first column) of source_filename which are not part of the cache to output_file. The source
+    is streamed and looked up in chunks, only the cache itself is loaded.
+
+    :return: A tuple<number of distinct source entities, number of missing entities>.
+    """
+    store = open_entity_store(cache_filename)
+    seen = set()
+    missing = 0
+    try:
+        with open(source_filename, "r") as source_file:
+            reader = csv.reader(source_file)
+            next(reader)
+            while True:
+                chunk = []
+                for row in reader:
+                    if row[0] not in seen:
+                        seen.add(row[0])
+                        chunk.append(row[0])
+                        if len(chunk) == chunk_size:
+                            break
+                if not chunk:
+                    break
+
+                cached = store.get_many(chunk)
+                for entity in chunk:
+                    if entity not in cached:
+                        missing += 1
+                        output_file.write(f"{entity}\n")
+    finally:
+        store.close()
+    return len(seen), missing
 
 
 if __name__ == '__main__':
-    list_incorrectly_linked_entities()
+    parser = argparse.ArgumentParser(description='Validates linkings of living people against the wikidata ids of '
+                                                 'their pages in a local mediawiki database.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    validate_parser = subparsers.add_parser('validate', help="validate linkings and write a report (<linking>"
+                                                             ".report.json) and the mismatched and missing rows "
+                                                             "(<linking>.issues.csv) per linking")
+    validate_parser.add_argument('linkings', help="csv files written by wikidata_entity_linker.py "
+                                                  "(default='living_people_linking.csv')", nargs='*',
+                                 default=["living_people_linking.csv"])
+    validate_parser.add_argument('-s', '--strategy', help="'hash' keeps a linking in memory and streams the database "
+                                                          "rows through it, 'sorted' sorts a linking by id and merges "
+                                                          "it with the rows sorted by the database (default='hash')",
+                                 choices=strategies, default='hash')
+    validate_parser.add_argument('-p', '--processes', help="number of linkings validated in parallel (default=1)",
+                                 default=1, type=int)
+    validate_parser.add_argument('-r', '--reports-directory', help="directory of the reports (default: the directory "
+                                                                   "of each linking)", default=None)
+    validate_parser.add_argument('--chunk-size', help="rows fetched from the database at once (default=10000)",
+                                 default=10000, type=int)
+    validate_parser.add_argument('--max-rows-in-memory', help="rows of a linking which are sorted in memory by the "
+                                                              "'sorted' strategy (default=5000000)", default=5000000,
+                                 type=int)
+    validate_parser.add_argument('--temporary-directory', help="directory for the sorted runs of large linkings "
+                                                               "(default: the system's temporary directory)",
+                                 default=None)
+    validate_parser.add_argument('--db-host', help="host of the mediawiki database (default='localhost')",
+                                 default='localhost')
+    validate_parser.add_argument('--db-user', help="user of the mediawiki database (default='root')", default='root')
+    validate_parser.add_argument('--db-password', help="password of the mediawiki database (default='toor')",
+                                 default='toor')
+    validate_parser.add_argument('--db-name', help="name of the mediawiki database (default='mpss2019')",
+                                 default='mpss2019')
+
+    missing_parser = subparsers.add_parser('missing-in-cache', help="list the entities of a source csv which are not "
+                                                                    "part of a cache")
+    missing_parser.add_argument('source', help="csv file whose first column contains the entities "
+                                               "(default='living_people_wikipedia_page_id.csv')", nargs='?',
+                                default="living_people_wikipedia_page_id.csv")
+    missing_parser.add_argument('cache', help="cache written by wikidata_entity_linker.py "
+                                              "(default='living_people_cache.csv')", nargs='?',
+                                default="living_people_cache.csv")
+    missing_parser.add_argument('-o', '--output', help="file to which the missing entities will be saved "
+                                                       "(default: stdout)", default=None)
+    missing_parser.add_argument('--chunk-size', help="entities looked up at once (default=10000)", default=10000,
+                                type=int)
+
+    args_dict = vars(parser.parse_args())
+
+    if args_dict['command'] == 'missing-in-cache':
+        output_file = sys.stdout if args_dict['output'] is None else open(args_dict['output'], "w+")
+        try:
+            source_entities, missing_entities = missing_in_cache(args_dict['source'], args_dict['cache'], output_file,
+                                                                 args_dict['chunk_size'])
+        finally:
+            if output_file is not sys.stdout:
+                output_file.close()
+        print(f"{missing_entities} of {source_entities} entities are missing in the cache", file=sys.stderr)
+        sys.exit(0)
+
+    import mysql.connector
+
+    if args_dict['reports_directory'] is not None:
+        os.makedirs(args_dict['reports_directory'], exist_ok=True)
+
+    connect = functools.partial(mysql.connector.connect, host=args_dict['db_host'], user=args_dict['db_user'],
+                                password=args_dict['db_password'], database=args_dict['db_name'], use_pure=True,
+                                # the merge join stops reading the ground truth after the last id of a linking
+                                consume_results=True)
+    for result in validate_linkings(args_dict['linkings'], connect, args_dict['processes'],
+                                    strategy=args_dict['strategy'], reports_directory=args_dict['reports_directory'],
+                                    chunk_size=args_dict['chunk_size'],
+                                    max_rows_in_memory=args_dict['max_rows_in_memory'],
+                                    temporary_directory=args_dict['temporary_directory']):
+        print(f"{result['linking']}: {result['correct']} correct, {result['mismatched']} mismatched, "
+              f"{result['missing_in_db']} missing in db (precision {result['precision']:.4f}), "
+              f"issues in {result['issues']}")
@@ -0,0 +1,117 @@
+import queue
+
+from contextlib import contextmanager
+
+from dump_entity_linker import TitleIndexEntityLinker
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of DB-API connections. Connections are opened lazily, at most size connections are opened.
+    """
+
+    def __init__(self, connect, size=20):
+        """
+
+        :param connect: Callable returning a new DB-API connection.
+        :param size: Maximum number of open connections.
+        """
+        self._connect = connect
+        self._connections = queue.LifoQueue()
+        self._available_slots = queue.Queue()
+        for _ in range(size):
+            self._available_slots.put(None)
+
+    @contextmanager
+    def connection(self):
+        self._available_slots.get()
+        try:
+            connection = self._connections.get_nowait()
+        except queue.Empty:
+            try:
+                connection = self._connect()
+            except Exception:
+                self._available_slots.put(None)
+                raise
+
+        try:
+            yield connection
+        finally:
+            self._connections.put(connection)
+            self._available_slots.put(None)
+
+    def close(self):
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def mysql_connection_pool(host, user, password, database, size=20):
+    import mysql.connector
+
+    return ConnectionPool(lambda: mysql.connector.connect(host=host, user=user, password=password, database=database,
+                                                          use_pure=True), size)
+
+
+class MediaWikiDatabaseEntityLinker(TitleIndexEntityLinker):
+    """
+    Links entities using the page, page_props and redirect tables of a local mediawiki mirror (the same database used
+    by linking_validator.py). Every batch is resolved with one query for the titles and one query for the redirects.
+    benchmarks/mediawiki_sqlite_check.py checks it against a SQLite copy of these tables.
+    """
+
+    max_parameters_per_query = 900
+
+    _titles_query = "SELECT p.page_title, item.pp_value, description.pp_value, disambiguation.pp_page " \
+                    "FROM page p " \
+                    "JOIN page_props item ON item.pp_page = p.page_id AND item.pp_propname = 'wikibase_item' " \
+                    "LEFT JOIN page_props description " \
+                    "ON description.pp_page = p.page_id AND description.pp_propname = 'wikibase-shortdesc' " \
+                    "LEFT JOIN page_props disambiguation " \
+                    "ON disambiguation.pp_page = p.page_id AND disambiguation.pp_propname = 'disambiguation' " \
+                    "WHERE p.page_namespace = 0 AND p.page_title IN ({})"
+
+    # interwiki redirects point to a page of another wiki, which may have the title of a local page (local redirects
+    # have an empty rd_interwiki, older databases store NULL)
+    _redirects_query = "SELECT p.page_title, r.rd_title " \
+                       "FROM page p JOIN redirect r ON r.rd_from = p.page_id " \
+                       "WHERE p.page_namespace = 0 AND r.rd_namespace = 0 " \
+                       "AND (r.rd_interwiki IS NULL OR r.rd_interwiki = '') AND p.page_title IN ({})"
+
+    def __init__(self, connection_pool, placeholder='%s'):
+        """
+
+        :param connection_pool: ConnectionPool shared by all threads using this linker.
+        :param placeholder: Parameter placeholder of the database driver ('%s' for mysql.connector, '?' for sqlite3).
+        """
+        self._connection_pool = connection_pool
+        self._placeholder = placeholder
+
+    @staticmethod
+    def _decode(value):
+        # mediawiki stores titles and page props as varbinary
+        return value.decode('utf-8') if isinstance(value, (bytes, bytearray)) else value
+
+    def _select(self, query, titles):
+        # mediawiki stores titles with underscores instead of spaces
+        keys = list({title.replace(' ', '_') for title in titles})
+        with self._connection_pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                for i in range(0, len(keys), self.max_parameters_per_query):
+                    chunk = keys[i:i + self.max_parameters_per_query]
+                    cursor.execute(query.format(','.join([self._placeholder] * len(chunk))), chunk)
+                    for row in cursor.fetchall():
+                        yield [self._decode(value) for value in row]
+            finally:
+                cursor.close()
+
+    def _select_titles(self, titles):
+        return {title.replace('_', ' '): (linked_entity, description, disambiguation is not None)
+                for title, linked_entity, description, disambiguation in self._select(self._titles_query, titles)}
+
+    def _select_redirects(self, titles):
+        return {title.replace('_', ' '): target.replace('_', ' ')
+                for title, target in self._select(self._redirects_query, titles)}
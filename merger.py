@@ -1,51 +1,158 @@
+import argparse
 import csv
+import heapq
+import os
+import shutil
+import tempfile
 
-if __name__ == '__main__':
-    fasttext_path = "wiki-news-300d-1M-linking.csv"
-    glove_path = "glove-linking.csv"
-    # output_fasttext_path = "fasttext-glove-linking.csv"
-    output_fasttext_path = "fasttext-glove-id-intersect-for-fasttext.csv"
-    output_glove_path = "fasttext-glove-id-intersect-for-glove.csv"
-
-    # dictionary QID, Tags
-    with open(fasttext_path, "r") as fasttext_file:
-        reader = csv.reader(fasttext_file)
-        next(reader)
-        fasttext_dict = dict()
-        for row in reader:
-            tag = row[0]
-            id = row[1]
-            tags = fasttext_dict.get(id, None)
-            if not tags:
-                tags = []
-                fasttext_dict[id] = tags
-            tags.append(tag)
-
-    with open(glove_path, "r") as glove_file:
-        reader = csv.reader(glove_file)
+from itertools import groupby
+
+
+def id_key(linked_entity):
+    """
+    Sort key of a linked entity: wikidata ids in numeric order (Q2 < Q10), other ids afterwards.
+    """
+    if linked_entity[:1] == 'Q' and linked_entity[1:].isdigit():
+        return 0, int(linked_entity[1:]), ''
+    return 1, 0, linked_entity
+
+
+def _row_key(row):
+    return id_key(row[1])
+
+
+def _read_run(filename):
+    with open(filename, "r") as run_file:
+        yield from csv.reader(run_file)
+
+
+def sorted_linking(filename, temporary_directory, max_rows_in_memory=5000000, key=_row_key):
+    """
+    Reads a linking csv in one pass and yields its rows (label, linked entity) sorted by linked entity. Labels of the
+    same linked entity keep their order of the file.
+
+    Files with more than max_rows_in_memory rows are sorted externally: sorted runs of max_rows_in_memory rows are
+    written to temporary_directory and merged afterwards.
+
+    :param key: Sort key of a row, id_key of the linked entity by default.
+    """
+    runs = []
+    with open(filename, "r") as linking_file:
+        reader = csv.reader(linking_file)
         next(reader)
-        glove_dict = dict()
+
+        rows = []
         for row in reader:
-            tag = row[0]
-            id = row[1]
-            tags = glove_dict.get(id, None)
-            if not tags:
-                tags = []
-                glove_dict[id] = tags
-            tags.append(tag)
-
-    intersecting_ids = set(fasttext_dict.keys()) & set(glove_dict.keys())
-
-    with open(output_fasttext_path, "w+") as output_file:
-        writer = csv.writer(output_file)
-        writer.writerow(["embedding_label", "knowledgebase_id"])
-        for id in intersecting_ids:
-            for tag in fasttext_dict[id]:
-                writer.writerow([tag, id])
-
-    with open(output_glove_path, "w+") as output_file:
-        writer = csv.writer(output_file)
-        writer.writerow(["embedding_label", "knowledgebase_id"])
-        for id in intersecting_ids:
-            for tag in glove_dict[id]:
-                writer.writerow([tag, id])
+            rows.append((row[0], row[1]))
+            if len(rows) == max_rows_in_memory:
+                rows.sort(key=key)
+                run_file, run_filename = tempfile.mkstemp(suffix='.csv', dir=temporary_directory)
+                with os.fdopen(run_file, "w") as run:
+                    csv.writer(run).writerows(rows)
+                runs.append(run_filename)
+                rows = []
+
+    rows.sort(key=key)
+    if not runs:
+        yield from rows
+        return
+
+    # heapq.merge is stable, hence labels of the same id stay in file order when the runs are passed in file order
+    yield from heapq.merge(*[_read_run(run) for run in runs], iter(rows), key=key)
+    for run in runs:
+        os.remove(run)
+
+
+def merge_linkings(streams, min_inputs):
+    """
+    Joins sorted linkings on their linked entities.
+
+    :param streams: List of iterables of rows sorted by id_key of the linked entity (see sorted_linking).
+    :param min_inputs: Minimum number of inputs a linked entity has to occur in (len(streams) for the intersection,
+        1 for the union).
+    :return: Generator of tuple<linked entity, list<list<label>>>, containing the labels of every input (empty lists
+        for inputs not containing the linked entity) in id order.
+    """
+    groups = [groupby(stream, key=lambda row: row[1]) for stream in streams]
+    current = [next(group, None) for group in groups]
+
+    while True:
+        keys = [id_key(group[0]) for group in current if group is not None]
+        if not keys:
+            return
+
+        smallest_key = min(keys)
+        linked_entity = None
+        labels = []
+        for i, group in enumerate(current):
+            if group is None or id_key(group[0]) != smallest_key:
+                labels.append([])
+                continue
+
+            linked_entity = group[0]
+            labels.append([label for label, _ in group[1]])
+            current[i] = next(groups[i], None)
+
+        if sum(1 for input_labels in labels if input_labels) >= min_inputs:
+            yield linked_entity, labels
+
+
+def default_output_filename(filename, mode_name):
+    root, extension = os.path.splitext(filename)
+    return f"{root}.{mode_name}{extension or '.csv'}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Selects the wikidata ids shared by several linkings (intersection, '
+                                                 'union or ids found in at least k linkings) and writes one output '
+                                                 'per linking. All outputs list the selected ids in the same order.')
+    parser.add_argument('linkings', help="csv files written by wikidata_entity_linker.py", nargs='+')
+    parser.add_argument('-o', '--outputs', help="output files, one per linking (default: the linking with the "
+                                                "suffix '.<mode>', e.g. glove-linking.intersection.csv)", nargs='+',
+                        default=None)
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument('-u', '--union', help="select ids found in any linking", action='store_true')
+    mode_group.add_argument('-k', '--at-least', help="select ids found in at least k linkings", type=int,
+                            default=None)
+    parser.add_argument('--max-rows-in-memory', help="rows per linking which are sorted in memory. Larger linkings "
+                                                     "are sorted externally (default=5000000)", default=5000000,
+                        type=int)
+    parser.add_argument('--temporary-directory', help="directory for the sorted runs of large linkings (default: "
+                                                      "the system's temporary directory)", default=None)
+
+    args_dict = vars(parser.parse_args())
+
+    linkings = args_dict['linkings']
+    if args_dict['union']:
+        min_inputs, mode_name = 1, 'union'
+    elif args_dict['at_least'] is not None:
+        min_inputs, mode_name = args_dict['at_least'], f"at-least-{args_dict['at_least']}-of-{len(linkings)}"
+        if not 1 <= min_inputs <= len(linkings):
+            parser.error(f"--at-least must be between 1 and {len(linkings)}")
+    else:
+        min_inputs, mode_name = len(linkings), 'intersection'
+
+    outputs = args_dict['outputs'] or [default_output_filename(linking, mode_name) for linking in linkings]
+    if len(outputs) != len(linkings):
+        parser.error("exactly one output per linking is required")
+
+    temporary_directory = tempfile.mkdtemp(dir=args_dict['temporary_directory'])
+    output_files = [open(output, "w+") for output in outputs]
+    try:
+        writers = [csv.writer(output_file) for output_file in output_files]
+        for writer in writers:
+            writer.writerow(["embedding_label", "knowledgebase_id"])
+
+        selected_ids = 0
+        streams = [sorted_linking(linking, temporary_directory, args_dict['max_rows_in_memory'])
+                   for linking in linkings]
+        for linked_entity, labels in merge_linkings(streams, min_inputs):
+            selected_ids += 1
+            for writer, input_labels in zip(writers, labels):
+                writer.writerows([label, linked_entity] for label in input_labels)
+    finally:
+        for output_file in output_files:
+            output_file.close()
+        shutil.rmtree(temporary_directory)
+
+    print(f"{selected_ids} ids selected ({mode_name})")
@@ -0,0 +1,308 @@
+import json
+import os
+import threading
+
+from bisect import bisect_left
+from time import perf_counter, time
+
+# upper bounds (seconds) of the latency buckets, from cache lookups (~10us) to throttled http requests (~1min)
+default_latency_buckets = (0.00001, 0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                           2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter:
+    """
+    Monotonically increasing value, optionally split by label values (e.g. one value per http status code).
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._values = dict()
+
+    def inc(self, amount=1, labels=()):
+        """
+
+        :param labels: Tuple of label values in the order of label_names.
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        """
+        :return: List of tuple<name suffix, labels, value>.
+        """
+        with self._lock:
+            return [('', labels, value) for labels, value in self._values.items()]
+
+
+class Gauge:
+    """
+    Value which is read from a callback whenever the metrics are exported, e.g. the length of a queue.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = ()
+        self._callback = callback
+
+    def samples(self):
+        return [('', (), self._callback())]
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_labels', '_start')
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(perf_counter() - self._start, self._labels)
+
+
+class Histogram:
+    """
+    Distribution of observed values (usually latencies in seconds) in fixed buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=default_latency_buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # Dictionary<labels, list<bucket counts..., count, sum>>
+        self._values = dict()
+
+    def observe(self, value, labels=()):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(labels, None)
+            if values is None:
+                values = [0] * (len(self.buckets) + 3)
+                self._values[labels] = values
+            values[bucket] += 1
+            values[-2] += 1
+            values[-1] += value
+
+    def time(self, labels=()):
+        """
+        Context manager observing the time spent inside of it.
+        """
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labels, values in self._values.items():
+                cumulative_count = 0
+                for upper_bound, count in zip(self.buckets + ('+Inf',), values):
+                    cumulative_count += count
+                    samples.append(('_bucket', labels + (str(upper_bound),), cumulative_count))
+                samples.append(('_count', labels, values[-2]))
+                samples.append(('_sum', labels, values[-1]))
+        return samples
+
+
+class _NullMetric:
+    """
+    Returned by a disabled registry. Every method does nothing, so instrumented code does not have to check whether
+    metrics are enabled.
+    """
+
+    def inc(self, amount=1, labels=()):
+        pass
+
+    def observe(self, value, labels=()):
+        pass
+
+    def time(self, labels=()):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_metric = _NullMetric()
+
+
+class MetricsRegistry:
+    """
+    Creates and collects all metrics of a process. Metrics are identified by their name, so every component asking
+    for the same name gets the same metric.
+
+    A disabled registry hands out no-op metrics. Components look up their metrics once when they are created, hence a
+    registry has to be enabled before the components using it are created.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._metrics = dict()
+        self.created = time()
+
+    def enable(self):
+        self.enabled = True
+
+    def _metric(self, name, create):
+        if not self.enabled:
+            return _null_metric
+
+        with self._lock:
+            metric = self._metrics.get(name, None)
+            if metric is None:
+                metric = create()
+                self._metrics[name] = metric
+            return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self._metric(name, lambda: Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=default_latency_buckets):
+        return self._metric(name, lambda: Histogram(name, help_text, label_names, buckets))
+
+    def gauge(self, name, help_text, callback):
+        """
+        Registers callback as the source of a gauge. A later registration of the same name replaces the callback.
+        """
+        if not self.enabled:
+            return _null_metric
+
+        with self._lock:
+            self._metrics[name] = Gauge(name, help_text, callback)
+            return self._metrics[name]
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def snapshot(self):
+        """
+        :return: Dictionary<metric name, value> suitable for json. Values split by labels are nested dictionaries
+            keyed by the label values joined with ','. Histograms contain count, sum and the bucket counts.
+        """
+        snapshot = {'timestamp': time(), 'uptime': time() - self.created}
+        for metric in self.metrics():
+            if metric.kind == 'histogram':
+                value = dict()
+                for suffix, labels, sample in metric.samples():
+                    key = ','.join(labels[:len(metric.label_names)])
+                    entry = value.setdefault(key, {'buckets': dict()})
+                    if suffix == '_bucket':
+                        entry['buckets'][labels[-1]] = sample
+                    else:
+                        entry[suffix[1:]] = sample
+            elif metric.label_names:
+                value = {','.join(str(label) for label in labels): sample for _, labels, sample in metric.samples()}
+            else:
+                value = sum(sample for _, _, sample in metric.samples())
+            snapshot[metric.name] = value
+        return snapshot
+
+    def prometheus_text(self):
+        """
+        :return: All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics():
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            label_names = metric.label_names + (('le',) if metric.kind == 'histogram' else ())
+            for suffix, labels, sample in metric.samples():
+                if suffix != '_bucket':
+                    labels = labels[:len(metric.label_names)]
+                label_text = ','.join(f'{name}="{value}"' for name, value in zip(label_names, labels))
+                lines.append(f"{metric.name}{suffix}{{{label_text}}} {sample}" if label_text else
+                             f"{metric.name}{suffix} {sample}")
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    """
+    Periodically writes the metrics of a registry to a file, either appending one json line per interval or
+    replacing the file with the Prometheus text format (as expected by the textfile collector of node_exporter).
+    """
+
+    formats = ('jsonl', 'prometheus')
+
+    def __init__(self, registry, filename, format='jsonl', interval=10.0):
+        if format not in self.formats:
+            raise Exception(f"Unknown metrics format {format}.")
+
+        self.registry = registry
+        self.filename = filename
+        self.format = format
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._export_periodically, daemon=True)
+        self._previous_snapshot = None
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the exporter and exports the final values.
+        """
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.export()
+
+    def _export_periodically(self):
+        while not self._stopped.wait(self.interval):
+            self.export()
+
+    def _rates(self, snapshot):
+        """
+        :return: Dictionary<metric name, increase per second> of all unlabeled counters since the last export.
+        """
+        previous_snapshot = self._previous_snapshot
+        if previous_snapshot is None:
+            previous_snapshot = {'timestamp': self.registry.created}
+
+        elapsed = snapshot['timestamp'] - previous_snapshot['timestamp']
+        if elapsed <= 0:
+            return dict()
+
+        rates = dict()
+        for metric in self.registry.metrics():
+            if metric.kind == 'counter' and not metric.label_names:
+                rates[metric.name] = (snapshot[metric.name] - previous_snapshot.get(metric.name, 0)) / elapsed
+        return rates
+
+    def export(self):
+        if self.format == 'jsonl':
+            snapshot = self.registry.snapshot()
+            snapshot['rates'] = self._rates(snapshot)
+            self._previous_snapshot = snapshot
+            with open(self.filename, 'a') as file:
+                file.write(json.dumps(snapshot) + '\n')
+            return
+
+        temporary_filename = self.filename + '.tmp'
+        with open(temporary_filename, 'w') as file:
+            file.write(self.registry.prometheus_text())
+        os.replace(temporary_filename, self.filename)
+
+
+# used by every component which does not get its own registry, enabled by the command line interface on demand
+shared_metrics = MetricsRegistry(enabled=False)
@@ -0,0 +1,178 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from http_cassette import CassetteMiss
+from named_entity_linker import NamedEntityLinker, NamedEntityLinking
+from wikidata_entity_linker import WikidataEntityLinker, WikidataNamedEntity
+from wikidata_sites import cache_key, split_cache_key
+
+
+class MultiSiteEntityLinker(NamedEntityLinker):
+    """
+    Links entities on several sites (e.g. enwiki, dewiki and frwiki) at once. Entities are passed and returned as
+    cache keys (see wikidata_sites.cache_key), so the results of all sites share one cache, which is keyed by
+    (site, title).
+
+    Every call first requests the entities of the primary site (the first linker). Its answer contains the sitelinks
+    of all sites, hence an entity of another site which equals the title of a found item on that site is linked
+    without a request of its own. Only the remaining entities are requested on their sites. The batches of every
+    phase are requested concurrently.
+    """
+
+    def __init__(self, linkers):
+        """
+
+        :param linkers: One WikidataEntityLinker per site, the first one links the primary site. Their related_sites
+            should contain all other sites, otherwise no entity can be linked by the sitelinks of another site.
+        """
+        self._linkers = {linker.site: linker for linker in linkers}
+        self._primary_linker = linkers[0]
+        self.sites = [linker.site for linker in linkers]
+        self.entities_per_request = self.keys_per_call(self._primary_linker.entities_per_request, len(linkers))
+        self._executor = ThreadPoolExecutor(len(linkers))
+
+    @staticmethod
+    def keys_per_call(entities_per_request, sites):
+        """
+        Number of keys entity_ids accepts: entities_per_request entities per site for every site. The primary site
+        gets several full batches, so the entities of the other sites which remain after linking by sitelinks still
+        fill their batches.
+        """
+        return entities_per_request * sites * sites
+
+    def linker(self, site):
+        return self._linkers[site]
+
+    def close(self):
+        self._executor.shutdown()
+
+    def entities_by_ids(self, ids, props='info'):
+        """
+        See WikidataEntityLinker.entities_by_ids, the items contain the sitelinks of all sites.
+        """
+        return self._primary_linker.entities_by_ids(ids, props)
+
+    @staticmethod
+    def _to_key(site, linked_entity):
+        return WikidataNamedEntity(cache_key(site, linked_entity.entity), linked_entity.linked_entity,
+                                   linked_entity.description, linked_entity.lastrevid, linked_entity.modified,
+                                   cache_key(site, linked_entity.title) if linked_entity.title is not None else None,
+                                   tuple(cache_key(site, redirect) for redirect in linked_entity.redirects),
+                                   linked_entity.sitelinks, linked_entity.descriptions)
+
+    def _link_sites(self, entities_by_site, not_found_by_site):
+        """
+        Links the entities of every site in batches of the batch size of its linker, all batches concurrently.
+
+        :return: Dictionary<site, Dictionary<entity, WikidataNamedEntity>> containing the entities (not keys) of
+            every site.
+        """
+        batches = []
+        for site, entities in entities_by_site.items():
+            batch_size = self._linkers[site].batch_size()
+            batches.extend((site, entities[i:i + batch_size]) for i in range(0, len(entities), batch_size))
+
+        def link_batch(site_batch):
+            site, batch = site_batch
+            site_not_found_entities = set()
+            try:
+                return self._linkers[site].entity_ids(batch, site_not_found_entities), site_not_found_entities
+            except CassetteMiss as miss:
+                raise CassetteMiss(str(miss), [cache_key(site, entity) for entity in miss.values]) from miss
+
+        if len(batches) == 1:
+            results = [link_batch(batches[0])]
+        else:
+            results = list(self._executor.map(link_batch, batches))
+
+        linked_entities_by_site = {site: dict() for site in entities_by_site}
+        for (site, _), (linked_entities, site_not_found_entities) in zip(batches, results):
+            linked_entities_by_site[site].update(linked_entities)
+            not_found_by_site[site].update(site_not_found_entities)
+        return linked_entities_by_site
+
+    def _link_by_sitelinks(self, primary_linked_entities, entities_by_site, linked_entities):
+        """
+        Links the entities of entities_by_site which are the title of an item found on the primary site and removes
+        them from entities_by_site.
+        """
+        items_by_title = dict()
+        for linked_entity in primary_linked_entities.values():
+            for site, title in (linked_entity.sitelinks or {}).items():
+                items_by_title.setdefault((site, title), linked_entity)
+
+        for site, entities in entities_by_site.items():
+            linker = self._linkers[site]
+            remaining_entities = []
+            for entity in entities:
+                title = entity
+                item = items_by_title.get((site, title), None)
+                if item is None:
+                    title = WikidataEntityLinker.mediawiki_title(entity)
+                    item = items_by_title.get((site, title), None)
+                if item is None:
+                    remaining_entities.append(entity)
+                    continue
+
+                linked_entities[cache_key(site, entity)] = WikidataNamedEntity(
+                    cache_key(site, entity), item.linked_entity, linker.description(item.descriptions or {}),
+                    item.lastrevid, item.modified, cache_key(site, title), (), item.sitelinks, item.descriptions)
+            entities[:] = remaining_entities
+
+    def entity_id(self, entity):
+        result = self.entity_ids([entity], set())
+        if entity not in result:
+            return None, NamedEntityLinking.NOT_FOUND
+        return result[entity], NamedEntityLinking.SUCCESS
+
+    def entity_ids(self, entities, not_found_entities=None):
+        """
+        :param entities: Cache keys of the entities to link, at most entities_per_request.
+        :param not_found_entities: Expects a set which will be used to store the keys that could not be linked.
+        :return: Dictionary<key, WikidataNamedEntity>, the entity, title and redirects of every linked entity are keys
+            as well.
+        """
+        if len(entities) > self.entities_per_request:
+            raise Exception(f"Only {self.entities_per_request} entities are allowed per request. You are trying to "
+                            f"request {len(entities)} entities at once.")
+
+        entities_by_site = {site: [] for site in self.sites}
+        for key in dict.fromkeys(entities):
+            site, entity = split_cache_key(key)
+            if site not in entities_by_site:
+                raise Exception(f"{key} belongs to site {site}, which is not linked.")
+            entities_by_site[site].append(entity)
+
+        linked_entities = dict()
+        not_found_by_site = {site: set() for site in self.sites}
+        primary_site = self._primary_linker.site
+        primary_entities = entities_by_site.pop(primary_site)
+        linked_entities_by_site = self._link_sites({primary_site: primary_entities}, not_found_by_site)
+        self._link_by_sitelinks(linked_entities_by_site[primary_site], entities_by_site, linked_entities)
+        linked_entities_by_site.update(self._link_sites(entities_by_site, not_found_by_site))
+
+        for site, site_linked_entities in linked_entities_by_site.items():
+            for linked_entity in site_linked_entities.values():
+                linked_entities[cache_key(site, linked_entity.entity)] = self._to_key(site, linked_entity)
+
+        if not_found_entities is not None:
+            for site, site_not_found_entities in not_found_by_site.items():
+                not_found_entities.update(cache_key(site, entity) for entity in site_not_found_entities)
+        return linked_entities
+
+
+class SiteRowWriter:
+    """
+    Csv writer for rows whose first column is a cache key: every row is written to the writer of the site of the key,
+    with the key replaced by the entity.
+    """
+
+    def __init__(self, writers):
+        """
+
+        :param writers: Dictionary<site, csv writer>.
+        """
+        self._writers = writers
+
+    def writerow(self, row):
+        site, entity = split_cache_key(row[0])
+        self._writers[site].writerow([entity] + list(row[1:]))
@@ -7,6 +7,8 @@ class NamedEntity:
     """
     Simple pair consisting out of an entity (for example a word) and a linked_entity (for example a wikidata id).
     """
+    __slots__ = ('entity', 'linked_entity')
+
     def __init__(self, entity, linked_entity):
         self.entity = entity
         self.linked_entity = linked_entity
@@ -36,3 +38,32 @@ class NamedEntityLinker(ABC):
     @abstractmethod
     def entity_ids(self, entities, not_found_entities):
         pass
+
+
+class FallbackEntityLinker(NamedEntityLinker):
+    """
+    Links entities using a primary linker. Only entities the primary linker could not link are passed to the fallback
+    linker.
+    """
+
+    def __init__(self, primary_entity_linker, fallback_entity_linker):
+        self._primary_entity_linker = primary_entity_linker
+        self._fallback_entity_linker = fallback_entity_linker
+
+    def entity_id(self, entity):
+        named_entity, linking_info = self._primary_entity_linker.entity_id(entity)
+        if linking_info == NamedEntityLinking.SUCCESS:
+            return named_entity, linking_info
+
+        return self._fallback_entity_linker.entity_id(entity)
+
+    def entity_ids(self, entities, not_found_entities=None):
+        missing_entities = set()
+        linked_entities = self._primary_entity_linker.entity_ids(entities, missing_entities)
+
+        if missing_entities:
+            # keep the order of entities, some linkers map their results back by position
+            missing_entities = [entity for entity in entities if entity in missing_entities]
+            linked_entities.update(self._fallback_entity_linker.entity_ids(missing_entities, not_found_entities))
+
+        return linked_entities
@@ -0,0 +1,151 @@
+import random
+import threading
+
+from collections import deque, namedtuple
+from email.utils import parsedate_to_datetime
+from time import monotonic, sleep, time
+
+RateLimiterState = namedtuple('RateLimiterState', ['rate', 'tokens', 'backoff_remaining', 'consecutive_failures',
+                                                   'error_rate', 'throttled_requests'])
+
+
+class AdaptiveRateLimiter:
+    """
+    Thread-safe token bucket whose rate adapts to the answers of the server (AIMD):
+        - every successful request increases the rate additively (by `increase` requests/sec per second of success),
+        - a throttled request (429, 503, maxlag) multiplies the rate with `decrease` and blocks all callers until
+          the Retry-After of the server (or a jittered exponential backoff) has passed,
+        - other errors decrease the rate once the error rate of the last `error_window` requests exceeds
+          `max_error_rate`.
+    """
+
+    def __init__(self, rate=50.0, min_rate=1.0, max_rate=200.0, increase=1.0, decrease=0.5, base_backoff=1.0,
+                 max_backoff=60.0, error_window=100, max_error_rate=0.1):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_error_rate = max_error_rate
+
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._tokens = 1.0
+        self._last_refill = monotonic()
+        self._backoff_until = 0.0
+        self._consecutive_failures = 0
+        self._throttled_requests = 0
+        self._outcomes = deque(maxlen=error_window)
+
+    def _refill(self, now):
+        # no tokens accumulate during a backoff, the bucket is refilled from its end on
+        refill_start = max(self._last_refill, self._backoff_until)
+        if now > refill_start:
+            # the bucket holds at most one second worth of requests
+            self._tokens = min(max(self._rate, 1.0), self._tokens + (now - refill_start) * self._rate)
+        self._last_refill = now
+
+    def reserve(self):
+        """
+        Takes a token out of the bucket.
+
+        :return: The time in seconds the caller has to wait before sending its request. Callers queued during a
+            backoff are spaced by 1/rate after its end instead of all being sent when it ends.
+        """
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = max(0.0, self._backoff_until - now)
+            if self._tokens < 0:
+                wait += -self._tokens / self._rate
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            sleep(wait)
+
+    def backoff_delay(self, attempt):
+        """
+        Exponential backoff with full jitter.
+
+        :param attempt: Number of failed attempts so far (starting at 1).
+        """
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** (attempt - 1)))
+
+    def record_success(self):
+        with self._lock:
+            self._outcomes.append(False)
+            self._consecutive_failures = 0
+            self._rate = min(self.max_rate, self._rate + self.increase / self._rate)
+
+    def record_throttle(self, retry_after=None):
+        """
+
+        :param retry_after: Seconds the server asked us to wait (None if unknown).
+        """
+        with self._lock:
+            self._outcomes.append(True)
+            self._throttled_requests += 1
+            self._consecutive_failures += 1
+            self._rate = max(self.min_rate, self._rate * self.decrease)
+
+            delay = self.backoff_delay(self._consecutive_failures)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            now = monotonic()
+            self._refill(now)
+            self._backoff_until = max(self._backoff_until, now + delay)
+            # requests saved up before the throttle must not be sent as a burst once the backoff has passed
+            self._tokens = min(self._tokens, 1.0)
+
+    def record_error(self):
+        with self._lock:
+            self._outcomes.append(True)
+            self._consecutive_failures += 1
+            if self._error_rate() > self.max_error_rate:
+                self._rate = max(self.min_rate, self._rate * self.decrease)
+                # every error would otherwise decrease the rate again until the window has recovered
+                self._outcomes.clear()
+
+    def _error_rate(self):
+        if not self._outcomes:
+            return 0.0
+        return sum(self._outcomes) / len(self._outcomes)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def state(self):
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            return RateLimiterState(rate=self._rate, tokens=self._tokens,
+                                    backoff_remaining=max(0.0, self._backoff_until - now),
+                                    consecutive_failures=self._consecutive_failures, error_rate=self._error_rate(),
+                                    throttled_requests=self._throttled_requests)
+
+
+def parse_retry_after(value):
+    """
+    Parses the value of a Retry-After header, which is either a number of seconds or a http date.
+
+    :return: Seconds to wait or None if value is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+# shared by every WikidataEntityLinker of this process which does not get its own limiter
+shared_rate_limiter = AdaptiveRateLimiter()
@@ -0,0 +1,237 @@
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import zlib
+
+from alias_index import AliasIndex
+from entity_store import open_entity_store
+from time import sleep
+
+
+def shard_of(entity, shard_count):
+    """
+    Assigns entity to one of shard_count shards. The assignment does not depend on the process (unlike hash()), so
+    every host and every re-run of a shard agrees on it.
+    """
+    return zlib.crc32(entity.encode('utf-8')) % shard_count
+
+
+def parse_shard(value):
+    """
+    Parses a shard given as 'index/count', for example '3/8'.
+
+    :return: A tuple<int, int> containing the shard index and the shard count.
+    """
+    try:
+        shard_index, shard_count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not of the form index/count (for example 3/8).")
+
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise argparse.ArgumentTypeError(f"shard index must be in [0, {shard_count}).")
+    return shard_index, shard_count
+
+
+def shard_filename(filename, shard_index, shard_count):
+    """
+    Name of the segment of filename belonging to a shard, e.g. linking.csv -> linking.shard-3-of-8.csv.
+    """
+    root, extension = os.path.splitext(filename)
+    return f"{root}.shard-{shard_index}-of-{shard_count}{extension}"
+
+
+def merge_rows(filenames, output_filename, header=None):
+    """
+    Concatenates the csv files of all shards and removes duplicate entities (first column). Every entity belongs to
+    exactly one shard, so duplicates are only searched for within a shard, which keeps the memory usage at the size of
+    the largest shard.
+
+    :param header: Header row of the files or None if the files have no header.
+    :return: The number of merged rows.
+    """
+    merged_rows = 0
+    with open(output_filename, "w") as output_file:
+        writer = csv.writer(output_file, delimiter=',')
+        if header is not None:
+            writer.writerow(header)
+
+        for filename in filenames:
+            seen_entities = set()
+            with open(filename, "r") as file:
+                reader = csv.reader(file, delimiter=',')
+                if header is not None:
+                    next(reader, None)
+
+                for row in reader:
+                    if row[0] in seen_entities:
+                        continue
+                    seen_entities.add(row[0])
+                    writer.writerow(row)
+                    merged_rows += 1
+
+    return merged_rows
+
+
+def merge_caches(cache_filenames, cache_filename, backend=None, rows_per_transaction=100000):
+    """
+    Adds all rows of the shard caches to the cache, which are not part of it yet.
+
+    :return: The number of added rows.
+    """
+    cache = open_entity_store(cache_filename, backend)
+    added_rows = 0
+
+    def add(rows):
+        cached_rows = cache.get_many([row[0] for row in rows])
+        new_rows = [row for row in rows if row[0] not in cached_rows]
+        cache.put_many(new_rows)
+        return len(new_rows)
+
+    try:
+        for filename in cache_filenames:
+            shard_cache = open_entity_store(filename, backend)
+            try:
+                rows = []
+                for row in shard_cache.rows():
+                    rows.append(tuple(row))
+                    if len(rows) == rows_per_transaction:
+                        added_rows += add(rows)
+                        rows = []
+                added_rows += add(rows)
+            finally:
+                shard_cache.close()
+        cache.sync()
+    finally:
+        cache.close()
+
+    return added_rows
+
+
+def merge_alias_indexes(alias_index_filenames, alias_index_filename):
+    """
+    Adds all aliases of the shard alias indexes to the alias index, which are not part of it yet.
+
+    :return: The number of aliases of the merged index.
+    """
+    alias_index = AliasIndex(alias_index_filename)
+    try:
+        for filename in alias_index_filenames:
+            try:
+                with open(filename, "r") as file:
+                    reader = csv.reader(file)
+                    next(reader, None)
+                    for alias, title in reader:
+                        alias_index.add(alias, title)
+            except FileNotFoundError:
+                pass
+    finally:
+        alias_index.close()
+    return len(alias_index)
+
+
+def merge_shards(shard_count, output_filename, not_found_entities_filename, cache_filename, cache_backend=None,
+                 alias_index_filename=None):
+    """
+    Combines the output, the not found entities, the cache segment and the alias index segment of every shard.
+    """
+    shards = range(shard_count)
+
+    merged_rows = merge_rows([shard_filename(output_filename, shard, shard_count) for shard in shards],
+                             output_filename, header=['embedding_label', 'knowledgebase_id'])
+    print(f"{merged_rows} linked entities merged into {output_filename}")
+
+    merged_rows = merge_rows([shard_filename(not_found_entities_filename, shard, shard_count) for shard in shards],
+                             not_found_entities_filename)
+    print(f"{merged_rows} not found entities merged into {not_found_entities_filename}")
+
+    added_rows = merge_caches([shard_filename(cache_filename, shard, shard_count) for shard in shards],
+                              cache_filename, cache_backend)
+    print(f"{added_rows} new cache entries merged into {cache_filename}")
+
+    if alias_index_filename is not None:
+        aliases = merge_alias_indexes([shard_filename(alias_index_filename, shard, shard_count) for shard in shards],
+                                      alias_index_filename)
+        print(f"{alias_index_filename} contains {aliases} aliases")
+
+
+def run_shards(shard_count, linker_arguments, processes=None):
+    """
+    Runs wikidata_entity_linker.py once per shard on this machine.
+
+    :param linker_arguments: Command line arguments passed to every shard (without --shard).
+    :param processes: Maximum number of shards running at once (default: all).
+    :return: List of the shards which failed.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wikidata_entity_linker.py')
+    processes = processes or shard_count
+
+    failed_shards = []
+    pending_shards = list(range(shard_count))
+    running_shards = dict()
+    while pending_shards or running_shards:
+        while pending_shards and len(running_shards) < processes:
+            shard = pending_shards.pop(0)
+            print(f"Starting shard {shard}/{shard_count}")
+            running_shards[shard] = subprocess.Popen([sys.executable, script] + linker_arguments +
+                                                     ['--shard', f"{shard}/{shard_count}"])
+
+        sleep(0.5)
+        for shard, process in list(running_shards.items()):
+            if process.poll() is None:
+                continue
+
+            del running_shards[shard]
+            if process.returncode != 0:
+                print(f"Shard {shard}/{shard_count} failed with exit code {process.returncode}")
+                failed_shards.append(shard)
+
+    return failed_shards
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Links a model in several shards. Every shard processes the entities '
+                                                 'hashed to it with its own output files and its own cache segment, '
+                                                 'the merge step combines them afterwards. Shards may also be run on '
+                                                 'different hosts sharing a filesystem by starting '
+                                                 'wikidata_entity_linker.py --shard index/count on every host and '
+                                                 'merging once all of them are done.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="run all shards on this machine and merge them. All arguments "
+                                                   "which are not listed here are passed to wikidata_entity_linker.py")
+    run_parser.add_argument('shards', help="number of shards", type=int)
+    run_parser.add_argument('--processes', help="maximum number of shards running at once (default: number of "
+                                                "shards)", type=int, default=None)
+
+    merge_parser = subparsers.add_parser('merge', help="merge the results of all shards")
+    merge_parser.add_argument('shards', help="number of shards", type=int)
+
+    for subparser in (run_parser, merge_parser):
+        # same defaults as wikidata_entity_linker.py
+        subparser.add_argument('-o', '--output', default="linking.csv")
+        subparser.add_argument('-n', '--not-found-entities', default="not_found_entities.txt")
+        subparser.add_argument('-c', '--cache', default="cache.csv")
+        subparser.add_argument('--cache-backend', choices=['csv', 'sqlite'], default=None)
+        subparser.add_argument('--alias-index', default=None)
+
+    args, unknown_arguments = parser.parse_known_args()
+    if args.command == 'merge' and unknown_arguments:
+        parser.error(f"unrecognized arguments: {' '.join(unknown_arguments)}")
+
+    if args.command == 'run':
+        linker_arguments = unknown_arguments + ['-o', args.output, '-n', args.not_found_entities, '-c', args.cache]
+        if args.cache_backend is not None:
+            linker_arguments += ['--cache-backend', args.cache_backend]
+        if args.alias_index is not None:
+            linker_arguments += ['--alias-index', args.alias_index]
+
+        failed_shards = run_shards(args.shards, linker_arguments, args.processes)
+        if failed_shards:
+            print(f"Shards {', '.join(str(shard) for shard in failed_shards)} failed. Re-run them using "
+                  f"wikidata_entity_linker.py --shard index/{args.shards} and merge afterwards.")
+            sys.exit(1)
+
+    merge_shards(args.shards, args.output, args.not_found_entities, args.cache, args.cache_backend, args.alias_index)
+    print("All done!")
@@ -0,0 +1,189 @@
+import mmap
+import multiprocessing
+import os
+
+from dump_entity_linker import open_dump
+
+formats = ('vec', 'glove', 'word2vec-binary')
+_compressed_extensions = ('.gz', '.bz2')
+
+
+def _is_header(line):
+    # .vec and word2vec files start with "<number of words> <dimensions>"
+    fields = line.split()
+    return len(fields) == 2 and all(field.isdigit() for field in fields)
+
+
+def detect_format(filename):
+    """
+    Derives the format of an embedding file: 'word2vec-binary' for .bin files, 'vec' for text files starting with a
+    "<words> <dimensions>" header (fasttext, word2vec text) and 'glove' for text files without header.
+    """
+    if filename.endswith('.bin'):
+        return 'word2vec-binary'
+
+    if filename.endswith(_compressed_extensions):
+        with open_dump(filename) as file:
+            first_line = file.readline()
+    else:
+        with open(filename, 'rb') as file:
+            first_line = file.readline().decode('utf-8', errors='replace')
+    return 'vec' if _is_header(first_line) else 'glove'
+
+
+def _decode(token):
+    return token.decode('utf-8', errors='replace')
+
+
+def _scan_tokens(filename, start, end):
+    """
+    Returns the first field of every line starting in [start, end) of a text embedding file. Only the token prefix of
+    a line is copied, the vectors are skipped by searching for the next newline inside the memory map.
+    """
+    tokens = []
+    with open(filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as memory_map:
+        position = start
+        while position < end:
+            line_end = memory_map.find(b'\n', position)
+            if line_end < 0:
+                line_end = len(memory_map)
+            token_end = memory_map.find(b' ', position, line_end)
+            if token_end < 0:
+                token_end = line_end
+            token = memory_map[position:token_end].rstrip(b'\r')
+            if token:
+                tokens.append(_decode(token))
+            position = line_end + 1
+    return tokens
+
+
+def _scan_tokens_of_range(arguments):
+    return _scan_tokens(*arguments)
+
+
+def _text_chunks(filename, start, chunks):
+    """
+    Splits [start, size of filename) into byte ranges which begin at the start of a line.
+    """
+    size = os.path.getsize(filename)
+    boundaries = [start]
+    with open(filename, 'rb') as file:
+        for i in range(1, chunks):
+            file.seek(max(boundaries[-1], start + (size - start) * i // chunks))
+            file.readline()
+            boundaries.append(min(size, file.tell()))
+    boundaries.append(size)
+    return [(filename, boundaries[i], boundaries[i + 1]) for i in range(chunks) if boundaries[i] < boundaries[i + 1]]
+
+
+def _read_text_tokens(filename, skip_header, processes):
+    start = 0
+    if skip_header:
+        with open(filename, 'rb') as file:
+            file.readline()
+            start = file.tell()
+
+    if os.path.getsize(filename) == start:
+        return
+
+    if processes <= 1:
+        yield from _scan_tokens(filename, start, os.path.getsize(filename))
+        return
+
+    # a few chunks per process, so the tokens of the first chunks can be consumed while the others are scanned
+    with multiprocessing.Pool(processes) as pool:
+        for tokens in pool.imap(_scan_tokens_of_range, _text_chunks(filename, start, processes * 4)):
+            yield from tokens
+
+
+def _read_compressed_text_tokens(filename, skip_header):
+    with open_dump(filename) as file:
+        if skip_header:
+            file.readline()
+        for line in file:
+            token = line[:line.find(' ')] if ' ' in line else line.rstrip('\r\n')
+            if token:
+                yield token
+
+
+def _read_word2vec_binary_tokens(filename):
+    with open(filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as memory_map:
+        header_end = memory_map.find(b'\n')
+        words, dimensions = (int(field) for field in memory_map[:header_end].split())
+        vector_size = dimensions * 4
+
+        position = header_end + 1
+        for _ in range(words):
+            token_end = memory_map.find(b' ', position)
+            # some writers terminate every vector with a newline, which then prefixes the next token
+            yield _decode(memory_map[position:token_end].lstrip(b'\n'))
+            position = token_end + 1 + vector_size
+
+
+def read_vocabulary(filename, format=None, processes=1):
+    """
+    Iterates over the tokens (first column) of an embedding file in file order without parsing the vectors.
+
+    :param filename: .vec (fasttext/word2vec text), GloVe .txt or word2vec .bin file. Text files may be compressed
+        (.gz, .bz2).
+    :param format: One of formats. If None, the format is detected using detect_format.
+    :param processes: Number of processes scanning uncompressed text files in parallel.
+    :return: Generator of tokens.
+    """
+    format = format or detect_format(filename)
+    if format not in formats:
+        raise Exception(f"Unknown vocabulary format {format}.")
+
+    if format == 'word2vec-binary':
+        return _read_word2vec_binary_tokens(filename)
+    if filename.endswith(_compressed_extensions):
+        return _read_compressed_text_tokens(filename, format == 'vec')
+    return _read_text_tokens(filename, format == 'vec', processes)
+
+
+class CaseFoldedIndex:
+    """
+    Maps the case-folded form of a token to all its spellings in a vocabulary. Only tokens whose case-folded form is
+    of interest are kept, so an index for a few linked labels stays small even for a vocabulary of millions of tokens.
+    """
+
+    def __init__(self, keys=None):
+        """
+
+        :param keys: Tokens whose spellings should be collected (all tokens if None).
+        """
+        self._keys = None if keys is None else {key.casefold() for key in keys}
+        # Dictionary<case-folded token, str or tuple<str>>, most tokens have a single spelling
+        self._spellings = dict()
+
+    def add(self, token):
+        key = token.casefold()
+        if self._keys is not None and key not in self._keys:
+            return
+
+        spellings = self._spellings.get(key, None)
+        if spellings is None:
+            self._spellings[key] = token
+        elif isinstance(spellings, str):
+            if spellings != token:
+                self._spellings[key] = (spellings, token)
+        elif token not in spellings:
+            self._spellings[key] = spellings + (token,)
+
+    def update(self, tokens):
+        for token in tokens:
+            self.add(token)
+        return self
+
+    def spellings(self, token):
+        """
+        :return: Tuple of all spellings of token in the vocabulary (in vocabulary order).
+        """
+        spellings = self._spellings.get(token.casefold(), ())
+        return (spellings,) if isinstance(spellings, str) else spellings
+
+    def __contains__(self, token):
+        return token in self.spellings(token)
+
+    def __len__(self):
+        return len(self._spellings)
@@ -1,18 +1,51 @@
 import requests
 import csv
-import os
 import argparse
+import asyncio
+import collections
+import contextlib
+import itertools
+import os
 import threading
-
-from named_entity_linker import NamedEntityLinker, NamedEntity, NamedEntityLinking
-from time import sleep
+import unicodedata
+
+from alias_index import AliasIndex
+from batch_sizer import AdaptiveBatchSizer
+from deduplication import BloomFilter, RowDeduplicator
+from entity_store import LayeredEntityStore, TieredEntityStore, WriteBehindEntityStore, open_entity_store
+from http_cassette import HttpCassette
+from linking_pipeline import LinkingPipeline, RunCheckpoint
+from metrics import MetricsExporter, shared_metrics
+from named_entity_linker import FallbackEntityLinker, NamedEntityLinker, NamedEntity, NamedEntityLinking
+from rate_limiter import AdaptiveRateLimiter, parse_retry_after, shared_rate_limiter
+from sharded_linking import parse_shard, shard_filename, shard_of
+from time import monotonic, sleep, time
+from urllib.parse import urlencode
+from wikidata_sites import cache_key, default_site, site_filename, site_language, split_cache_key
 
 
 class WikidataNamedEntity(NamedEntity):
+    __slots__ = ('description', 'lastrevid', 'modified', 'title', 'redirects', 'sitelinks', 'descriptions')
+
+    def __init__(self, entity, linked_entity, description, lastrevid=0, modified='', title=None, redirects=(),
+                 sitelinks=None, descriptions=None):
+        """
 
-    def __init__(self, entity, linked_entity, description):
+        :param lastrevid: Revision of the linked entity when it was fetched (0 if unknown).
+        :param modified: Timestamp of that revision, e.g. '2020-01-01T00:00:00Z' ('' if unknown).
+        :param title: Canonical title of the page entity resolved to on the linked site (None if unknown).
+        :param redirects: Titles entity passed on its way to title (normalized titles, redirects, ...).
+        :param sitelinks: Dictionary<site, title> of the linked entity on all requested sites (None if unknown).
+        :param descriptions: Dictionary<language, description> of the linked entity in all requested languages.
+        """
         NamedEntity.__init__(self, entity, linked_entity)
         self.description = description
+        self.lastrevid = lastrevid
+        self.modified = modified
+        self.title = title
+        self.redirects = redirects
+        self.sitelinks = sitelinks
+        self.descriptions = descriptions
 
     def __str__(self):
         return '{}, {}, {}'.format(self.entity, self.linked_entity, self.description)
@@ -20,61 +53,109 @@ class WikidataNamedEntity(NamedEntity):
 
 class PersistentEntityLinker(NamedEntityLinker):
 
-    def __init__(self, filename):
+    def __init__(self, filename=None, store=None, backend=None, metrics=None, alias_index=None):
         """
 
-        :param filename: Path to a csv file which will be used to store entity linkings.
+        :param filename: Path to a file which will be used to store entity linkings. Files ending with .sqlite, .sqlite3
+            or .db are stored using SQLite, all other files are stored as csv.
+        :param store: EntityStore to use instead of opening filename.
+        :param backend: 'csv' or 'sqlite' to override the backend derived from filename.
+        :param metrics: MetricsRegistry to report to. If None, the registry shared by the whole process is used.
+        :param alias_index: AliasIndex of the cache. If defined, linked entities are stored once under the canonical
+            title of their page and every entity resolving to that page is recorded as an alias, so later lookups of
+            any of them are answered from the cache.
         """
-        self._filename = filename
-        self._initialize_dictionary()
-        self._dictionary_file = open(filename, mode='a', buffering=1)
-        self._lock = threading.Lock()
+        if (filename is None) == (store is None):
+            raise Exception("Exactly one of filename and store must be defined.")
 
-    def _initialize_dictionary(self):
-        self._dictionary = dict()
+        self._filename = filename
+        self._store = store if store is not None else open_entity_store(filename, backend)
+        self._alias_index = alias_index
 
-        try:
-            with open(self._filename, "r") as file:
-                reader = csv.reader(file, delimiter=',')
-                next(reader)
-                for row in reader:
-                    self._dictionary[row[0]] = WikidataNamedEntity(row[0], row[1], row[2])
+        metrics = metrics if metrics is not None else shared_metrics
+        self._lookups = metrics.counter('cache_lookups_total', "Cache lookups by result (hit, negative_hit, miss)",
+                                        ('result',))
+        self._lookup_seconds = metrics.histogram('cache_lookup_seconds', "Duration of bulk cache lookups")
+        self._writes = metrics.counter('cache_writes_total', "Entries written to the cache")
+        self._alias_hits = metrics.counter('cache_alias_hits_total', "Lookups answered by the row of an alias")
 
-        except FileNotFoundError:
-            with open(self._filename, "a") as file:
-                csv.writer(file).writerow(["entity", "linked_entity", "description"])
+    def close(self):
+        self._store.close()
+        if self._alias_index is not None:
+            self._alias_index.close()
 
     def __del__(self):
-        self._dictionary_file.close()
+        if hasattr(self, '_store'):
+            self.close()
 
     def persist_entity(self, wikidata_named_entity):
-        with self._lock:
-            writer = csv.writer(self._dictionary_file, delimiter=',')
-            if os.stat(self._filename).st_size == 0:
-                writer.writerow(["entity", "linked_entity", "description"])
+        self._writes.inc()
+        title = wikidata_named_entity.title if self._alias_index is not None else None
+        self._store.put(title or wikidata_named_entity.entity, wikidata_named_entity.linked_entity,
+                        wikidata_named_entity.description, wikidata_named_entity.lastrevid,
+                        wikidata_named_entity.modified, int(time()))
+
+        if title is not None:
+            # the row has to exist before the aliases pointing to it
+            for alias in (wikidata_named_entity.entity,) + tuple(wikidata_named_entity.redirects):
+                self._alias_index.add(alias, title)
+
+    def _get_rows(self, entities):
+        """
+        Looks up entities and, for entities without a row of their own, the rows of their canonical titles.
 
-            writer.writerow([wikidata_named_entity.entity, wikidata_named_entity.linked_entity,
-                             wikidata_named_entity.description])
+        :return: Dictionary<entity, row> (see EntityStore.get_many).
+        """
+        rows = self._store.get_many(entities)
+        if self._alias_index is None:
+            return rows
 
-            self._dictionary[wikidata_named_entity.entity] = wikidata_named_entity
+        titles = dict()
+        for entity in entities:
+            if entity in rows:
+                continue
 
-    def entity_id(self, entity):
-        with self._lock:
-            named_entity = self._dictionary.get(entity, None)
+            title = self._alias_index.get(entity)
+            if title is None:
+                # mediawiki does not distinguish these spellings, so they resolve to the same page
+                site, name = split_cache_key(entity)
+                title = cache_key(site, WikidataEntityLinker.mediawiki_title(name))
+                if title == entity:
+                    continue
+                title = self._alias_index.get(title) or title
+            titles[entity] = title
+
+        if titles:
+            title_rows = self._store.get_many(set(titles.values()))
+            alias_hits = 0
+            for entity, title in titles.items():
+                row = title_rows.get(title, None)
+                # a negative row of a title does not mean that the linker would not find entity by other candidates
+                if row is not None and row[0] != '':
+                    rows[entity] = row
+                    alias_hits += 1
+            self._alias_hits.inc(alias_hits)
+        return rows
 
-        linking_info = NamedEntityLinking.SUCCESS
-        if named_entity is not None:
-            if named_entity.linked_entity == '':
-                named_entity = None
-                linking_info = NamedEntityLinking.NO_LINKING_FOUND
-        else:
-            linking_info = NamedEntityLinking.NOT_FOUND
-        return named_entity, linking_info
+    @staticmethod
+    def _to_linking(entity, row):
+        if row is None:
+            return None, NamedEntityLinking.NOT_FOUND
+
+        linked_entity, description, lastrevid, modified, _ = row
+        if linked_entity == '':
+            return None, NamedEntityLinking.NO_LINKING_FOUND
+        return WikidataNamedEntity(entity, linked_entity, description, lastrevid, modified), NamedEntityLinking.SUCCESS
+
+    def entity_id(self, entity):
+        return self._to_linking(entity, self._get_rows([entity]).get(entity, None))
 
     def entity_ids(self, entities, not_found_entities=None):
         dictionary = dict()
+        with self._lookup_seconds.time():
+            rows = self._get_rows(entities)
         for entity in entities:
-            named_entity, linking_info = self.entity_id(entity)
+            named_entity, linking_info = self._to_linking(entity, rows.get(entity, None))
 
             if linking_info == NamedEntityLinking.SUCCESS:
                 dictionary[entity] = named_entity
@@ -83,14 +164,148 @@ class PersistentEntityLinker(NamedEntityLinker):
 
         return dictionary
 
+    def cached_entity_ids(self, entities, not_found_entities=None):
+        """
+        Looks up entities with a single bulk query.
+
+        :param not_found_entities: Set to which all entities are added, which are cached without a linking.
+        :return: A tuple<Dictionary<entity, WikidataNamedEntity>, list>. The first value contains all cached linkings,
+            the second one all entities which have never been requested before.
+        """
+        dictionary = dict()
+        not_cached_entities = []
+        negative_hits = 0
+        with self._lookup_seconds.time():
+            rows = self._get_rows(entities)
+        for entity in entities:
+            named_entity, linking_info = self._to_linking(entity, rows.get(entity, None))
+
+            if linking_info == NamedEntityLinking.SUCCESS:
+                dictionary[entity] = named_entity
+            elif linking_info == NamedEntityLinking.NOT_FOUND:
+                not_cached_entities.append(entity)
+            else:
+                negative_hits += 1
+                if not_found_entities is not None:
+                    not_found_entities.add(entity)
+
+        self._lookups.inc(len(dictionary), ('hit',))
+        self._lookups.inc(negative_hits, ('negative_hit',))
+        self._lookups.inc(len(not_cached_entities), ('miss',))
+        return dictionary, not_cached_entities
+
 
 class WikidataEntityLinker(NamedEntityLinker):
+    wikidata_api_url = "https://www.wikidata.org/w/api.php"
+
+    max_tries = 5
+    # seconds after which a request which has not been answered is given up and repeated
+    request_timeout = 60
+    # seconds of database replication lag at which wikidata rejects our requests (see mediawiki's maxlag parameter)
+    maxlag = 5
+    # requests whose query string would be longer are sent as POST, servers reject too long urls (414)
+    max_get_query_length = 2000
+    # answers indicating that a request was too large (request timeout, body too large, url too long, gateway
+    # timeout), only these shrink the batch size
+    batch_size_error_codes = (408, 413, 414, 504)
+
+    def __init__(self, session=requests.Session(), entities_per_request=50, rate_limiter=None, metrics=None,
+                 api_url=None, batch_sizer=None, site=default_site, languages=None, related_sites=(), cassette=None,
+                 request_timeout=None):
+        """
 
-    def __init__(self, session=requests.Session(), entities_per_request=50):
+        :param entities_per_request: Maximum number of entities per request.
+        :param site: Site whose page titles are linked, e.g. 'dewiki'.
+        :param languages: Languages of the descriptions in order of preference (default: the language of site). All
+            of them are requested at once, English is always requested to recognize disambiguation pages.
+        :param related_sites: Further sites whose sitelinks are requested along with the ones of site (see
+            WikidataNamedEntity.sitelinks).
+        :param api_url: Url of the api.php to request instead of wikidata_api_url (e.g. a mirror or a mock server).
+        :param rate_limiter: AdaptiveRateLimiter used to pace all requests. If None, the limiter shared by all
+            linkers of this process is used.
+        :param metrics: MetricsRegistry to report to. If None, the registry shared by the whole process is used.
+        :param batch_sizer: AdaptiveBatchSizer which is told the latency and size of every answer and decides how many
+            normalization candidates are requested at once (see batch_size). If None, batches always contain
+            entities_per_request entities.
+        :param cassette: HttpCassette. In 'record' mode every successful 'wbgetentities' response is recorded, in
+            'replay' mode all responses are taken from the cassette and wikidata is not requested at all.
+        :param request_timeout: Seconds after which a request which has not been answered is repeated (up to
+            max_tries times) and counts as failed batch for the batch sizer (default: request_timeout).
+        """
         self._session = session
+        self.cassette = cassette
         self.entities_per_request = entities_per_request
+        self.batch_sizer = batch_sizer
+        self.site = site
+        self.languages = tuple(languages) if languages else (site_language(site),)
+        self.related_sites = tuple(related_site for related_site in related_sites if related_site != site)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else shared_rate_limiter
+        if api_url is not None:
+            self.wikidata_api_url = api_url
+        if request_timeout is not None:
+            self.request_timeout = request_timeout
+
+        metrics = metrics if metrics is not None else shared_metrics
+        self._responses = metrics.counter('wikidata_responses_total', "Responses of wbgetentities by http status "
+                                                                      "code ('maxlag' if the server was lagging, "
+                                                                      "'timeout' if it did not answer in time)",
+                                          ('status',))
+        self._retries = metrics.counter('wikidata_retries_total', "Repeated wbgetentities requests")
+        self._request_seconds = metrics.histogram('wikidata_request_seconds', "Duration of wbgetentities requests "
+                                                                              "(without rate limiting and backoff)")
+        self._pass_requests = metrics.counter('wikidata_pass_requests_total', "wbgetentities requests by linking pass "
+                                                                              "(batch, candidates, normalize)",
+                                              ('pass',))
+        self._methods = metrics.counter('wikidata_requests_total', "wbgetentities requests by http method "
+                                                                   "('replay' if answered by a cassette)",
+                                        ('method',))
+
+    def batch_size(self):
+        """
+        :return: Number of entities the next request should contain.
+        """
+        if self.batch_sizer is None:
+            return self.entities_per_request
+        return min(self.entities_per_request, self.batch_sizer.size())
+
+    def description(self, descriptions):
+        """
+        :param descriptions: 'descriptions' of an item as returned by 'wbgetentities' or
+            WikidataNamedEntity.descriptions.
+        :return: The description in the first of languages the item has one in, None if there is none.
+        """
+        for language in self.languages:
+            description = descriptions.get(language, None)
+            if isinstance(description, dict):
+                description = description.get('value', None)
+            if description is not None:
+                return description
+        return None
 
-    def _link_entities(self, entities, not_found_entities):
+    @staticmethod
+    def is_disambiguation(descriptions):
+        """
+        :param descriptions: 'descriptions' of an item as returned by 'wbgetentities'.
+        """
+        description = descriptions.get('en', {}).get('value', None)
+        return description is not None and 'disambiguation page' in description
+
+    @staticmethod
+    def join_titles(titles):
+        """
+        Joins titles to the value of a multi-value parameter. If a title contains '|', mediawiki's alternative
+        separator U+001F is used, which is announced by starting the value with it.
+        """
+        if any('|' in title for title in titles):
+            return '\x1f' + '\x1f'.join(titles)
+        return '|'.join(titles)
+
+    @staticmethod
+    def is_requestable(entity):
+        # U+001F can be neither part of a title (control characters are invalid) nor be separated from the others
+        return '\x1f' not in entity
+
+    def _link_entities(self, entities, not_found_entities, normalize=None):
         """
         Requests wikidata ids to every entity in entities.
         The linking is performed using wikidata's API call to 'wbgetentities'.
@@ -102,6 +317,8 @@ class WikidataEntityLinker(NamedEntityLinker):
             When fetching several ids at once, normalization (for example converting a word to ist base form) is not
             possible. This may result in less entries being found.
         :param not_found_entities: Expects a set which will be used to store entities that could not be linked.
+        :param normalize: Whether wikidata should normalize the titles. Normalization is only possible for single
+            entities, hence it is enabled for single entities by default.
         :return: Returns Dictionary<entity, WikidataNamedEntity>. Entities, which could not be linked, will not be added
             to the dictionary.
         """
@@ -109,80 +326,347 @@ class WikidataEntityLinker(NamedEntityLinker):
             raise Exception(f"Only {self.entities_per_request} entities are allowed per request. You are trying to "
                             f"request {len(entities)} entities at once.")
 
-        linked_entities = dict()
+        entities = self._requestable_entities(entities, not_found_entities)
         if len(entities) == 0:
-            return linked_entities
+            return dict()
 
-        _not_found_entities = set()
-        entity_index = 0
-        titles = "|".join(entities)
-        normalize = True if len(entities) == 1 else False
+        if normalize is None:
+            normalize = True if len(entities) == 1 else False
+
+        params = self._query_params(self.join_titles(entities), normalize)
+        if self._replaying():
+            return self._replay_entities(entities, params, not_found_entities)
+
+        query_result_json = self._request(params, len(entities))
+        return self._parse_query_result(entities, query_result_json, not_found_entities)
+
+    def _replaying(self):
+        return self.cassette is not None and self.cassette.mode == 'replay'
+
+    def _replay_entities(self, entities, params, not_found_entities):
+        """
+        Links entities by the responses the cassette recorded for params. Every response is parsed together with the
+        entities it has been recorded for, exactly like an answer of wikidata.
+        """
+        self._methods.inc(labels=('replay',))
+        exchanges = self.cassette.replay(params)
+        if len(exchanges) == 1 and exchanges[0][0] == list(entities):
+            return self._parse_query_result(entities, exchanges[0][1], not_found_entities)
+
+        # the responses of other batches also contain entities which have not been requested now
+        linked_entities = dict()
+        for recorded_entities, query_result_json in exchanges:
+            linked_entities.update(self._parse_query_result(recorded_entities, query_result_json, None))
+        linked_entities = {entity: linked_entities[entity] for entity in entities if entity in linked_entities}
+        if not_found_entities is not None:
+            not_found_entities.update(entity for entity in entities if entity not in linked_entities)
+        return linked_entities
+
+    def _requestable_entities(self, entities, not_found_entities):
+        """
+        :return: entities without the ones which can not be requested, those are added to not_found_entities.
+        """
+        requestable_entities = [entity for entity in entities if self.is_requestable(entity)]
+        if len(requestable_entities) != len(entities) and not_found_entities is not None:
+            not_found_entities.update(entity for entity in entities if not self.is_requestable(entity))
+        return requestable_entities
 
+    def _request(self, params, batch_size):
+        """
+        Sends a request to the api (paced by the rate limiter) and repeats it until it succeeds or max_tries is
+        reached.
+
+        :param batch_size: Number of titles or ids requested, reported to the batch sizer.
+        :return: The decoded json response.
+        """
         try_count = 1
-        sleep_time_in_sec = 0
         while True:
-            query_result = self._execute_query(titles, normalize)
-            if query_result.status_code != 200:
-                sleep_time_in_sec += 1
-                sleep(sleep_time_in_sec)
-            else:
-                break
-
-            try_count += 1
-            if try_count > 5:
+            self.rate_limiter.acquire()
+            started = monotonic()
+            with self._request_seconds.time():
+                try:
+                    query_result = self._execute_query(params)
+                except requests.Timeout:
+                    query_result = None
+            if query_result is None:
+                self._report_timeout(started, try_count)
+                sleep(self.rate_limiter.backoff_delay(try_count))
+                try_count += 1
+                self._retries.inc()
+                continue
+            if query_result.status_code == 414 and try_count < self.max_tries:
+                self._shorten_get_queries(params)
+                try_count += 1
+                continue
+            query_result_json = None
+            if query_result.status_code == 200:
+                try:
+                    query_result_json = query_result.json()
+                except ValueError:
+                    pass
+
+            self._report_batch(batch_size, started, len(query_result.content), query_result.status_code,
+                               query_result_json)
+            if not self._must_retry(query_result.status_code, query_result.headers, query_result_json):
+                if self.cassette is not None:
+                    self.cassette.record(params, query_result.content)
+                return query_result_json
+
+            if try_count >= self.max_tries:
                 raise Exception(
                         f"http request to fetch wikidata ids to entity failed with {query_result.status_code}. query_result: {query_result}")
 
+            sleep(self.rate_limiter.backoff_delay(try_count))
+            try_count += 1
+            self._retries.inc()
+
+    def entities_by_ids(self, ids, props='info'):
+        """
+        Requests wikidata items by their ids, e.g. to revalidate cached linkings.
+
+        :param ids: Collection of at most entities_per_request wikidata ids.
+        :param props: Properties to request, 'info' only returns the lastrevid and modified timestamp of every item.
+        :return: Dictionary<id, json of the item> as returned by 'wbgetentities'. Items which have been merged into
+            another item are returned under their requested id (the json contains the id of the target), deleted
+            items contain the key 'missing'.
+        """
+        if len(ids) > self.entities_per_request:
+            raise Exception(f"Only {self.entities_per_request} entities are allowed per request. You are trying to "
+                            f"request {len(ids)} entities at once.")
+
+        if len(ids) == 0:
+            return dict()
+
+        params = self._ids_query_params("|".join(ids), props)
+        if self._replaying():
+            self._methods.inc(labels=('replay',))
+            query_result_jsons = [query_result_json for _, query_result_json in self.cassette.replay(params)]
+        else:
+            query_result_jsons = [self._request(params, len(ids))]
+
+        items = dict()
+        for query_result_json in query_result_jsons:
+            if 'entities' not in query_result_json:
+                raise Exception(f"http request failed, Key 'entities' not found in result. ids: {ids}, "
+                                f"query_result: {query_result_json}")
+
+            for key, value in query_result_json['entities'].items():
+                # wbgetentities answers with the target of merged items, the redirect tells the requested id
+                items[value.get('redirects', {}).get('from', key)] = value
+
+        if len(query_result_jsons) > 1:
+            # answered by the responses of other batches
+            items = {item_id: items[item_id] for item_id in ids if item_id in items}
+        return items
+
+    def _must_retry(self, status_code, headers, query_result_json):
+        """
+        Reports the outcome of a request to the rate limiter.
+
+        :param query_result_json: The decoded json response or None if the response could not be decoded.
+        :return: True if the request failed and has to be repeated.
+        """
+        error = query_result_json.get('error', None) if query_result_json is not None else None
+        maxlag_exceeded = isinstance(error, dict) and error.get('code', None) == 'maxlag'
+        self._responses.inc(labels=('maxlag' if maxlag_exceeded else str(status_code),))
 
-        # parse results
-        query_result_json = query_result.json()
+        if status_code in (429, 503) or maxlag_exceeded:
+            self.rate_limiter.record_throttle(parse_retry_after(headers.get('Retry-After', None)))
+            return True
+
+        if status_code != 200 or query_result_json is None:
+            self.rate_limiter.record_error()
+            return True
+
+        self.rate_limiter.record_success()
+        return False
+
+    def _report_batch(self, batch_size, started, response_bytes, status_code, query_result_json):
+        """
+        Reports the latency and size of an answer to the batch sizer. Throttled requests are left to the rate limiter,
+        other failures which do not depend on the size of the batch (e.g. a 500) are only retried.
+
+        :param started: monotonic() when the request has been sent.
+        """
+        if self.batch_sizer is None:
+            return
+
+        if status_code in self.batch_size_error_codes:
+            self.batch_sizer.record_error(started)
+            return
+
+        error = query_result_json.get('error', None) if query_result_json is not None else None
+        if isinstance(error, dict) and error.get('code', None) == 'maxlag':
+            return
+
+        if status_code == 200 and query_result_json is not None:
+            self.batch_sizer.record_success(batch_size, started, monotonic() - started, response_bytes)
+
+    def _report_batch_error(self, started):
+        """
+        Reports a request which timed out to the batch sizer.
+        """
+        if self.batch_sizer is not None:
+            self.batch_sizer.record_error(started)
+
+    def _report_timeout(self, started, try_count):
+        """
+        Reports a request which has not been answered within request_timeout.
+
+        :raises Exception: If it was the last of max_tries tries.
+        """
+        self._responses.inc(labels=('timeout',))
+        self._report_batch_error(started)
+        if try_count >= self.max_tries:
+            raise Exception(f"http request to fetch wikidata ids to entity timed out {try_count} times after "
+                            f"{self.request_timeout} seconds.")
+
+    def _parse_query_result(self, entities, query_result_json, not_found_entities):
+        """
+        Maps the json answer of a 'wbgetentities' request back to the requested entities.
+
+        :param entities: The entities which have been requested (in request order).
+        :param query_result_json: The decoded json response.
+        :param not_found_entities: Expects a set which will be used to store entities that could not be linked.
+        :return: Returns Dictionary<entity, WikidataNamedEntity>.
+        """
+        linked_entities = dict()
+        _not_found_entities = set()
+        titles = "|".join(entities)
 
         if 'entities' not in query_result_json:
             # add all to not found entities with warning
             raise Exception(f"http request failed, Key 'entities' not found in result. titles: {titles}, query_result: "
                             f"{query_result_json}")
 
+        redirects = self._redirects(query_result_json)
+        results = []
+        results_by_title = dict()
         for key, value in query_result_json['entities'].items():
-            description = None
             if key[0] != 'Q':
                 _not_found_entities.add(value['title'])
                 continue
-            try:
-                description = value['descriptions']['en']['value']
-            except KeyError:
-                pass
 
-            while entities[entity_index] in _not_found_entities:
-                entity_index += 1
+            results.append((key, value))
+            title = value.get('sitelinks', {}).get(self.site, {}).get('title', None)
+            if title is not None:
+                results_by_title[title] = (key, value)
 
-            if description is not None and 'disambiguation page' in description:
-                _not_found_entities.add(entities[entity_index])
+        # Entities are matched to the result carrying their title. Entities which have been redirected are matched to
+        # the remaining results by position (wbgetentities answers in request order).
+        matched_results = dict()
+        for entity in entities:
+            result = results_by_title.get(entity, None) or results_by_title.get(entity.replace('_', ' '), None)
+            if result is not None:
+                matched_results[entity] = result
+
+        matched_keys = {key for key, value in matched_results.values()}
+        unmatched_results = iter([result for result in results if result[0] not in matched_keys])
+        for entity in entities:
+            if entity in matched_results or entity in _not_found_entities:
+                continue
+            result = next(unmatched_results, None)
+            if result is None:
+                _not_found_entities.add(entity)
             else:
-                linked_entity = WikidataNamedEntity(entities[entity_index], key, description)
-                linked_entities[linked_entity.entity] = linked_entity
+                matched_results[entity] = result
 
-            entity_index += 1
+        for entity, (key, value) in matched_results.items():
+            descriptions = value.get('descriptions', {})
+            if self.is_disambiguation(descriptions):
+                _not_found_entities.add(entity)
+            else:
+                sitelinks = {site: sitelink['title'] for site, sitelink in value.get('sitelinks', {}).items()}
+                title = sitelinks.get(self.site, None)
+                linked_entities[entity] = WikidataNamedEntity(
+                    entity, key, self.description(descriptions), value.get('lastrevid', 0), value.get('modified', ''),
+                    title, self._redirect_chain(entity, title, redirects), sitelinks,
+                    {language: description['value'] for language, description in descriptions.items()})
 
         if not_found_entities is not None:
             not_found_entities.update(_not_found_entities)
 
         return linked_entities
 
-    def _execute_query(self, titles, normalize):
-        wikidata_api_url = "https://www.wikidata.org/w/api.php"
+    @staticmethod
+    def _redirects(query_result_json):
+        """
+        :return: Dictionary<from, to> of all titles the api reports as normalized or redirected.
+        """
+        redirects = dict()
+        for key in ('normalized', 'redirects'):
+            mapping = query_result_json.get(key, None)
+            if isinstance(mapping, dict):
+                mapping = mapping.values()
+            for redirect in mapping or ():
+                if isinstance(redirect, dict) and 'from' in redirect and 'to' in redirect:
+                    redirects[redirect['from']] = redirect['to']
+        return redirects
+
+    @staticmethod
+    def _redirect_chain(entity, title, redirects):
+        """
+        :return: Tuple of the titles between entity and title according to redirects.
+        """
+        chain = []
+        current = redirects.get(entity, None)
+        while current is not None and current != title and current != entity and current not in chain:
+            chain.append(current)
+            current = redirects.get(current, None)
+        return tuple(chain)
+
+    def _use_post(self, params):
+        return len(urlencode(params)) > self.max_get_query_length
+
+    def _shorten_get_queries(self, params):
+        """
+        Lowers max_get_query_length after the server rejected the url of params as too long (414), so params and all
+        longer queries are sent as POST.
+        """
+        self._responses.inc(labels=('414',))
+        self.max_get_query_length = min(self.max_get_query_length, len(urlencode(params)) - 1)
+
+    def _execute_query(self, params):
+        if self._use_post(params):
+            self._methods.inc(labels=('POST',))
+            return self._session.post(url=self.wikidata_api_url, data=params, timeout=self.request_timeout)
+        self._methods.inc(labels=('GET',))
+        return self._session.get(url=self.wikidata_api_url, params=params, timeout=self.request_timeout)
+
+    def _sitefilter(self):
+        return "|".join((self.site,) + self.related_sites)
+
+    def _requested_languages(self):
+        return "|".join(self.languages + (() if 'en' in self.languages else ('en',)))
+
+    def _query_params(self, titles, normalize):
         params = {
             'action': "wbgetentities",
-            'sites': "enwiki",
+            'sites': self.site,
             'titles': titles,
             'redirects': "yes",
-            'props': 'info|descriptions',
+            'props': 'info|descriptions|sitelinks',
+            'sitefilter': self._sitefilter(),
             'format': "json",
-            'languages': 'en'
+            'languages': self._requested_languages(),
+            'maxlag': self.maxlag
         }
         if normalize:
             params['normalize'] = '1'
 
-        return self._session.get(url=wikidata_api_url, params=params)
+        return params
+
+    def _ids_query_params(self, ids, props):
+        return {
+            'action': "wbgetentities",
+            'ids': ids,
+            'redirects': "yes",
+            'props': props,
+            'sitefilter': self._sitefilter(),
+            'format': "json",
+            'languages': self._requested_languages(),
+            'maxlag': self.maxlag
+        }
 
     def entity_id(self, entity):
         """
@@ -208,8 +692,10 @@ class WikidataEntityLinker(NamedEntityLinker):
         """
         Requests wikidata ids to every entity in entities.
         The linking is performed using wikidata's API call to 'wbgetentities'.
-        The linking is performed in two iterations. In the first iteration it will be tried to link all entities without
-        normalization. In the second iteration a request is send per not found entity with normalization enabled.
+        The linking is performed in three iterations. In the first iteration it will be tried to link all entities
+        without normalization. In the second iteration the normalization candidates of all not found entities are
+        requested in full batches. In the third iteration a request with normalization enabled is send per entity,
+        which still could not be linked and whose normalization can not be reproduced locally.
 
         :param entities: Collection of entities (strings). Each entity must contain at least one character.
             WikidataEntityLinker will try to link several entities at once (in blocks of max. 50 entities per query).
@@ -225,12 +711,20 @@ class WikidataEntityLinker(NamedEntityLinker):
                             f"request {len(entities)} entities at once.")
 
         missing_batch_entities = set()
+        self._pass_requests.inc(labels=('batch',))
         linked_entities = self._link_entities(entities, missing_batch_entities)
-
-        entity_counter = 0
-        for entity in missing_batch_entities:
-            entity_counter += 1
-            sleep(0.05)
+        missing_batch_entities = [entity for entity in entities if entity in missing_batch_entities]
+
+        candidates, candidate_batches = self._normalization_candidate_batches(missing_batch_entities, entities)
+        linked_candidates = dict()
+        self._pass_requests.inc(len(candidate_batches), ('candidates',))
+        for candidate_batch in candidate_batches:
+            linked_candidates.update(self._link_entities(candidate_batch, None, normalize=False))
+
+        unresolved_entities = self._apply_normalization_candidates(candidates, linked_candidates, linked_entities,
+                                                                   not_found_entities)
+        self._pass_requests.inc(len(unresolved_entities), ('normalize',))
+        for entity in unresolved_entities:
             linked_entity, linking_info = self.entity_id(entity)
             if linked_entity is None:
                 if not_found_entities is not None:
@@ -245,13 +739,189 @@ class WikidataEntityLinker(NamedEntityLinker):
     def normalize(entity):
         return entity.capitalize()
 
+    @staticmethod
+    def mediawiki_title(entity):
+        """
+        The title mediawiki's normalization produces for entity: spaces instead of underscores, first letter uppercase.
+        """
+        title = entity.replace('_', ' ').strip()
+        return title[:1].upper() + title[1:]
+
+    @staticmethod
+    def normalization_candidates(entity):
+        """
+        Generates the titles entity may be known by, most likely title first: the title mediawiki's normalization
+        would produce (see mediawiki_title) followed by further capitalization variants.
+        """
+        title = entity.replace('_', ' ').strip()
+        candidates = [WikidataEntityLinker.mediawiki_title(entity), title.capitalize(), title.title(), title.upper(), title.lower(),
+                      entity[:1].upper() + entity[1:]]
+
+        unique_candidates = []
+        for candidate in candidates:
+            if candidate and candidate != entity and candidate not in unique_candidates:
+                unique_candidates.append(candidate)
+        return unique_candidates
+
+    @staticmethod
+    def needs_server_side_normalization(entity):
+        """
+        Whether mediawiki's normalization of entity may differ from all normalization_candidates (unicode
+        normalization, collapsing of whitespace, ...).
+        """
+        title = entity.replace('_', ' ').strip()
+        return unicodedata.normalize('NFC', title) != title or '  ' in title or title != entity.replace('_', ' ')
+
+    def _normalization_candidate_batches(self, entities, requested_entities):
+        """
+
+        :param entities: Entities which could not be linked.
+        :param requested_entities: Titles which have already been requested and must not be requested again.
+        :return: A tuple<Dictionary<entity, list<candidate>>, list<list<candidate>>>. The second value contains every
+            candidate exactly once, split into batches of batch_size() candidates.
+        """
+        candidates = {entity: self.normalization_candidates(entity) for entity in entities}
+
+        requested_entities = set(requested_entities)
+        unique_candidates = []
+        for entity_candidates in candidates.values():
+            for candidate in entity_candidates:
+                if candidate not in requested_entities:
+                    requested_entities.add(candidate)
+                    unique_candidates.append(candidate)
+
+        batch_size = self.batch_size()
+        candidate_batches = [unique_candidates[i:i + batch_size] for i in range(0, len(unique_candidates), batch_size)]
+        return candidates, candidate_batches
+
+    def _apply_normalization_candidates(self, candidates, linked_candidates, linked_entities, not_found_entities):
+        """
+        Links every entity to its most likely linked candidate.
+
+        :return: Entities which could not be linked but may be linked using server side normalization.
+        """
+        unresolved_entities = []
+        for entity, entity_candidates in candidates.items():
+            for candidate in entity_candidates:
+                linked_candidate = linked_candidates.get(candidate, None)
+                if linked_candidate is not None:
+                    linked_entities[entity] = WikidataNamedEntity(entity, linked_candidate.linked_entity,
+                                                                  linked_candidate.description,
+                                                                  linked_candidate.lastrevid, linked_candidate.modified,
+                                                                  linked_candidate.title,
+                                                                  (candidate,) + tuple(linked_candidate.redirects),
+                                                                  linked_candidate.sitelinks,
+                                                                  linked_candidate.descriptions)
+                    break
+            else:
+                if self.needs_server_side_normalization(entity):
+                    unresolved_entities.append(entity)
+                elif not_found_entities is not None:
+                    not_found_entities.add(entity)
+
+        return unresolved_entities
+
+
+class _InFlightRequest:
+    __slots__ = ('done', 'linked_entity', 'failed')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.linked_entity = None
+        self.failed = False
+
+
+class InFlightRequests:
+    """
+    Single-flight registry for entities which are currently requested from wikidata. A thread asking for an entity
+    another thread is already requesting waits for that request instead of sending its own one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = dict()
+        self.requested_entities = 0
+        self.coalesced_entities = 0
+
+    def claim(self, entities):
+        """
+
+        :return: A tuple<list, Dictionary<entity, _InFlightRequest>>. The first value contains the entities the caller
+            has to request (and to complete afterwards), the second one the requests of other threads to wait for.
+        """
+        owned_entities = []
+        foreign_requests = dict()
+        with self._lock:
+            for entity in entities:
+                request = self._requests.get(entity, None)
+                if request is None:
+                    self._requests[entity] = _InFlightRequest()
+                    owned_entities.append(entity)
+                else:
+                    foreign_requests[entity] = request
+
+            self.requested_entities += len(owned_entities)
+            self.coalesced_entities += len(foreign_requests)
+
+        return owned_entities, foreign_requests
+
+    def complete(self, entities, linked_entities, failed=False):
+        """
+        Hands the results of claimed entities to all waiting threads.
+
+        :param linked_entities: Dictionary<entity, WikidataNamedEntity>. Entities which are not part of the dictionary
+            could not be linked.
+        :param failed: True if the request failed. Waiting threads will request the entities themselves.
+        """
+        with self._lock:
+            requests = [self._requests.pop(entity) for entity in entities]
+
+        for entity, request in zip(entities, requests):
+            request.linked_entity = linked_entities.get(entity, None)
+            request.failed = failed
+            request.done.set()
+
+    @staticmethod
+    def wait(requests):
+        """
+
+        :return: A tuple<Dictionary<entity, WikidataNamedEntity>, list>. The first value contains the results of all
+            successful requests (None if an entity could not be linked), the second one all entities whose request
+            failed.
+        """
+        results = dict()
+        failed_entities = []
+        for entity, request in requests.items():
+            request.done.wait()
+            if request.failed:
+                failed_entities.append(entity)
+            else:
+                results[entity] = request.linked_entity
+        return results, failed_entities
+
+    def statistics(self):
+        """
+
+        :return: Dictionary containing the number of entities which have been requested and the number of entities
+            which have been taken from requests of other threads (saved requests).
+        """
+        with self._lock:
+            return {'requested_entities': self.requested_entities, 'coalesced_entities': self.coalesced_entities}
+
+
+# shared by every WikidataEntityLinkerProxy of this process which does not get its own registry
+shared_in_flight_requests = InFlightRequests()
+
 
 class WikidataEntityLinkerProxy(NamedEntityLinker):
     def __init__(self, filename=None, entities_per_request=50, wikidata_entity_linker=None,
-                 persistent_entity_linker=None):
+                 persistent_entity_linker=None, in_flight_requests=None, metrics=None):
         """
 
         :param filename: Path to persistent storage
+        :param in_flight_requests: InFlightRequests used to coalesce concurrent requests for the same entity. If None,
+            the registry shared by all proxies of this process is used.
+        :param metrics: MetricsRegistry to report to. If None, the registry shared by the whole process is used.
         """
         if filename is None:
             if persistent_entity_linker is None:
@@ -270,6 +940,16 @@ class WikidataEntityLinkerProxy(NamedEntityLinker):
         else:
             self._wikidata_entity_linker = wikidata_entity_linker
 
+        self.in_flight_requests = in_flight_requests if in_flight_requests is not None else shared_in_flight_requests
+
+        metrics = metrics if metrics is not None else shared_metrics
+        self._coalesced_entities = metrics.counter('proxy_coalesced_entities_total', "Entities which were already "
+                                                                                     "requested by another caller")
+        self._linker_seconds = metrics.histogram('proxy_linker_seconds', "Duration of entity_ids calls of the "
+                                                                         "linker behind the cache")
+        self._wait_seconds = metrics.histogram('proxy_wait_seconds', "Time spent waiting for entities requested by "
+                                                                     "other callers")
+
     def entity_id(self, entity):
         linked_entity, linking_info = self._persistent_entity_linker.entity_id(entity)
 
@@ -277,39 +957,121 @@ class WikidataEntityLinkerProxy(NamedEntityLinker):
             return linked_entity, linking_info
 
         if linking_info == NamedEntityLinking.NOT_FOUND:
-            linked_entity, linking_info = self._wikidata_entity_linker.entity_id(entity)
-            if linking_info == NamedEntityLinking.SUCCESS:
-                self._persistent_entity_linker.persist_entity(linked_entity)
-            else:
-                self._persistent_entity_linker.persist_entity(WikidataNamedEntity(entity, "", ""))
+            linked_entities = self.entity_ids([entity])
+            if entity in linked_entities:
+                return linked_entities[entity], NamedEntityLinking.SUCCESS
+            return None, NamedEntityLinking.NOT_FOUND
 
-        linked_entity, linking_info
+        return linked_entity, linking_info
 
     def entity_ids(self, entities, not_found_entities=None):
-        # sammel alle entities, die wir so nicht an
+        persistent_linked_entities, not_cached_entities = self._cached_entity_ids(entities, not_found_entities)
+        owned_entities, foreign_requests = self._claim(not_cached_entities, persistent_linked_entities,
+                                                       not_found_entities)
 
-        not_matched_entities = set()
-        persistent_linked_entities = self._persistent_entity_linker.entity_ids(entities, not_matched_entities)
-
-        not_cached_entities = []
-
-        for entity in not_matched_entities:
-            linked_entity, linking_info = self._persistent_entity_linker.entity_id(entity)
-            if linking_info == NamedEntityLinking.NOT_FOUND:
-                not_cached_entities.append(entity)
-            elif not_found_entities is not None and linking_info == NamedEntityLinking.NO_LINKING_FOUND:
-                not_found_entities.add(entity)
+        not_matched_entities_using_wikidata = set()
+        try:
+            with self._linker_seconds.time():
+                linked_entities = self._wikidata_entity_linker.entity_ids(owned_entities,
+                                                                          not_matched_entities_using_wikidata)
+            self._persist_linked_entities(linked_entities, not_matched_entities_using_wikidata)
+        except BaseException:
+            self.in_flight_requests.complete(owned_entities, dict(), failed=True)
+            raise
+        self.in_flight_requests.complete(owned_entities, linked_entities)
+
+        with self._wait_seconds.time():
+            foreign_linked_entities, failed_entities = self.in_flight_requests.wait(foreign_requests)
+        if failed_entities:
+            not_matched_failed_entities = set()
+            failed_linked_entities = self._wikidata_entity_linker.entity_ids(failed_entities,
+                                                                             not_matched_failed_entities)
+            self._persist_linked_entities(failed_linked_entities, not_matched_failed_entities)
+            foreign_linked_entities.update(failed_linked_entities)
+            foreign_linked_entities.update((entity, None) for entity in not_matched_failed_entities)
+
+        return self._merge_linked_entities(persistent_linked_entities, linked_entities,
+                                           not_matched_entities_using_wikidata, foreign_linked_entities,
+                                           not_found_entities)
+
+    async def async_entity_ids(self, entities, not_found_entities=None):
+        """
+        Same as entity_ids, but awaits the wikidata linker instead of blocking on it. Requires the wikidata linker to
+        provide an async_entity_ids coroutine (see AsyncWikidataEntityLinker).
+        """
+        persistent_linked_entities, not_cached_entities = self._cached_entity_ids(entities, not_found_entities)
+        owned_entities, foreign_requests = self._claim(not_cached_entities, persistent_linked_entities,
+                                                       not_found_entities)
 
         not_matched_entities_using_wikidata = set()
-        linked_entities = self._wikidata_entity_linker.entity_ids(not_cached_entities,
-                                                                  not_matched_entities_using_wikidata)
+        try:
+            with self._linker_seconds.time():
+                linked_entities = await self._wikidata_entity_linker.async_entity_ids(
+                    owned_entities, not_matched_entities_using_wikidata)
+            self._persist_linked_entities(linked_entities, not_matched_entities_using_wikidata)
+        except BaseException:
+            self.in_flight_requests.complete(owned_entities, dict(), failed=True)
+            raise
+        self.in_flight_requests.complete(owned_entities, linked_entities)
+
+        foreign_linked_entities = dict()
+        if foreign_requests:
+            # the requests may be owned by other threads, hence they are awaited outside of the event loop
+            with self._wait_seconds.time():
+                foreign_linked_entities, failed_entities = await asyncio.get_running_loop().run_in_executor(
+                    None, self.in_flight_requests.wait, foreign_requests)
+            if failed_entities:
+                not_matched_failed_entities = set()
+                failed_linked_entities = await self._wikidata_entity_linker.async_entity_ids(
+                    failed_entities, not_matched_failed_entities)
+                self._persist_linked_entities(failed_linked_entities, not_matched_failed_entities)
+                foreign_linked_entities.update(failed_linked_entities)
+                foreign_linked_entities.update((entity, None) for entity in not_matched_failed_entities)
+
+        return self._merge_linked_entities(persistent_linked_entities, linked_entities,
+                                           not_matched_entities_using_wikidata, foreign_linked_entities,
+                                           not_found_entities)
+
+    def _claim(self, not_cached_entities, persistent_linked_entities, not_found_entities):
+        owned_entities, foreign_requests = self.in_flight_requests.claim(not_cached_entities)
+        self._coalesced_entities.inc(len(foreign_requests))
+
+        # another thread may have persisted some of the entities between the cache lookup and the claim
+        cached_linked_entities, owned_not_cached_entities = self._cached_entity_ids(owned_entities, not_found_entities)
+        if len(owned_not_cached_entities) < len(owned_entities):
+            owned_not_cached_entities_set = set(owned_not_cached_entities)
+            self.in_flight_requests.complete([entity for entity in owned_entities
+                                              if entity not in owned_not_cached_entities_set], cached_linked_entities)
+            persistent_linked_entities.update(cached_linked_entities)
+
+        return owned_not_cached_entities, foreign_requests
+
+    def _cached_entity_ids(self, entities, not_found_entities):
+        """
+        Looks up entities in the persistent storage.
 
+        :return: A tuple<Dictionary<entity, WikidataNamedEntity>, list>. The first value contains all cached linkings,
+            the second one all entities which have never been requested before.
+        """
+        return self._persistent_entity_linker.cached_entity_ids(entities, not_found_entities)
+
+    def _persist_linked_entities(self, linked_entities, not_matched_entities_using_wikidata):
         for key, entity in linked_entities.items():
             self._persistent_entity_linker.persist_entity(entity)
 
         for entity in not_matched_entities_using_wikidata:
             self._persistent_entity_linker.persist_entity(WikidataNamedEntity(entity, "", ""))
-            if not_found_entities is not None:
+
+    @staticmethod
+    def _merge_linked_entities(persistent_linked_entities, linked_entities, not_matched_entities_using_wikidata,
+                               foreign_linked_entities, not_found_entities):
+        if not_found_entities is not None:
+            not_found_entities.update(not_matched_entities_using_wikidata)
+
+        for entity, linked_entity in foreign_linked_entities.items():
+            if linked_entity is not None:
+                linked_entities[entity] = linked_entity
+            elif not_found_entities is not None:
                 not_found_entities.add(entity)
 
         smaller_dict = persistent_linked_entities
@@ -337,51 +1099,11 @@ def link_entities(entities, output_file_writer, cache, not_found_entities_file_w
         not_found_entities_file_writer.writerow([item])
 
 
-_rows_read = 0
-
-
-def entity_linker_thread(reader, output_file_writer, not_found_entities_file_writer, read_lock, write_lock,
-                         persistent_entity_linker, entities_per_request):
-    global _rows_read
-    entities = []
-
-    proxy = WikidataEntityLinkerProxy(persistent_entity_linker=persistent_entity_linker)
-
-    # Habe einen Threadpool, der fleißig auf diese Datei polled
-    reading = True
-    while reading:
-        reading = False
-        entities.clear()
-        rows_read = 0
-        read_lock.acquire()
-        for row in reader:
-            reading = True
-            if '&' not in row[0] and '|' not in row[0]:
-                entities.append(row[0])
-                rows_read += 1
-            if rows_read % entities_per_request == 0:
-                break
-        read_lock.release()
-
-        if not reading:
-            break
-
-        not_found_entities = set()
-        try:
-            linked_entities = proxy.entity_ids(entities, not_found_entities)
-
-            with write_lock:
-                for entity in linked_entities.values():
-                    output_file_writer.writerow([entity.entity, entity.linked_entity])
-
-                for item in not_found_entities:
-                    not_found_entities_file_writer.writerow([item])
-
-                _rows_read += rows_read
-                print(f"{_rows_read} entities processed")
-        except Exception as ex:
-            print(f"{'|'.join(entities)} caused exception: {ex}")
-
+def labels_by_frequency(entities):
+    """
+    :return: The distinct entities ordered by decreasing number of occurrences, ties in order of first occurrence.
+    """
+    return [entity for entity, _ in collections.Counter(entities).most_common()]
 
 
 if __name__ == '__main__':
@@ -393,68 +1115,405 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output', help="csv file to which the linking will be saved. (default='linking.csv')",
                         default="linking.csv")
     parser.add_argument('-c', '--cache', help="csv file which will be used to store all data fetched from wikidata to "
-                                              "speedup future queries. (default='cache.csv')", default="cache.csv")
+                                              "speedup future queries. Files ending with .sqlite, .sqlite3 or .db "
+                                              "are stored in an indexed SQLite database instead. "
+                                              "(default='cache.csv')", default="cache.csv")
+    parser.add_argument('--cache-backend', help="storage backend of the cache (default: derived from the file "
+                                                "extension of --cache)", choices=['csv', 'sqlite'], default=None)
+    parser.add_argument('--write-batch-size', help="number of new cache entries which are written to the cache at "
+                                                   "once by a background writer. 0 writes every entry immediately "
+                                                   "(default=1000)", default=1000, type=int)
+    parser.add_argument('--write-latency', help="maximum number of seconds a new cache entry waits for the "
+                                                "background writer (default=1.0)", default=1.0, type=float)
+    parser.add_argument('--fsync', help="'never' leaves syncing the cache to the operating system, 'batch' syncs "
+                                        "the cache after every write of the background writer (default='never')",
+                        choices=WriteBehindEntityStore.fsync_policies, default='never')
+    parser.add_argument('--alias-index', help="csv file recording the canonical page title every linked entity "
+                                              "resolved to. The cache then stores one entry per page and answers "
+                                              "lookups of every known spelling, redirect or normalized form of it "
+                                              "without a request (default: no alias index)", default=None)
+    parser.add_argument('--memory-cache-entries', help="keep only the most recently used entries of the cache in "
+                                                       "memory, at most this many. Useful with a SQLite cache, which "
+                                                       "does not have to be loaded (default: not bounded)",
+                        default=None, type=int)
+    parser.add_argument('--memory-cache-bytes', help="keep only the most recently used entries of the cache in "
+                                                     "memory, at most this many bytes (estimated, default: not "
+                                                     "bounded)", default=None, type=int)
+    parser.add_argument('--cache-stripes', help="number of independently locked parts of the memory cache "
+                                                "(default=16)", default=16, type=int)
     parser.add_argument('-n', '--not-found-entities', help="file to which all not found entities will be stored  ("
                                                            "default='not_found_entities.txt')",
                         default="not_found_entities.txt")
     parser.add_argument('-d', '--delimiter', help="delimiter used to parse file containing the model/word list. You "
                                                   "may need to surround the delimiter with ''  ( "
                                                   "default=' ')")
-    parser.add_argument('-t', '--threads', help="number of parallel http requests (default=20)", default=20)
+    parser.add_argument('-t', '--threads', help="number of parallel http requests (default=20)", default=20,
+                        type=int)
+    parser.add_argument('-e', '--engine', help="'threads' performs blocking http requests from --threads threads, "
+                                               "'async' performs all http requests from a single event loop "
+                                               "(default='threads')", choices=['threads', 'async'],
+                        default='threads')
+    parser.add_argument('--max-in-flight', help="maximum number of concurrent http requests when using the async "
+                                                "engine (default=200)", default=200, type=int)
+    parser.add_argument('--api-url', help="api.php used to request wikidata, e.g. a mirror or the mock server in "
+                                          "benchmarks/ (default='{}')".format(WikidataEntityLinker.wikidata_api_url),
+                        default=None)
+    cassette_arguments = parser.add_mutually_exclusive_group()
+    cassette_arguments.add_argument('--record', help="SQLite file to which every successful wbgetentities request "
+                                                     "and its compressed response is recorded, as well as the "
+                                                     "rows which failed, to be replayed by --replay",
+                                    metavar='CASSETTE')
+    cassette_arguments.add_argument('--replay', help="answer all wbgetentities requests from a file written by "
+                                                     "--record instead of requesting wikidata. Rows which failed in "
+                                                     "the recorded run and entities which have not been recorded "
+                                                     "fail, so replay the same model against the cache the recorded "
+                                                     "run started with. Batches have a fixed size (--batch-sizing is "
+                                                     "ignored)", metavar='CASSETTE')
+    parser.add_argument('--sites', help="sites whose page titles are linked, e.g. enwiki dewiki frwiki. All sites are "
+                                        "linked in one pass and share the cache, which is keyed by site and title. "
+                                        "Entities of further sites which are the title of an item found on the "
+                                        "first site need no request of their own. Unless only enwiki is linked, "
+                                        "every site gets its own output files with the site as suffix, e.g. "
+                                        "linking.dewiki.csv (default: enwiki)", nargs='+', default=[default_site])
+    parser.add_argument('--languages', help="further languages of the cached descriptions in order of preference. "
+                                            "Every site prefers its own language, the descriptions of all languages "
+                                            "are fetched by the same request (default: the languages of --sites)",
+                        nargs='+', default=[])
+    parser.add_argument('--entities-per-request', help="maximum number of entities requested at once (default=50, "
+                                                       "the maximum allowed by wikidata)", default=50, type=int)
+    parser.add_argument('--batch-sizing', help="'adaptive' shrinks batches while requests are slow, fail or return "
+                                               "too much data and grows them up to --entities-per-request "
+                                               "otherwise, 'fixed' always requests --entities-per-request entities "
+                                               "(default='adaptive')", choices=['adaptive', 'fixed'],
+                        default='adaptive')
+    parser.add_argument('--min-entities-per-request', help="smallest batch of adaptive batch sizing (default=5)",
+                        default=5, type=int)
+    parser.add_argument('--target-latency', help="seconds a request may take before adaptive batch sizing shrinks "
+                                                 "the batches (default=2.0)", default=2.0, type=float)
+    parser.add_argument('--request-rate', help="initial and maximum number of requests per second. The rate is "
+                                               "lowered whenever wikidata throttles us (default: starts at 50 and "
+                                               "grows up to 200)", default=None, type=float)
+    parser.add_argument('--request-timeout', help="seconds after which a request which has not been answered is "
+                                                  "repeated, it counts as failed try and shrinks adaptive batches "
+                                                  "(default=60)", default=60, type=float)
+    parser.add_argument('-s', '--source', help="'wikidata' links entities using the wikidata api, 'dump' links "
+                                               "entities using an index built by dump_entity_linker.py, "
+                                               "'mediawiki-db' links entities using the page_props table of a local "
+                                               "mediawiki mirror (default='wikidata')",
+                        choices=['wikidata', 'dump', 'mediawiki-db'], default='wikidata')
+    parser.add_argument('--fallback', help="request entities which could not be linked by --source from the "
+                                           "wikidata api", action='store_true')
+    parser.add_argument('--dump-index', help="index file used by --source dump")
+    parser.add_argument('--db-host', help="host of the mediawiki database (default='localhost')",
+                        default='localhost')
+    parser.add_argument('--db-user', help="user of the mediawiki database (default='root')", default='root')
+    parser.add_argument('--db-password', help="password of the mediawiki database (default='')", default='')
+    parser.add_argument('--db-name', help="name of the mediawiki database (default='mpss2019')", default='mpss2019')
+    parser.add_argument('--ordered', help="write the linking and the not found entities in the order of the model "
+                                          "file", action='store_true')
+    parser.add_argument('--resume', help="periodically save a checkpoint and continue an interrupted run from its "
+                                         "last checkpoint instead of starting over. Implies --ordered",
+                        action='store_true')
+    parser.add_argument('--checkpoint', help="checkpoint file used by --resume (default: --output with the suffix "
+                                             "'.checkpoint')")
+    parser.add_argument('--checkpoint-interval', help="number of written rows after which a checkpoint is saved "
+                                                      "(default=10000)", default=10000, type=int)
+    parser.add_argument('--deduplicate', help="look up and request every distinct label once and fan its result out "
+                                              "to all rows with this label. 'exact' remembers the results of up to "
+                                              "--dedup-max-keys labels, 'bloom' only remembers the results of labels "
+                                              "which occurred before (tracked by a bloom filter of "
+                                              "--bloom-capacity labels), which suits very large inputs whose labels "
+                                              "mostly occur once (default: off)", choices=('exact', 'bloom'),
+                        default=None)
+    parser.add_argument('--dedup-max-keys', help="maximum number of labels whose result --deduplicate remembers "
+                                                 "(default=1000000)", default=1000000, type=int)
+    parser.add_argument('--bloom-capacity', help="number of distinct labels the bloom filter of --deduplicate bloom "
+                                                 "is sized for at a false positive rate of 1%% (default=10000000)",
+                        default=10000000, type=int)
+    parser.add_argument('--frequency-first', help="count the labels of the model first and link the distinct labels "
+                                                  "in order of decreasing frequency before writing the output, so an "
+                                                  "interrupted run has cached the most frequent labels. Keeps every "
+                                                  "distinct label in memory while counting",
+                        action='store_true')
+    parser.add_argument('--shard', help="only link the entities hashed to shard index of count shards, given as "
+                                        "index/count. Output files and the cache segment of the shard get the suffix "
+                                        "'.shard-index-of-count', see sharded_linking.py to run and merge all shards",
+                        type=parse_shard, default=None)
+    parser.add_argument('--metrics', help="file to which metrics (cache hits, http requests, latencies of every "
+                                          "stage, ...) are exported periodically. Metrics are disabled if not set")
+    parser.add_argument('--metrics-format', help="'jsonl' appends one json object per interval, 'prometheus' "
+                                                 "replaces the file with the Prometheus text format "
+                                                 "(default='jsonl')", choices=MetricsExporter.formats,
+                        default='jsonl')
+    parser.add_argument('--metrics-interval', help="seconds between two metric exports (default=10)", default=10.0,
+                        type=float)
     parser.add_argument('-q', '--quotechar', help='character used to quote special characters (default="")',
                         default="")
 
     args_dict = vars(parser.parse_args())
 
+    if args_dict['source'] == 'dump':
+        if args_dict['dump_index'] is None:
+            parser.error("--source dump requires --dump-index")
+    if args_dict['source'] != 'wikidata' and args_dict['engine'] == 'async':
+        parser.error(f"--source {args_dict['source']} can only be used with --engine threads")
+    sites = list(dict.fromkeys(args_dict['sites']))
+    multi_site = sites != [default_site]
+    if multi_site and (args_dict['source'] != 'wikidata' or args_dict['engine'] == 'async'):
+        parser.error("--sites requires --source wikidata and --engine threads")
+
     print(args_dict)
 
+    metrics_exporter = None
+    batch_sizer = None
+    # the latencies of replayed requests say nothing about wikidata
+    if args_dict['batch_sizing'] == 'adaptive' and args_dict['replay'] is None:
+        batch_sizer = AdaptiveBatchSizer(max_size=args_dict['entities_per_request'],
+                                         min_size=args_dict['min_entities_per_request'],
+                                         target_latency=args_dict['target_latency'])
+
+    if args_dict['metrics'] is not None:
+        # metrics have to be enabled before the components reporting to them are created
+        shared_metrics.enable()
+        shared_metrics.gauge('rate_limiter_rate', "Current request rate (requests/sec) of the rate limiter",
+                             lambda: rate_limiter.rate)
+        if batch_sizer is not None:
+            shared_metrics.gauge('wikidata_batch_size', "Current number of entities per request of the adaptive "
+                                                        "batch sizing", batch_sizer.size)
+        metrics_exporter = MetricsExporter(shared_metrics, args_dict['metrics'], args_dict['metrics_format'],
+                                           args_dict['metrics_interval']).start()
+
     model_filename = args_dict['model']
     output_filename = args_dict['output']
     cache = args_dict['cache']
     not_found_entities_filename = args_dict['not_found_entities']
     delimiter = args_dict['delimiter']
-    persistent_entity_linker = PersistentEntityLinker(cache)
+    shard = args_dict['shard']
+    if shard is not None:
+        # every shard writes its own files, the cache is only read and extended by a private segment
+        output_filename = shard_filename(output_filename, *shard)
+        not_found_entities_filename = shard_filename(not_found_entities_filename, *shard)
+        entity_store = LayeredEntityStore(open_entity_store(shard_filename(cache, *shard), args_dict['cache_backend']),
+                                          open_entity_store(cache, args_dict['cache_backend']))
+    else:
+        entity_store = open_entity_store(cache, args_dict['cache_backend'])
+    if args_dict['write_batch_size'] > 0:
+        entity_store = WriteBehindEntityStore(entity_store, batch_size=args_dict['write_batch_size'],
+                                              max_latency=args_dict['write_latency'], fsync=args_dict['fsync'])
+    tiered_entity_store = None
+    if args_dict['memory_cache_entries'] is not None or args_dict['memory_cache_bytes'] is not None:
+        entity_store = tiered_entity_store = TieredEntityStore(entity_store, args_dict['memory_cache_entries'],
+                                                               args_dict['memory_cache_bytes'],
+                                                               args_dict['cache_stripes'])
+    alias_index = None
+    if args_dict['alias_index'] is not None:
+        if shard is not None:
+            alias_index = AliasIndex(shard_filename(args_dict['alias_index'], *shard),
+                                     base_filenames=[args_dict['alias_index']])
+        else:
+            alias_index = AliasIndex(args_dict['alias_index'])
+    persistent_entity_linker = PersistentEntityLinker(store=entity_store, alias_index=alias_index)
     thread_count = args_dict['threads']
     quotechar = args_dict['quotechar']
-
-    # load model
-    entities_per_request = 50
-    read_lock = threading.Lock()
-    write_lock = threading.Lock()
-    threads = []
+    engine = args_dict['engine']
+    max_in_flight = args_dict['max_in_flight']
+    entities_per_request = args_dict['entities_per_request']
+    api_url = args_dict['api_url']
+    rate_limiter = shared_rate_limiter
+    if args_dict['request_rate'] is not None:
+        rate_limiter = AdaptiveRateLimiter(rate=args_dict['request_rate'], max_rate=args_dict['request_rate'])
+
+    cassette = None
+    if args_dict['record'] is not None:
+        cassette = HttpCassette(args_dict['record'], 'record')
+    elif args_dict['replay'] is not None:
+        cassette = HttpCassette(args_dict['replay'], 'replay')
+
+    def create_wikidata_entity_linker(site=default_site):
+        languages = [site_language(site)] + args_dict['languages'] + [site_language(other_site) for other_site in sites]
+        return WikidataEntityLinker(session=requests.Session(), entities_per_request=entities_per_request,
+                                    rate_limiter=rate_limiter, api_url=api_url, batch_sizer=batch_sizer, site=site,
+                                    languages=list(dict.fromkeys(languages)), related_sites=sites, cassette=cassette,
+                                    request_timeout=args_dict['request_timeout'])
+
+    source_entity_linker = None
+    if args_dict['source'] == 'dump':
+        from dump_entity_linker import DumpEntityLinker
+
+        source_entity_linker = DumpEntityLinker(args_dict['dump_index'])
+    elif args_dict['source'] == 'mediawiki-db':
+        from mediawiki_entity_linker import MediaWikiDatabaseEntityLinker, mysql_connection_pool
+
+        # one pool for all threads
+        source_entity_linker = MediaWikiDatabaseEntityLinker(mysql_connection_pool(
+            args_dict['db_host'], args_dict['db_user'], args_dict['db_password'], args_dict['db_name'],
+            size=thread_count))
+
+    if source_entity_linker is not None and args_dict['fallback']:
+        source_entity_linker = FallbackEntityLinker(source_entity_linker, create_wikidata_entity_linker())
+
+    if multi_site:
+        from multi_site_linker import MultiSiteEntityLinker, SiteRowWriter
+
+    def create_linker():
+        if multi_site:
+            return MultiSiteEntityLinker([create_wikidata_entity_linker(site) for site in sites])
+        return create_wikidata_entity_linker()
+
+    # every site gets its own outputs (output, not found entities)
+    site_outputs = {site: (site_filename(output_filename, site), site_filename(not_found_entities_filename, site))
+                    for site in sites} if multi_site else {default_site: (output_filename, not_found_entities_filename)}
+    output_filenames = [filename for outputs in site_outputs.values() for filename in outputs]
 
     print(f'Starting to process model file {model_filename}...')
 
-    with open(model_filename, "r") as model_file, \
-            open(output_filename, "w+") as output_file, \
-            open(not_found_entities_filename, "w+") as not_found_entities_file:
-
+    checkpoint = None
+    rows_skipped = None
+    if args_dict['resume']:
+        checkpoint_filename = args_dict['checkpoint'] or output_filename + '.checkpoint'
+        if args_dict['checkpoint'] is not None and shard is not None:
+            checkpoint_filename = shard_filename(checkpoint_filename, *shard)
+        checkpoint = RunCheckpoint(checkpoint_filename, model_filename, output_filenames)
+        rows_skipped = checkpoint.load()
+        if rows_skipped is not None:
+            print(f'Resuming after {rows_skipped} rows written by a previous run...')
+
+    deduplicator = None
+    if args_dict['deduplicate'] is not None:
+        deduplicator = RowDeduplicator(max_keys=args_dict['dedup_max_keys'],
+                                       bloom_filter=BloomFilter(args_dict['bloom_capacity'])
+                                       if args_dict['deduplicate'] == 'bloom' else None)
+
+    def model_entities(model_file):
+        """
+        Entities of the model file in the order the pipeline links them (keys of every site when linking several
+        sites), without the rows written by a previous run.
+        """
         if quotechar == "":
             quoting = csv.QUOTE_NONE
         else:
             quoting = csv.QUOTE_MINIMAL
 
-        reader = csv.reader(model_file, delimiter=delimiter, quoting=quoting, quotechar=quotechar)
+        reader = csv.reader(model_file, delimiter=delimiter, quoting=quoting, quotechar=quotechar or None)
         next(reader)
 
-        output_file_writer = csv.writer(output_file, delimiter=',')
-        output_file_writer.writerow(['embedding_label', 'knowledgebase_id'])
-
-        not_found_entities_file_writer = csv.writer(not_found_entities_file, delimiter=',')
-
-        for i in range(0, thread_count):
-            print("Spinng up thread", i + 1)
-            thread = threading.Thread(target=entity_linker_thread, args=(
-                reader, output_file_writer, not_found_entities_file_writer, read_lock, write_lock,
-                persistent_entity_linker,
-                entities_per_request))
-            threads.append(thread)
-            thread.start()
-
-        for thread in threads:
-            thread.join()
-
+        entities = (row[0] for row in reader)
+        if shard is not None:
+            shard_index, shard_count = shard
+            entities = (entity for entity in entities if shard_of(entity, shard_count) == shard_index)
+        if multi_site:
+            entities = (cache_key(site, entity) for entity in entities for site in sites)
+        # rows_skipped counts the rows the pipeline has written, i.e. rows of this shard and one row per site
+        return itertools.islice(entities, rows_skipped or 0, None)
+
+    # a resumed run appends to the output files, which have been truncated to the last checkpoint
+    output_mode = "w+" if rows_skipped is None else "a"
+    with open(model_filename, "r") as model_file, contextlib.ExitStack() as output_files:
+        output_files_by_filename = {filename: output_files.enter_context(open(filename, output_mode))
+                                    for filename in output_filenames}
+
+        output_file_writers = dict()
+        not_found_entities_file_writers = dict()
+        for site, (site_output_filename, site_not_found_entities_filename) in site_outputs.items():
+            output_file_writers[site] = csv.writer(output_files_by_filename[site_output_filename], delimiter=',')
+            if rows_skipped is None:
+                output_file_writers[site].writerow(['embedding_label', 'knowledgebase_id'])
+            not_found_entities_file_writers[site] = csv.writer(
+                output_files_by_filename[site_not_found_entities_filename], delimiter=',')
+
+        if multi_site:
+            output_file_writer = SiteRowWriter(output_file_writers)
+            not_found_entities_file_writer = SiteRowWriter(not_found_entities_file_writers)
+        else:
+            output_file_writer = output_file_writers[default_site]
+            not_found_entities_file_writer = not_found_entities_file_writers[default_site]
+
+        if checkpoint is not None:
+            checkpoint.attach(list(output_files_by_filename.values()))
+
+        async_wikidata_entity_linker = None
+        if engine == 'async':
+            from async_wikidata_entity_linker import AsyncWikidataEntityLinker
+
+            async_wikidata_entity_linker = AsyncWikidataEntityLinker(entities_per_request=entities_per_request,
+                                                                     max_in_flight=max_in_flight,
+                                                                     rate_limiter=rate_limiter, api_url=api_url,
+                                                                     batch_sizer=batch_sizer, cassette=cassette,
+                                                                     request_timeout=args_dict['request_timeout'])
+            source_entity_linker = async_wikidata_entity_linker
+
+        def create_proxy():
+            return WikidataEntityLinkerProxy(persistent_entity_linker=persistent_entity_linker,
+                                             wikidata_entity_linker=source_entity_linker
+                                             if source_entity_linker is not None
+                                             else create_linker())
+
+        pipeline_arguments = dict(
+            # the multi site linker splits its batches by site using the batch sizer
+            entities_per_request=entities_per_request if not multi_site
+            else MultiSiteEntityLinker.keys_per_call(entities_per_request, len(sites)),
+            batch_sizer=batch_sizer if not multi_site else None, workers=thread_count,
+            max_in_flight=max_in_flight if engine == 'async' else None)
+
+        if args_dict['frequency_first']:
+            with open(model_filename, "r") as counted_model_file:
+                frequent_entities = labels_by_frequency(model_entities(counted_model_file))
+            print(f'Linking {len(frequent_entities)} distinct entities, the most frequent first...')
+            # only fills the cache, the output is written in model order by the pipeline below
+            discarding_writer = csv.writer(output_files.enter_context(open(os.devnull, "w")))
+            prefetch_statistics = LinkingPipeline(create_proxy, persistent_entity_linker, discarding_writer,
+                                                  discarding_writer, **pipeline_arguments).run(frequent_entities)
+            print(prefetch_statistics)
+            del frequent_entities
+
+        pipeline = LinkingPipeline(create_proxy, persistent_entity_linker, output_file_writer,
+                                   not_found_entities_file_writer,
+                                   ordered=args_dict['ordered'] or checkpoint is not None, checkpoint=checkpoint,
+                                   checkpoint_interval=args_dict['checkpoint_interval'],
+                                   rows_skipped=rows_skipped or 0, deduplicator=deduplicator,
+                                   # the failed rows are those of this pipeline, not of the prefetching one
+                                   cassette=cassette, **pipeline_arguments)
+        pipeline_statistics = pipeline.run(model_entities(model_file))
+
+        if async_wikidata_entity_linker is not None:
+            async_wikidata_entity_linker.close()
+
+    persistent_entity_linker.close()
+    if cassette is not None:
+        cassette.close()
+    if metrics_exporter is not None:
+        metrics_exporter.stop()
+
+    in_flight_statistics = shared_in_flight_requests.statistics()
     print()
+    print(pipeline_statistics)
+    print(f"{in_flight_statistics['requested_entities']} entities requested, "
+          f"{in_flight_statistics['coalesced_entities']} requests saved by coalescing")
+    if tiered_entity_store is not None:
+        tier_statistics = tiered_entity_store.statistics()
+        print(f"memory cache: {tier_statistics['memory']['hits']} hits, {tier_statistics['memory']['misses']} misses, "
+              f"{tier_statistics['memory']['evictions']} evictions; disk cache: {tier_statistics['disk']['hits']} "
+              f"hits, {tier_statistics['disk']['misses']} misses")
+    if cassette is not None:
+        cassette_statistics = cassette.statistics()
+        if cassette.mode == 'record':
+            print(f"{cassette_statistics['recorded_exchanges']} responses and "
+                  f"{cassette_statistics['recorded_failures']} failed batches recorded to {cassette.filename}, "
+                  f"{cassette_statistics['recorded_bytes']} bytes stored in {cassette_statistics['stored_bytes']} "
+                  f"bytes")
+        else:
+            print(f"{cassette_statistics['replayed_exchanges']} recorded responses replayed, "
+                  f"{cassette_statistics['assembled_requests']} requests assembled from the responses of other "
+                  f"batches, {cassette_statistics['missed_requests']} requests not recorded")
+    if deduplicator is not None:
+        deduplicator_state = deduplicator.state()
+        print(f"deduplication: {deduplicator_state.collapsed_rows} rows collapsed into rows in flight, "
+              f"{deduplicator_state.answered_rows} rows answered by {deduplicator_state.remembered_keys} remembered "
+              f"results")
+    if batch_sizer is not None:
+        batch_sizer_state = batch_sizer.state()
+        print(f"adaptive batch sizing: {batch_sizer_state.size} entities per request at the end, "
+              f"{batch_sizer_state.decreases} decreases, {batch_sizer_state.errors} failed requests")
     print("All done!")
 
     # print(f'Requesting wikidata ids  {entity_counter}/{len(missing_batch_entities)}')
@@ -0,0 +1,41 @@
+import os
+
+# site linked against if no other sites are given
+default_site = 'enwiki'
+# separates the site from the entity in cache keys, U+001F is never part of a requestable title
+_key_separator = '\x1f'
+
+
+def cache_key(site, entity):
+    """
+    Key of entity linked on site in the cache. Entities of default_site are stored under the entity itself, so caches
+    written before other sites could be linked stay valid.
+    """
+    return entity if site == default_site else f"{site}{_key_separator}{entity}"
+
+
+def split_cache_key(key):
+    """
+    :return: A tuple<site, entity> of a key created by cache_key.
+    """
+    site, separator, entity = key.partition(_key_separator)
+    if not separator:
+        return default_site, key
+    return site, entity
+
+
+def site_language(site):
+    """
+    :return: The language of a wikipedia site, e.g. 'de' for 'dewiki' and 'zh-yue' for 'zh_yuewiki'.
+    """
+    if site.endswith('wiki') and site != 'commonswiki':
+        return site[:-len('wiki')].replace('_', '-')
+    return 'en'
+
+
+def site_filename(filename, site):
+    """
+    Output file of a site when linking several sites at once, e.g. linking.dewiki.csv.
+    """
+    root, extension = os.path.splitext(filename)
+    return f"{root}.{site}{extension}"